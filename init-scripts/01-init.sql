@@ -33,7 +33,10 @@ CREATE TABLE user_settings (
 
 CREATE TABLE image_queries (
     query_id VARCHAR(255) PRIMARY KEY,
-    embeddings FLOAT[] NOT NULL,
+    embeddings BYTEA NOT NULL,
+    embedding_rows INTEGER NOT NULL,
+    embedding_dim INTEGER NOT NULL,
+    embedding_dtype VARCHAR NOT NULL DEFAULT 'float16',
     text TEXT,
     is_visual_only BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
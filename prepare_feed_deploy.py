@@ -642,6 +642,8 @@ colpali_schema = Schema(
                 match=["text"],
                 index="enable-bm25",
             ),
+            Field(name="pooling_ratio", type="float", indexing=["summary", "attribute"]),
+            Field(name="patch_clusters", type="array<int>", indexing=["summary"]),
             Field(
                 name="embedding",
                 type="tensor<int8>(patch{}, v[16])",
@@ -697,6 +699,26 @@ colpali_schema = Schema(
             ],
             from_disk=True,
         ),
+        DocumentSummary(
+            name="results_sim",
+            summary_fields=[
+                Summary(name="id"),
+                Summary(name="patch_clusters"),
+                Summary(name="title"),
+                Summary(name="url"),
+                Summary(name="blur_image"),
+                Summary(name="page_number"),
+                Summary(
+                    name="text",
+                    fields=[("bolding", "on")],
+                ),
+                Summary(
+                    name="snippet",
+                    fields=[("source", "text"), "dynamic"],
+                ),
+            ],
+            from_disk=True,
+        ),
     ],
 )
 
@@ -0,0 +1,45 @@
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+# Accepts numpy arrays, torch tensors (any dtype or device) and nested lists
+ArrayLike = Union[np.ndarray, "torch.Tensor", list]  # noqa: F821
+
+
+def to_numpy(embeddings: ArrayLike) -> np.ndarray:
+    """Convert embeddings to a float32 numpy array, moving torch tensors to the CPU first."""
+    if hasattr(embeddings, "detach"):
+        embeddings = embeddings.detach().float().cpu().numpy()
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def binarize(embeddings: ArrayLike) -> np.ndarray:
+    """
+    Binarize embeddings by sign and pack every 8 dimensions into one int8, in a single vectorized call.
+
+    Args:
+        embeddings (ArrayLike): Float embeddings of shape [..., 128].
+
+    Returns:
+        np.ndarray: Packed embeddings of shape [..., 16] and dtype int8.
+    """
+    return np.packbits(to_numpy(embeddings) > 0, axis=-1).view(np.int8)
+
+
+def tensor_cells(array: np.ndarray) -> Dict[int, List]:
+    """
+    Convert a [N, D] array to the Vespa JSON short form of a mixed tensor such as
+    `tensor<int8>(patch{}, v[16])`: a dict from the mapped dimension index to the dense values.
+    """
+    return dict(enumerate(array.tolist()))
+
+
+def float_cells(embeddings: ArrayLike) -> Dict[int, List[float]]:
+    return tensor_cells(to_numpy(embeddings))
+
+
+def binary_cells(embeddings: ArrayLike, max_rows: Optional[int] = None) -> Dict[int, List[int]]:
+    packed = binarize(embeddings)
+    if max_rows is not None:
+        packed = packed[:max_rows]
+    return tensor_cells(packed)
@@ -1,3 +1,4 @@
+import threading
 from collections import OrderedDict
 
 
@@ -6,24 +7,29 @@ class LRUCache:
     def __init__(self, max_size=20):
         self.max_size = max_size
         self.cache = OrderedDict()
+        # Entries are read and written from both the event loop and worker threads
+        self.lock = threading.Lock()
 
     def get(self, key):
         key = str(key)
-        if key in self.cache:
-            self.cache.move_to_end(key)
-            return self.cache[key]
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
         return None
 
     def set(self, key, value):
         key = str(key)
-        if key in self.cache:
-            self.cache.move_to_end(key)
-        else:
-            if len(self.cache) >= self.max_size:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                if len(self.cache) >= self.max_size:
+                    self.cache.popitem(last=False)
+            self.cache[key] = value
 
     def delete(self, key):
         key = str(key)
-        if key in self.cache:
-            del self.cache[key]
+        with self.lock:
+            if key in self.cache:
+                del self.cache[key]
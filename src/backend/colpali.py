@@ -1,35 +1,39 @@
 import torch
 from PIL import Image
 import numpy as np
-from typing import Generator, Tuple, List, Union, Dict
+from typing import TYPE_CHECKING, Generator, Iterable, Optional, Tuple, List, Union, Dict
 from pathlib import Path
 import base64
 from io import BytesIO
 import re
 import io
-import matplotlib.cm as cm
-
-from colpali_engine.models import ColPali, ColPaliProcessor
-from colpali_engine.utils.torch_utils import get_torch_device
-from vidore_benchmark.interpretability.torch_utils import (
-    normalize_similarity_map_per_query_token,
-)
-from functools import lru_cache
 import logging
 
+from .encoder_scheduler import EncoderScheduler
+from .precision import load_colpali
+from .query_embedding_cache import QueryEmbeddingCache
+
+# colpali_engine, vidore_benchmark and matplotlib are slow to import, so they are imported where they are
+# first needed. This keeps `should_filter_token` and friends cheap to import for the web process.
+if TYPE_CHECKING:
+    from colpali_engine.models import ColPali, ColPaliProcessor
+
 
 class SimMapGenerator:
     """
     Generates similarity maps based on query embeddings and image patches using the ColPali model.
     """
 
-    colormap = cm.get_cmap("viridis")  # Preload colormap for efficiency
+    _colormap = None
 
     def __init__(
         self,
         logger: logging.Logger,
         model_name: str = "vidore/colpali-v1.2",
         n_patch: int = 32,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        precision: str = "fp32",
+        scheduler: Optional[EncoderScheduler] = None,
     ):
         """
         Initializes the SimMapGenerator class with a specified model and patch dimension.
@@ -37,28 +41,40 @@ class SimMapGenerator:
         Args:
             model_name (str): The model name for loading the ColPali model.
             n_patch (int): The number of patches per dimension.
+            query_cache (QueryEmbeddingCache, optional): Persistent cache for query embeddings.
+            precision (str): Inference precision, one of backend.precision.PRECISIONS.
+            scheduler (EncoderScheduler, optional): Arbitrates the model between queries and page encoding.
         """
         self.model_name = model_name
         self.n_patch = n_patch
+        self.query_cache = query_cache
+        self.precision = precision
+        self.scheduler = scheduler or EncoderScheduler(logger)
+        from colpali_engine.utils.torch_utils import get_torch_device
+
         self.device = get_torch_device("auto")
         self.logger = logger
         self.logger.info(f"Using device: {self.device}")
         self.model, self.processor = self.load_model()
 
-    def load_model(self) -> Tuple[ColPali, ColPaliProcessor]:
+    @classmethod
+    def colormap(cls, values: np.ndarray) -> np.ndarray:
+        if cls._colormap is None:
+            import matplotlib.cm as cm
+
+            cls._colormap = cm.get_cmap("viridis")
+        return cls._colormap(values)
+
+    def load_model(self) -> Tuple["ColPali", "ColPaliProcessor"]:
         """
-        Loads the ColPali model and processor.
+        Loads the ColPali model and processor in the configured precision.
 
         Returns:
             Tuple[ColPali, ColPaliProcessor]: Loaded model and processor.
         """
-        model = ColPali.from_pretrained(
-            self.model_name,
-            torch_dtype=torch.float32,  # Note that the embeddings created during feed were float32 -> binarized, yet setting this seem to produce the most similar results both locally (mps) and HF (Cuda)
-            device_map=self.device,
-        ).eval()
-
-        processor = ColPaliProcessor.from_pretrained(self.model_name)
+        model, processor, self.precision = load_colpali(
+            self.model_name, self.device, self.precision, self.logger
+        )
         return model, processor
 
     def gen_similarity_maps(
@@ -72,6 +88,9 @@ class SimMapGenerator:
         """
         Generates similarity maps for the provided images and query, and returns base64-encoded blended images.
 
+        Maps are generated most useful first, in the order of `sim_map_order`, so a consumer that stops early
+        has rendered the maps users are most likely to open.
+
         Args:
             query (str): The query string.
             query_embs (torch.Tensor): Query embeddings tensor.
@@ -80,8 +99,12 @@ class SimMapGenerator:
             vespa_sim_maps (List[Dict]): List of Vespa similarity maps.
 
         Yields:
-            Tuple[int, str, str]: A tuple containing the image index, selected token, and base64-encoded image.
+            Tuple[int, str, int, str]: The image index, the token, its index and the base64-encoded image.
         """
+        from vidore_benchmark.interpretability.torch_utils import (
+            normalize_similarity_map_per_query_token,
+        )
+
         processed_images, original_images, original_sizes = [], [], []
         for img in images:
             img_pil = self._load_image(img)
@@ -96,16 +119,50 @@ class SimMapGenerator:
             vespa_sim_map_tensor
         )
 
-        for idx, img in enumerate(original_images):
-            for token_idx, token in token_idx_map.items():
-                if self.should_filter_token(token):
-                    continue
+        for idx, token_idx in self.sim_map_order(vespa_sim_map_tensor, token_idx_map):
+            sim_map = similarity_map_normalized[idx, token_idx, :, :]
+            blended_img_base64 = self._blend_image(
+                original_images[idx], sim_map, original_sizes[idx]
+            )
+            yield idx, token_idx_map[token_idx], token_idx, blended_img_base64
 
-                sim_map = similarity_map_normalized[idx, token_idx, :, :]
-                blended_img_base64 = self._blend_image(
-                    img, sim_map, original_sizes[idx]
-                )
-                yield idx, token, token_idx, blended_img_base64
+    def sim_map_order(
+        self, sim_map_tensor: torch.Tensor, token_idx_map: Dict[int, str]
+    ) -> List[Tuple[int, int]]:
+        """
+        Order the sim maps of a query by how likely they are to be opened.
+
+        A token contributes its best patch similarity to the MaxSim score of a page, so its share of the sum of
+        those maxima tells how much of the match it explains. That share is weighted by 1 / (rank + 1), so the
+        most informative token of the top result comes first and weak tokens of lower results last.
+
+        Args:
+            sim_map_tensor (torch.Tensor): Unnormalized similarities of shape [images, query tokens, n_patch, n_patch].
+            token_idx_map (Dict[int, str]): Mapping from indices to tokens.
+
+        Returns:
+            List[Tuple[int, int]]: (image index, token index) of every map to render, most useful first.
+        """
+        token_indices = [
+            token_idx
+            for token_idx, token in token_idx_map.items()
+            if not self.should_filter_token(token) and token_idx < sim_map_tensor.size(1)
+        ]
+        if not token_indices:
+            return []
+        contributions = (
+            sim_map_tensor[:, token_indices].amax(dim=(2, 3)).clamp(min=0)
+        )
+        shares = contributions / contributions.sum(dim=1, keepdim=True).clamp(min=1e-12)
+        ranks = torch.arange(sim_map_tensor.size(0), dtype=shares.dtype)
+        priorities = shares / (ranks + 1).unsqueeze(1)
+
+        # Stable sort, so ties stay in result and query order
+        order = torch.sort(priorities.flatten(), descending=True, stable=True).indices.tolist()
+        return [
+            (position // len(token_indices), token_indices[position % len(token_indices)])
+            for position in order
+        ]
 
     def _load_image(self, img: Union[Path, str]) -> Image:
         """
@@ -142,6 +199,11 @@ class SimMapGenerator:
             (len(vespa_sim_maps), query_embs.size(1), self.n_patch, self.n_patch)
         )
         for idx, vespa_sim_map in enumerate(vespa_sim_maps):
+            if "patch_clusters" in vespa_sim_map:
+                self._fill_pooled_similarity_map(
+                    vespa_sim_map_tensor[idx], vespa_sim_map
+                )
+                continue
             for cell in vespa_sim_map["quantized"]["cells"]:
                 patch = int(cell["address"]["patch"])
                 query_token = int(cell["address"]["querytoken"])
@@ -161,6 +223,26 @@ class SimMapGenerator:
                 ] = value
         return vespa_sim_map_tensor
 
+    def _fill_pooled_similarity_map(
+        self, sim_map_tensor: torch.Tensor, vespa_sim_map: Dict
+    ) -> None:
+        """
+        Fill the similarity map of a page fed with patch pooling. Every image patch gets the value of the
+        pooled vector it was merged into.
+
+        Args:
+            sim_map_tensor (torch.Tensor): Tensor of shape [query tokens, n_patch, n_patch] to fill.
+            vespa_sim_map (Dict): Vespa similarity map, with the pooled vector of every image patch.
+        """
+        clusters = torch.tensor(vespa_sim_map["patch_clusters"], dtype=torch.long)
+        pooled = torch.zeros((sim_map_tensor.size(0), int(clusters.max()) + 1))
+        for cell in vespa_sim_map["quantized"]["cells"]:
+            patch = int(cell["address"]["patch"])
+            if patch < pooled.size(1):
+                pooled[int(cell["address"]["querytoken"]), patch] = cell["value"]
+        grid = pooled[:, clusters]
+        sim_map_tensor.view(sim_map_tensor.size(0), -1)[:, : grid.size(1)] = grid
+
     def _blend_image(
         self, img: Image, sim_map: torch.Tensor, original_size: Tuple[int, int]
     ) -> str:
@@ -257,12 +339,54 @@ class SimMapGenerator:
         )
         return bool(pattern.match(token))
 
-    @lru_cache(maxsize=128)
     def get_query_embeddings_and_token_map(
         self, query: str
     ) -> Tuple[torch.Tensor, dict]:
         """
-        Retrieves query embeddings and a token index map.
+        Retrieves query embeddings and a token index map, from the query embedding cache if possible.
+
+        Cached embeddings are stored in float16, so the embeddings returned for a newly encoded query are
+        rounded the same way, and a query gives the same results whether it was cached or not.
+
+        Args:
+            query (str): The query string.
+
+        Returns:
+            Tuple[torch.Tensor, dict]: Query embeddings and token index map.
+        """
+        if self.query_cache is None:
+            return self.encode_query(query)
+
+        key = self.query_cache.make_key(self.model_name, self.precision, query)
+        cached = self.query_cache.get(key)
+        if cached is None:
+            q_emb, idx_to_token = self.encode_query(query)
+            embedding = q_emb.to(torch.float16).numpy()
+            self.query_cache.set(key, embedding, idx_to_token)
+            cached = (embedding, idx_to_token)
+        embedding, idx_to_token = cached
+        return torch.from_numpy(embedding.astype(np.float32)), idx_to_token
+
+    def warm_query_cache(self, queries: Iterable[str]) -> int:
+        """
+        Encode the queries that are not cached yet, e.g. the configured demo questions.
+
+        Returns:
+            int: The number of queries that were encoded.
+        """
+        if self.query_cache is None:
+            return 0
+        encoded = 0
+        for query in queries:
+            key = self.query_cache.make_key(self.model_name, self.precision, query)
+            if self.query_cache.get(key) is None:
+                self.get_query_embeddings_and_token_map(query)
+                encoded += 1
+        return encoded
+
+    def encode_query(self, query: str) -> Tuple[torch.Tensor, dict]:
+        """
+        Run the model on a query.
 
         Args:
             query (str): The query string.
@@ -271,11 +395,30 @@ class SimMapGenerator:
             Tuple[torch.Tensor, dict]: Query embeddings and token index map.
         """
         inputs = self.processor.process_queries([query]).to(self.model.device)
-        with torch.no_grad():
-            q_emb = self.model(**inputs).to("cpu")[0]
+        with self.scheduler.slot(EncoderScheduler.QUERY), torch.no_grad():
+            q_emb = self.model(**inputs).to("cpu", dtype=torch.float32)[0]
 
         query_tokens = self.processor.tokenizer.tokenize(
             self.processor.decode(inputs.input_ids[0])
         )
         idx_to_token = {idx: token for idx, token in enumerate(query_tokens)}
         return q_emb, idx_to_token
+
+    @property
+    def num_image_patches(self) -> int:
+        """Number of image patch tokens at the start of the embeddings of an image"""
+        return getattr(self.processor, "image_seq_length", 1024)
+
+    def encode_image_query(self, image: Image.Image) -> torch.Tensor:
+        """
+        Run the model on an image used as a query. This is interactive, so it runs in the query lane.
+
+        Args:
+            image (Image.Image): The query image.
+
+        Returns:
+            torch.Tensor: Patch embeddings of shape [num_patches, 128].
+        """
+        inputs = self.processor.process_images([image]).to(self.model.device)
+        with self.scheduler.slot(EncoderScheduler.QUERY), torch.no_grad():
+            return self.model(**inputs).to("cpu", dtype=torch.float32)[0]
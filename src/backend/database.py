@@ -1,17 +1,25 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker as sessionMaker
 from sqlalchemy.schema import CreateTable
-from sqlalchemy import select, delete
-from uuid import UUID
+from sqlalchemy import select, delete, func, text
+from uuid import UUID, uuid4
+import asyncio
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, AsyncGenerator
 from contextlib import asynccontextmanager
 from .models import User, UserDocument, UserSettings, RankerType, ImageQuery
 from .base import Base
 import logging
 from pathlib import Path
+import numpy as np
 import torch
+from datetime import timedelta
 from .auth import hash_password
+from .binarize import to_numpy
 
 DATABASE_URL = (
     f"postgresql+asyncpg://"
@@ -22,43 +30,187 @@ DATABASE_URL = (
     f"{os.getenv('POSTGRES_DB', 'postgres')}"
 )
 
-# Create async engine
-engine = create_async_engine(DATABASE_URL, echo=False)
+# Create async engine. Every worker process has its own pool, so the total number of connections is up to
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW) times the number of workers.
+engine = create_async_engine(
+    # SQLAlchemy's per-connection cache of asyncpg prepared statements
+    f"{DATABASE_URL}?prepared_statement_cache_size={int(os.getenv('DB_STATEMENT_CACHE_SIZE', '256'))}",
+    echo=False,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+    pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+)
 async_session = sessionMaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 STORAGE_DIR = Path("storage/user_documents")
+FILE_REMOVAL_WORKERS = 8
+
+# Channel on which settings changes are announced to the other workers
+SETTINGS_CHANNEL = "user_settings_changed"
+# Without SETTINGS_CACHE_NOTIFY, a change made by another worker is seen after at most this long
+SETTINGS_CACHE_TTL_SECONDS = float(os.getenv("SETTINGS_CACHE_TTL_SECONDS", "30"))
+
 
 class Database:
     def __init__(self):
         self.session_maker = async_session
         self.logger = logging.getLogger("vespa_app")
+        # Write-through caches of the settings and usernames per user_id, as (value, expiry time), see
+        # `invalidate_user`
+        self.settings_cache: dict[str, tuple] = {}
+        self.username_cache: dict[str, tuple] = {}
+        self.instance_id = uuid4().hex
+        self._listener = None
+        self._listener_task = None
+        self._pool_waits = {"checkouts": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0, "slow_checkouts": 0}
+        # Sessions are also opened from worker threads with their own event loops
+        self._pool_waits_lock = threading.Lock()
 
     @asynccontextmanager
     async def get_session(self) -> AsyncGenerator[AsyncSession, None]:
         async with self.session_maker() as session:
             try:
+                await self._checkout(session)
                 yield session
                 await session.commit()
             except Exception:
                 await session.rollback()
                 raise
 
+    @asynccontextmanager
+    async def get_read_session(self) -> AsyncGenerator[AsyncSession, None]:
+        """A session for queries that don't write; the transaction is rolled back instead of committed"""
+        async with self.session_maker() as session:
+            await self._checkout(session)
+            yield session
+
+    async def _checkout(self, session: AsyncSession) -> None:
+        # Get the connection up front, to measure how long requests wait for the pool
+        start = time.perf_counter()
+        await session.connection()
+        wait = time.perf_counter() - start
+        with self._pool_waits_lock:
+            self._pool_waits["checkouts"] += 1
+            self._pool_waits["total_wait_seconds"] += wait
+            self._pool_waits["max_wait_seconds"] = max(self._pool_waits["max_wait_seconds"], wait)
+            if wait > 0.1:
+                self._pool_waits["slow_checkouts"] += 1
+
+    def pool_stats(self) -> dict:
+        """Connection pool status of this worker, and how long sessions waited for a connection"""
+        pool = engine.pool
+        with self._pool_waits_lock:
+            waits = dict(self._pool_waits)
+        checkouts = waits["checkouts"]
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            **waits,
+            "mean_wait_seconds": waits["total_wait_seconds"] / checkouts if checkouts else 0.0,
+        }
+
     async def get_user_by_id(self, user_id: UUID) -> Optional[User]:
         """Get user by ID"""
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             result = await session.execute(
                 select(User).where(User.user_id == user_id)
             )
             return result.scalar_one_or_none()
 
     async def fetch_one(self, query, *args):
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             result = await session.execute(query, args)
             return result.mappings().first()
 
     async def close(self):
+        await self.stop_settings_listener()
         await engine.dispose()
 
+    def invalidate_user(self, user_id: str) -> None:
+        """Drop the cached settings and username of a user"""
+        key = str(user_id)
+        self.settings_cache.pop(key, None)
+        self.username_cache.pop(key, None)
+
+    @staticmethod
+    def _cached(cache: dict, key: str):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            cache.pop(key, None)
+            return None
+        return value
+
+    @staticmethod
+    def _cache(cache: dict, key: str, value) -> None:
+        cache[key] = (value, time.monotonic() + SETTINGS_CACHE_TTL_SECONDS)
+
+    async def get_username(self, user_id: str) -> Optional[str]:
+        """Get the username of a user, from the cache for SETTINGS_CACHE_TTL_SECONDS after a lookup"""
+        key = str(user_id)
+        username = self._cached(self.username_cache, key)
+        if username is None:
+            user = await self.get_user_by_id(UUID(key))
+            if not user:
+                return None
+            username = user.username
+            self._cache(self.username_cache, key, username)
+        return username
+
+    async def start_settings_listener(self) -> None:
+        """
+        Listen for settings changes made by other workers on SETTINGS_CHANNEL, and drop them from the cache.
+
+        If the connection is lost, notifications may have been missed, so the whole cache is cleared before
+        reconnecting.
+        """
+        import asyncpg
+
+        async def listen():
+            while True:
+                try:
+                    self._listener = await asyncpg.connect(
+                        DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://")
+                    )
+                    lost = asyncio.Event()
+                    self._listener.add_termination_listener(lambda conn: lost.set())
+                    await self._listener.add_listener(SETTINGS_CHANNEL, self._on_settings_changed)
+                    self.logger.info(f"Listening for settings changes on {SETTINGS_CHANNEL}")
+                    await lost.wait()
+                    self.logger.warning("Lost the settings listener connection")
+                except Exception as e:
+                    self.logger.error(f"Settings listener error: {str(e)}")
+                self.settings_cache.clear()
+                self.username_cache.clear()
+                await asyncio.sleep(5)
+
+        self._listener_task = asyncio.create_task(listen())
+
+    async def stop_settings_listener(self) -> None:
+        if self._listener_task:
+            self._listener_task.cancel()
+            self._listener_task = None
+        if self._listener and not self._listener.is_closed():
+            await self._listener.close()
+
+    def _on_settings_changed(self, connection, pid, channel, payload):
+        instance_id, user_id = payload.split(":", 1)
+        if instance_id != self.instance_id:
+            self.invalidate_user(user_id)
+
+    async def _notify_settings_changed(self, session: AsyncSession, user_id: str) -> None:
+        # Delivered when the transaction commits
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": SETTINGS_CHANNEL, "payload": f"{self.instance_id}:{user_id}"},
+        )
+
     async def init_tables(self):
         """Create tables if they don't exist"""
         async with engine.begin() as conn:
@@ -74,7 +226,7 @@ class Database:
     async def get_user_documents(self, user_id: UUID):
         """Get all documents for a user"""
         self.logger.debug(f"Database: Fetching documents for user_id: {user_id}")
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             result = await session.execute(
                 select(UserDocument).where(UserDocument.user_id == user_id)
             )
@@ -84,12 +236,20 @@ class Database:
 
     async def get_user_document_by_id(self, document_id: str):
         """Get a document by ID"""
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             result = await session.execute(
                 select(UserDocument).where(UserDocument.document_id == document_id)
             )
             return result.scalar_one_or_none()
 
+    async def get_document_owners(self) -> dict[str, str]:
+        """Get the owning user_id of every document, keyed by document_id"""
+        async with self.get_read_session() as session:
+            result = await session.execute(
+                select(UserDocument.document_id, UserDocument.user_id)
+            )
+            return {document_id: str(user_id) for document_id, user_id in result.all()}
+
     async def add_user_document(self, user_id: str, document_name: str, file_content: bytes):
         """Add a new document to both filesystem and database"""
         self.logger.debug(f"Adding document {document_name} for user {user_id}")
@@ -142,26 +302,6 @@ class Database:
                         await self.delete_document(document.document_id)
             raise
 
-    async def delete_all_user_documents(self, user_id: str):
-        """Delete all documents for a given user"""
-        self.logger.debug(f"Deleting all documents for user {user_id}")
-
-        try:
-            async with self.get_session() as session:
-                result = await session.execute(
-                    select(UserDocument).where(UserDocument.user_id == UUID(user_id))
-                )
-                documents = result.scalars().all()
-
-                for document in documents:
-                    await self.delete_document(str(document.document_id))
-
-                self.logger.info(f"Successfully deleted all documents for user {user_id}")
-
-        except Exception as e:
-            self.logger.error(f"Error deleting documents for user {user_id}: {str(e)}")
-            raise
-
     async def delete_document(self, document_id: str):
         """Delete a document from both database and filesystem"""
         self.logger.debug(f"Deleting document {document_id}")
@@ -169,36 +309,64 @@ class Database:
         try:
             async with self.get_session() as session:
                 result = await session.execute(
-                    select(UserDocument).where(UserDocument.document_id == document_id)
+                    delete(UserDocument)
+                    .where(UserDocument.document_id == document_id)
+                    .returning(UserDocument.user_id, UserDocument.file_extension)
                 )
-                document = result.scalar_one_or_none()
-
-                if not document:
-                    self.logger.warning(f"Document {document_id} not found in database")
-                    return
+                document = result.one_or_none()
 
-                file_path = STORAGE_DIR / str(document.user_id) / f"{document_id}{document.file_extension}"
-                if file_path.exists():
-                    file_path.unlink()
-                    self.logger.info(f"Deleted file {file_path}")
+            if not document:
+                self.logger.warning(f"Document {document_id} not found in database")
+                return
+            self.logger.info(f"Deleted database entry for document {document_id}")
 
-                await session.execute(
-                    delete(UserDocument).where(UserDocument.document_id == document_id)
-                )
-                await session.commit()
-                self.logger.info(f"Deleted database entry for document {document_id}")
+            user_id, file_extension = document
+            await self._remove_files([STORAGE_DIR / str(user_id) / f"{document_id}{file_extension}"])
 
         except Exception as e:
             self.logger.error(f"Error deleting document {document_id}: {str(e)}")
             raise
 
+    async def _remove_files(self, paths: list[Path]) -> None:
+        """Remove files on a thread pool, so large deletes neither block the event loop nor run one by one"""
+        if not paths:
+            return
+
+        def remove(path: Path):
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                self.logger.error(f"Error deleting file {path}: {str(e)}")
+
+        def remove_all():
+            with ThreadPoolExecutor(max_workers=FILE_REMOVAL_WORKERS) as executor:
+                list(executor.map(remove, paths))
+
+        await asyncio.to_thread(remove_all)
+        self.logger.debug(f"Deleted {len(paths)} files")
+
     async def get_demo_questions(self, user_id: str) -> list[str]:
         """Get demo questions for a user"""
         settings = await self.get_user_settings(user_id)
         return settings.demo_questions if settings else []
 
+    async def get_all_demo_questions(self) -> list[str]:
+        """Get the demo questions of all users, without duplicates"""
+        async with self.get_read_session() as session:
+            result = await session.execute(select(UserSettings.demo_questions))
+            questions = dict.fromkeys(
+                question
+                for demo_questions in result.scalars().all()
+                for question in (demo_questions or [])
+            )
+            return list(questions)
+
     async def get_user_settings(self, user_id: str) -> UserSettings:
         """Get user settings, creating default settings if they don't exist"""
+        cached = self._cached(self.settings_cache, str(user_id))
+        if cached is not None:
+            return cached
+
         async with self.get_session() as session:
             user_id_uuid = UUID(user_id)
 
@@ -225,7 +393,10 @@ class Database:
                 )
                 session.add(settings)
                 await session.commit()
+                # Load the server-side defaults before the row is cached
+                await session.refresh(settings)
 
+            self._cache(self.settings_cache, str(user_id), settings)
             return settings
 
     async def update_settings(self, user_id: str, settings: dict) -> None:
@@ -248,11 +419,14 @@ class Database:
                 )
                 session.add(user_settings)
 
+            await self._notify_settings_changed(session, str(user_id))
             await session.commit()
+            await session.refresh(user_settings)
+            self._cache(self.settings_cache, str(user_id), user_settings)
 
     async def get_users_list(self) -> list[User]:
         """Get all users from the app_user table"""
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             result = await session.execute(
                 select(User)
             )
@@ -262,28 +436,45 @@ class Database:
                 for user in users
             ]
 
-    async def delete_users(self, user_ids: set) -> None:
-        """Delete users and their associated data."""
+    async def delete_users(self, user_ids: set) -> dict[str, list[str]]:
+        """
+        Delete users and their associated data, with one statement per table for all of them.
+
+        Returns:
+            dict[str, list[str]]: The ids of the deleted documents of every deleted user.
+        """
+        if not user_ids:
+            return {}
+        user_uuids = [UUID(user_id) for user_id in user_ids]
+
         async with self.get_session() as session:
+            result = await session.execute(
+                delete(UserDocument)
+                .where(UserDocument.user_id.in_(user_uuids))
+                .returning(UserDocument.document_id, UserDocument.user_id)
+            )
+            deleted_documents = {str(user_id): [] for user_id in user_ids}
+            for document_id, user_id in result.all():
+                deleted_documents[str(user_id)].append(str(document_id))
+
+            await session.execute(delete(UserSettings).where(UserSettings.user_id.in_(user_uuids)))
+            await session.execute(delete(User).where(User.user_id.in_(user_uuids)))
             for user_id in user_ids:
-                user_id_uuid = UUID(user_id)
-                try:
-                    await session.execute(delete(UserSettings).where(UserSettings.user_id == user_id_uuid))
-                    self.logger.debug(f"Deleted settings for user ID: {user_id}")
-                    await self.delete_all_user_documents(user_id)
-
-                    user_keys_dir = Path(f"storage/user_keys/{user_id}")
-                    if user_keys_dir.exists():
-                        for file in user_keys_dir.iterdir():
-                            file.unlink()
-                        user_keys_dir.rmdir()
-                        self.logger.debug(f"Deleted user keys directory for user ID: {user_id}")
-
-                    await session.execute(delete(User).where(User.user_id == user_id_uuid))
-                    self.logger.info(f"Deleted user with ID: {user_id}")
-                except Exception as e:
-                    self.logger.error(f"Error deleting user {user_id}: {e}")
+                await self._notify_settings_changed(session, str(user_id))
 
+        for user_id in user_ids:
+            self.invalidate_user(user_id)
+
+        # The documents and keys of a user live in their own directories
+        def remove_directories():
+            for user_id in user_ids:
+                for directory in (STORAGE_DIR / str(user_id), Path("storage/user_keys") / str(user_id)):
+                    shutil.rmtree(directory, ignore_errors=True)
+
+        await asyncio.to_thread(remove_directories)
+        for user_id, document_ids in deleted_documents.items():
+            self.logger.info(f"Deleted user with ID: {user_id} and {len(document_ids)} documents")
+        return deleted_documents
 
     async def create_users(self, users: dict, existing_usernames: set) -> None:
         """Create new users based on input data."""
@@ -306,8 +497,13 @@ class Database:
                 except Exception as e:
                     self.logger.error(f"Error creating user {username}: {e}")
 
-    async def update_users(self, users_data: dict) -> None:
-        """Update users by deleting and creating as necessary."""
+    async def update_users(self, users_data: dict) -> dict[str, list[str]]:
+        """
+        Update users by deleting and creating as necessary.
+
+        Returns:
+            dict[str, list[str]]: The ids of the deleted documents of every deleted user.
+        """
         users = {
             key.split("_")[1]: {
                 "username": users_data.get(f"username_{key.split('_')[1]}"),
@@ -327,7 +523,7 @@ class Database:
 
             users_to_delete = db_user_ids - input_user_ids
 
-            await self.delete_users(users_to_delete)
+            deleted_documents = await self.delete_users(users_to_delete)
 
             await self.create_users(users, existing_usernames)
 
@@ -338,6 +534,8 @@ class Database:
                 self.logger.error(f"Error committing user updates: {e}")
                 raise
 
+        return deleted_documents
+
     async def is_application_configured(self, user_id: str) -> bool:
         from pathlib import Path
 
@@ -437,6 +635,16 @@ Only return JSON. Don't return any extra explanation text."""
                 text
             }
         }
+        field pooling_ratio type float {
+            indexing: summary | attribute
+        }
+        field patch_clusters type array<int> {
+            indexing: summary
+        }
+        field document_id type string {
+            indexing: summary | attribute
+            attribute: fast-search
+        }
         field embedding type tensor<int8>(patch{}, v[16]) {
             indexing: attribute | index
             attribute {
@@ -841,18 +1049,37 @@ Only return JSON. Don't return any extra explanation text."""
         summary questions {}
         from-disk
     }
+    document-summary results_sim {
+        summary id {}
+        summary patch_clusters {}
+        summary title {}
+        summary url {}
+        summary blur_image {}
+        summary page_number {}
+        summary text {
+            bolding: on
+        }
+        summary snippet {
+            source: text
+            dynamic
+        }
+        from-disk
+    }
 }"""
 
     async def store_image_query(self, query_id: str, embeddings: torch.Tensor, text: str, is_visual_only: bool) -> str:
         try:
-            # Convert embeddings tensor to numpy array and then to list
-            embeddings_list = embeddings.detach().cpu().numpy().tolist()
+            # Store the raw float16 bytes, a quarter of the size of the float list and close enough for ranking
+            embedding_array = np.ascontiguousarray(to_numpy(embeddings), dtype=np.float16)
 
             async with self.get_session() as session:
                 # Create new ImageQuery record
                 image_query = ImageQuery(
                     query_id=query_id,
-                    embeddings=embeddings_list,
+                    embeddings=embedding_array.tobytes(),
+                    embedding_rows=embedding_array.shape[0],
+                    embedding_dim=embedding_array.shape[1],
+                    embedding_dtype=embedding_array.dtype.name,
                     text=text,
                     is_visual_only=is_visual_only
                 )
@@ -866,8 +1093,17 @@ Only return JSON. Don't return any extra explanation text."""
             raise
 
     async def get_image_query(self, query_id: str) -> Optional[ImageQuery]:
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             result = await session.execute(
                 select(ImageQuery).where(ImageQuery.query_id == query_id)
             )
             return result.scalar_one_or_none()
+
+    async def purge_image_queries(self, ttl: timedelta) -> int:
+        """Delete the image queries older than `ttl`, returning how many were deleted"""
+        async with self.get_session() as session:
+            result = await session.execute(
+                delete(ImageQuery).where(ImageQuery.created_at < func.now() - ttl)
+            )
+            await session.commit()
+            return result.rowcount
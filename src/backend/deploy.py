@@ -1,4 +1,9 @@
+import asyncio
+import hashlib
+import json
 import os
+import httpx
+from pathlib import Path
 from dotenv import load_dotenv
 import logging
 
@@ -28,6 +33,7 @@ from vespa.configuration.services import (
 from vespa.configuration.vt import vt
 from vespa.package import ServicesConfiguration
 from backend.models import UserSettings
+from backend.schema_diff import NO_ACTION, classify_schema_change
 
 import pty
 import subprocess
@@ -39,6 +45,13 @@ from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("vespa_app")
 
+# Record of the last deployed application package, next to the vespa CLI's own files for the application
+DEPLOYED_PACKAGE_FILE = "deployed-package.json"
+# Files and directories of the application package that are hashed. Other files in the application directory,
+# such as the vespa_feed.json written by every upload, don't change the deployment.
+PACKAGE_FILES = ("services.xml", "deployment.xml", "hosts.xml", "validation-overrides.xml")
+PACKAGE_DIRS = ("schemas", "search", "security", "models", "constants", "components", "files")
+
 async def deploy_application_step_1(settings: UserSettings):
     logger.info("Validating settings")
     if not all([
@@ -69,7 +82,17 @@ async def deploy_application_step_1(settings: UserSettings):
         app_config = f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}"
         subprocess.run(["vespa", "config", "set", "application", app_config], check=True)
 
-        subprocess.run(["vespa", "auth", "cert", "-f", "-a", f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}"], check=True)
+        # A new certificate changes security/clients.pem, which forces a deploy, so keep an existing one
+        cert_dir = os.path.expanduser(f"~/.vespa/{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}")
+        cert_files = [
+            os.path.join(cert_dir, "data-plane-private-key.pem"),
+            os.path.join(cert_dir, "data-plane-public-cert.pem"),
+            os.path.join(app_dir, "security", "clients.pem"),
+        ]
+        if all(os.path.exists(path) for path in cert_files):
+            logger.info("Reusing the existing data plane certificate")
+        else:
+            subprocess.run(["vespa", "auth", "cert", "-f", "-a", f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}"], check=True)
 
         def run_auth_login():
             master, slave = pty.openpty()
@@ -132,7 +155,6 @@ async def deploy_application_step_1(settings: UserSettings):
         logger.info(f"Authentication URL found: {auth_url}")
 
         # Load certificate files
-        cert_dir = os.path.expanduser(f"~/.vespa/{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}")
         logger.debug(f"Looking for certificates in: {cert_dir}")
 
         private_key_path = os.path.join(cert_dir, "data-plane-private-key.pem")
@@ -170,8 +192,16 @@ async def deploy_application_step_1(settings: UserSettings):
     finally:
         os.chdir(current_dir)
 
-async def deploy_application_step_2(request, settings: UserSettings, user_id: str):
-    """Deploy the Vespa application"""
+async def deploy_application_step_2(
+    request, settings: UserSettings, user_id: str, force: bool = False, confirmed: bool = False
+):
+    """
+    Deploy the Vespa application.
+
+    The deploy is skipped when the same application package was deployed to the same target before and its
+    endpoint is still up, unless `force` is set. A schema change that needs a reindex or re-feed of the fed
+    pages is only deployed once `confirmed`; until then the classification is returned with status `confirm`.
+    """
     # Load environment variables
     load_dotenv()
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -247,76 +277,150 @@ async def deploy_application_step_2(request, settings: UserSettings, user_id: st
             ],
         )
 
-        servicesXml = vespa_application_package.services_to_text
-        services_xml_path = os.path.join(app_dir, "services.xml")
-        with open(services_xml_path, "w") as f:
-            f.write(servicesXml)
-
-        # Write the schema to its file
-        from pathlib import Path
-
-        schema_dir = Path(parent_dir) / "application/schemas"
-        schema_file = schema_dir / "pdf_page.sd"
-
-        logger.debug(f"Writing schema to {schema_file}")
-
-        schema_file.write_text(settings.schema)
-
-        import time
-        time.sleep(2)
-
-        import subprocess
-
-        # Store current directory
-        current_dir = os.getcwd()
-
-        try:
-            logger.debug("Running deploy commands")
-
-            # Change to application directory
-            os.chdir(app_dir)
-
-            process = subprocess.Popen(
-                ["vespa", "deploy", "--wait", "500", "-a", f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True
+        target = f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}"
+        write_if_changed(Path(app_dir) / "services.xml", vespa_application_package.services_to_text)
+        write_if_changed(Path(app_dir) / "schemas" / "pdf_page.sd", settings.schema)
+
+        files = package_files(app_dir)
+        package_hash = hash_package(files)
+        deployed = load_deployed_package(target)
+        schema_change = classify_schema_change(deployed.get("schema"), settings.schema)
+
+        if (
+            not force
+            and deployed.get("hash") == package_hash
+            and deployed.get("endpoint") == settings.vespa_cloud_endpoint
+        ):
+            # Dev deployments expire, and the record may be older than the deployment it describes
+            if await endpoint_is_up(deployed["endpoint"], target):
+                logger.info(f"Application package {package_hash[:12]} is already deployed to {target}, skipping deploy")
+                return {"status": "success", "skipped": True, "schema_change": schema_change.to_dict()}
+            logger.info(f"The last deployment to {target} is not reachable, deploying again")
+
+        changed = sorted(
+            path
+            for path in files.keys() | deployed.get("files", {}).keys()
+            if files.get(path) != deployed.get("files", {}).get(path)
+        )
+        logger.info(f"Deploying application package {package_hash[:12]}, changed files: {', '.join(changed)}")
+        if schema_change.action == NO_ACTION:
+            logger.info("Schema changes need no action for fed documents")
+        elif "schema" in deployed and not confirmed:
+            logger.info(f"Schema changes need a {schema_change.action}, waiting for confirmation")
+            return {"status": "confirm", "schema_change": schema_change.to_dict()}
+        else:
+            logger.warning(
+                f"Schema changes need a {schema_change.action} of fed documents: {'; '.join(schema_change.reasons)}"
             )
 
-            endpoint_url = ""
-            for line in iter(process.stdout.readline, ''):
-                logger.info(line.strip())
-                if "Found endpoints:" in line:
-                    # Read the next two lines to get to the URL line
-                    next(process.stdout)  # Skip "- dev.aws-us-east-*" line
-                    url_line = next(process.stdout)
-                    # Extract URL from line like " |-- https://d110fb1d.f78833a9.z.vespa-app.cloud/ (cluster '*_container')"
-                    match = re.search(r'https://[^\s]+', url_line)
-                    if match:
-                        endpoint_url = match.group(0)
-                        logger.info(f"Found endpoint URL: {endpoint_url}")
-
-            process.wait()
-            if process.returncode != 0:
-                raise subprocess.CalledProcessError(process.returncode, "vespa deploy")
-
-            if not endpoint_url:
-                raise Exception("Failed to find endpoint URL in deployment output")
+        endpoint_url = await asyncio.to_thread(run_vespa_deploy, app_dir, target)
 
-            # Save endpoint_url to the database
-            await request.app.db.update_settings(user_id, {"vespa_cloud_endpoint": endpoint_url})
-
-            logger.info(f"Deployment completed successfully! Endpoint URL: {endpoint_url}")
-        finally:
-            # Always restore the original working directory
-            os.chdir(current_dir)
+        # Save endpoint_url to the database
+        await request.app.db.update_settings(user_id, {"vespa_cloud_endpoint": endpoint_url})
+        save_deployed_package(
+            target, {"hash": package_hash, "files": files, "schema": settings.schema, "endpoint": endpoint_url}
+        )
 
-        return {"status": "success"}
+        logger.info(f"Deployment completed successfully! Endpoint URL: {endpoint_url}")
+        return {"status": "success", "skipped": False, "schema_change": schema_change.to_dict()}
 
     except Exception as e:
         logger.error(f"Deployment failed: {str(e)}")
         raise
 
+def write_if_changed(path: Path, text: str):
+    """Write a file of the application package, leaving it untouched if it already has this content"""
+    if path.exists() and path.read_text() == text:
+        return
+    logger.debug(f"Writing {path}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+def package_files(app_dir: str) -> dict:
+    """SHA-256 of every file of the application package (PACKAGE_FILES and PACKAGE_DIRS), by relative path"""
+    root = Path(app_dir)
+    paths = [root / name for name in PACKAGE_FILES]
+    for name in PACKAGE_DIRS:
+        paths.extend((root / name).rglob("*"))
+    return {
+        path.relative_to(root).as_posix(): hashlib.sha256(path.read_bytes()).hexdigest()
+        for path in sorted(paths)
+        if path.is_file()
+    }
+
+def hash_package(files: dict) -> str:
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+
+def deployed_package_path(target: str) -> Path:
+    return Path.home() / ".vespa" / target / DEPLOYED_PACKAGE_FILE
+
+def load_deployed_package(target: str) -> dict:
+    """The record of the package last deployed to `target`, or an empty dict if there is none"""
+    path = deployed_package_path(target)
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable deploy record {path}: {str(e)}")
+        return {}
+
+def save_deployed_package(target: str, record: dict):
+    path = deployed_package_path(target)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(record, indent=2))
+
+async def endpoint_is_up(endpoint: str, target: str) -> bool:
+    """Whether the container of a deployment answers its health check, using the data plane certificate"""
+    cert_dir = Path.home() / ".vespa" / target
+    cert = (str(cert_dir / "data-plane-public-cert.pem"), str(cert_dir / "data-plane-private-key.pem"))
+    if not all(Path(path).exists() for path in cert):
+        return False
+    try:
+        async with httpx.AsyncClient(cert=cert, timeout=10.0) as client:
+            response = await client.get(f"{endpoint.rstrip('/')}/state/v1/health")
+        return response.status_code == 200 and response.json().get("status", {}).get("code") == "up"
+    except (httpx.HTTPError, ValueError) as e:
+        logger.info(f"Health check of {endpoint} failed: {str(e)}")
+        return False
+
+def run_vespa_deploy(app_dir: str, target: str) -> str:
+    """
+    Deploy the application package with the vespa CLI and wait for it to converge. This is a blocking call.
+
+    Returns:
+        str: The endpoint URL of the deployed container cluster.
+    """
+    logger.debug("Running deploy commands")
+    process = subprocess.Popen(
+        ["vespa", "deploy", "--wait", "500", "-a", target],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        cwd=app_dir,
+    )
+
+    endpoint_url = ""
+    for line in iter(process.stdout.readline, ''):
+        logger.info(line.strip())
+        if "Found endpoints:" in line:
+            # Read the next two lines to get to the URL line
+            next(process.stdout)  # Skip "- dev.aws-us-east-*" line
+            url_line = next(process.stdout)
+            # Extract URL from line like " |-- https://d110fb1d.f78833a9.z.vespa-app.cloud/ (cluster '*_container')"
+            match = re.search(r'https://[^\s]+', url_line)
+            if match:
+                endpoint_url = match.group(0)
+                logger.info(f"Found endpoint URL: {endpoint_url}")
+
+    process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, "vespa deploy")
+
+    if not endpoint_url:
+        raise Exception("Failed to find endpoint URL in deployment output")
+    return endpoint_url
+
 def copy_api_key_file(parent_dir, tenant_name, user_id: str):
     from pathlib import Path
     import shutil
@@ -0,0 +1,180 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+class DiskCache:
+    """
+    Size-bounded cache of files in a single directory.
+
+    The directory is scanned once at startup and an in-memory index, ordered from least to most
+    recently used, is kept from then on, so lookups never touch the filesystem. Writes go to a
+    temporary file that is renamed into place, so readers never see partially written files. When the
+    total size exceeds `max_bytes`, the least recently used files are deleted. Files older than
+    `ttl_seconds` are treated as missing and removed by `sweep`.
+    """
+
+    TMP_PREFIX = ".tmp-"
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int,
+        logger: logging.Logger,
+        ttl_seconds: Optional[float] = None,
+    ):
+        """
+        Args:
+            directory (Path): Directory holding the cached files.
+            max_bytes (int): Byte budget for the directory.
+            logger (logging.Logger): Logger to use.
+            ttl_seconds (float, optional): Maximum age of a file. Defaults to no expiry.
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # name -> (size in bytes, write time)
+        self._total_bytes = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith(self.TMP_PREFIX):
+                # Left behind by an interrupted write
+                os.unlink(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self._index[name] = (size, mtime)
+            self._total_bytes += size
+        self.logger.info(
+            f"Indexed {len(self._index)} cached files ({self._total_bytes} bytes) in {self.directory}"
+        )
+        self.sweep()
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def contains(self, name: str) -> bool:
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None:
+                self._stats["misses"] += 1
+                return False
+            if self._is_expired(entry, time.time()):
+                self._remove_locked(name)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return False
+            self._index.move_to_end(name)
+            self._stats["hits"] += 1
+            return True
+
+    def get(self, name: str) -> Optional[Path]:
+        """Return the path of a cached file, or None if it is not cached."""
+        return self.path(name) if self.contains(name) else None
+
+    def write(self, name: str, data: bytes) -> Path:
+        """Atomically write a file into the cache, evicting old files if the budget is exceeded."""
+        fd, tmp_path = tempfile.mkstemp(prefix=self.TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(name))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            previous = self._index.pop(name, None)
+            if previous is not None:
+                self._total_bytes -= previous[0]
+            self._index[name] = (len(data), time.time())
+            self._total_bytes += len(data)
+            self._stats["writes"] += 1
+            self._evict_locked(keep=name)
+        return self.path(name)
+
+    def sweep(self) -> int:
+        """
+        Remove expired files and enforce the byte budget.
+
+        Returns:
+            int: The number of files removed.
+        """
+        removed = 0
+        now = time.time()
+        with self._lock:
+            if self.ttl_seconds:
+                expired = [
+                    name
+                    for name, entry in self._index.items()
+                    if self._is_expired(entry, now)
+                ]
+                for name in expired:
+                    self._remove_locked(name)
+                self._stats["expirations"] += len(expired)
+                removed += len(expired)
+            removed += self._evict_locked()
+        if removed:
+            self.logger.info(f"Removed {removed} files from {self.directory}")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "directory": str(self.directory),
+                "files": len(self._index),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                **self._stats,
+            }
+
+    def _is_expired(self, entry: tuple, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - entry[1] > self.ttl_seconds
+
+    def _remove_locked(self, name: str):
+        size, _ = self._index.pop(name)
+        self._total_bytes -= size
+        try:
+            os.unlink(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict_locked(self, keep: Optional[str] = None) -> int:
+        start = time.perf_counter()
+        evicted = 0
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            name = next(iter(self._index))
+            if name == keep:
+                self._index.move_to_end(name)
+                continue
+            self._remove_locked(name)
+            evicted += 1
+        self._stats["evictions"] += evicted
+        if evicted:
+            self.logger.debug(
+                f"Evicted {evicted} files from {self.directory} in {time.perf_counter() - start:.3f} s"
+            )
+        return evicted
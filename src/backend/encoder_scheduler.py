@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class EncoderScheduler:
+    """
+    Arbitrates the shared ColPali model between interactive query encoding and bulk page encoding.
+
+    Every forward pass runs inside a `slot` of one of two lanes. Up to `query_concurrency` query passes may run
+    at the same time, while a page pass needs the model to itself and is only started when no query is running
+    or waiting, so searches preempt feeding at batch granularity. Independently of that, at most
+    `max_page_jobs` bulk jobs (uploads) may be in progress; further ones wait in `page_job`.
+    """
+
+    QUERY = "query"
+    PAGE = "page"
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        query_concurrency: int = 1,
+        max_page_jobs: int = 1,
+    ):
+        """
+        Args:
+            logger (logging.Logger): Logger to use.
+            query_concurrency (int, optional): Maximum number of concurrent query forward passes. Defaults to 1.
+            max_page_jobs (int, optional): Maximum number of concurrent bulk page encoding jobs. Defaults to 1.
+        """
+        self.logger = logger
+        self.query_concurrency = query_concurrency
+        self.max_page_jobs = max_page_jobs
+        self._cond = threading.Condition()
+        self._active = {self.QUERY: 0, self.PAGE: 0}
+        self._waiting = {self.QUERY: 0, self.PAGE: 0}
+        self._page_jobs = threading.BoundedSemaphore(max_page_jobs)
+        self._metrics = {
+            lane: {"passes": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0, "total_run_seconds": 0.0}
+            for lane in (self.QUERY, self.PAGE)
+        }
+        self._metrics[self.PAGE]["preempted"] = 0
+
+    @contextmanager
+    def slot(self, lane: str):
+        """Hold the model for one forward pass in the given lane."""
+        start = time.perf_counter()
+        with self._cond:
+            self._waiting[lane] += 1
+            preempted = False
+            while not self._can_run_locked(lane):
+                preempted = preempted or (lane == self.PAGE and self._waiting[self.QUERY] > 0)
+                self._cond.wait()
+            self._waiting[lane] -= 1
+            self._active[lane] += 1
+            wait = time.perf_counter() - start
+            metrics = self._metrics[lane]
+            metrics["passes"] += 1
+            metrics["total_wait_seconds"] += wait
+            metrics["max_wait_seconds"] = max(metrics["max_wait_seconds"], wait)
+            if preempted:
+                metrics["preempted"] += 1
+
+        run_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active[lane] -= 1
+                self._metrics[lane]["total_run_seconds"] += time.perf_counter() - run_start
+                self._cond.notify_all()
+
+    @contextmanager
+    def page_job(self):
+        """Hold one of the `max_page_jobs` bulk job slots, e.g. for the duration of an upload."""
+        if not self._page_jobs.acquire(blocking=False):
+            self.logger.info("Waiting for another page encoding job to finish")
+            self._page_jobs.acquire()
+        try:
+            yield
+        finally:
+            self._page_jobs.release()
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                lane: {
+                    **metrics,
+                    "active": self._active[lane],
+                    "waiting": self._waiting[lane],
+                }
+                for lane, metrics in self._metrics.items()
+            }
+
+    def _can_run_locked(self, lane: str) -> bool:
+        if lane == self.QUERY:
+            return (
+                self._active[self.PAGE] == 0
+                and self._active[self.QUERY] < self.query_concurrency
+            )
+        return (
+            self._active[self.PAGE] == 0
+            and self._active[self.QUERY] == 0
+            and self._waiting[self.QUERY] == 0
+        )
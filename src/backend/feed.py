@@ -6,6 +6,11 @@ import logging
 import time
 import numpy as np
 from tqdm import tqdm
+from contextlib import nullcontext
+from backend.binarize import binary_cells
+from backend.encoder_scheduler import EncoderScheduler
+from backend.page_ids import page_id
+from backend.patch_pooling import hierarchical_pool
 from backend.models import UserSettings
 from pydantic import BaseModel
 import google.generativeai as genai
@@ -25,7 +30,7 @@ logger = logging.getLogger("vespa_app")
 
 
 
-def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali, processor: ColPaliProcessor, docNames: dict[str, str]):
+def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali, processor: ColPaliProcessor, docNames: dict[str, str], scheduler: EncoderScheduler = None, pool_factor: float = 1.0):
     try:
         base_dir = os.path.dirname(os.path.abspath(__file__))
         parent_dir = os.path.dirname(os.path.dirname(base_dir))
@@ -132,13 +137,21 @@ def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali
 
         try:
             images = [pdf["image"] for pdf in pdf_pages]
-            embeddings = generate_embeddings(images, model, processor)
+            embeddings = generate_embeddings(images, model, processor, scheduler=scheduler)
             logger.info(f"Generated {len(embeddings)} embeddings")
         except Exception as e:
             logger.error(f"Error generating embeddings: {str(e)}")
             return {"status": "error", "message": f"Error generating embeddings: {str(e)}"}
 
         vespa_feed = []
+        fed_questions = {}
+        num_patches = getattr(processor, "image_seq_length", 1024)
+        parent_field = "field document_id " in (settings.schema or "")
+        if pool_factor > 1 and "field patch_clusters " not in (settings.schema or ""):
+            return {
+                "status": "error",
+                "message": "FEED_PATCH_POOL_FACTOR needs the pooling_ratio and patch_clusters fields in the schema",
+            }
         try:
             for pdf, embedding in zip(pdf_pages, embeddings):
                 title = pdf["title"]
@@ -154,12 +167,21 @@ def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali
                     scale_image(image, 32), add_url_prefix=False
                 )
                 base_64_full_image = get_base64_image(image, add_url_prefix=False)
-                embedding_dict = {k: v for k, v in enumerate(embedding)}
-                binary_embedding = float_to_binary_embedding(embedding_dict)
+                pooling_fields = {}
+                if pool_factor > 1:
+                    # Merge redundant patches, the schema was checked for the pooling fields above
+                    embedding, clusters = hierarchical_pool(embedding, num_patches, pool_factor)
+                    pooling_fields = {
+                        "pooling_ratio": float(len(clusters) / (clusters.max() + 1)),
+                        "patch_clusters": clusters.tolist(),
+                    }
+                binary_embedding = binary_cells(embedding)
+                vespa_id = page_id(doc_id, page_no)
                 page = {
-                    "id": doc_id,
+                    "id": vespa_id,
                     "fields": {
-                        "id": doc_id,
+                        "id": vespa_id,
+                        **({"document_id": doc_id} if parent_field else {}),
                         "title": title,
                         "url": url,
                         "page_number": page_no,
@@ -169,9 +191,11 @@ def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali
                         "embedding": binary_embedding,
                         "queries": queries,
                         "questions": questions,
+                        **pooling_fields,
                     },
                 }
                 vespa_feed.append(page)
+                fed_questions.setdefault(doc_id, []).extend(questions)
         except Exception as e:
             logger.error(f"Error preparing Vespa feed: {str(e)}")
             return {"status": "error", "message": f"Error preparing Vespa feed: {str(e)}"}
@@ -190,16 +214,15 @@ def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali
             logger.error(f"Error saving Vespa feed file: {str(e)}")
             return {"status": "error", "message": f"Error saving Vespa feed file: {str(e)}"}
 
-        current_dir = os.getcwd()
-
         try:
             logger.debug("Feeding vespa application")
-            os.chdir(app_dir)
+            # Run in the application directory without chdir, since other threads rely on the working directory
             result = subprocess.run(
                 ["vespa", "feed", "vespa_feed.json", "-a", f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}"],
                 check=True,
                 capture_output=True,
-                text=True
+                text=True,
+                cwd=app_dir,
             )
 
             # Check for specific error messages in the output
@@ -211,7 +234,7 @@ def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali
                 }
 
             logger.info(f"Feeding completed successfully!")
-            return {"status": "success"}
+            return {"status": "success", "questions": fed_questions}
         except subprocess.CalledProcessError as e:
             error_output = e.stderr if e.stderr else e.stdout
             logger.error(f"Error feeding Vespa: {error_output}")
@@ -226,8 +249,6 @@ def feed_documents_to_vespa(settings: UserSettings, user_id: str, model: ColPali
                 "status": "error",
                 "message": f"Error feeding Vespa: {error_output}"
             }
-        finally:
-            os.chdir(current_dir)
 
     except Exception as e:
         logger.error(f"Unexpected error in feed_documents_to_vespa: {str(e)}")
@@ -245,16 +266,6 @@ def get_pdf_images(pdf_path):
     assert len(images) == len(page_texts)
     return images, page_texts
 
-def float_to_binary_embedding(float_query_embedding: dict) -> dict:
-    """Utility function to convert float query embeddings to binary query embeddings."""
-    binary_query_embeddings = {}
-    for k, v in float_query_embedding.items():
-        binary_vector = (
-            np.packbits(np.where(np.array(v) > 0, 1, 0)).astype(np.int8).tolist()
-        )
-        binary_query_embeddings[k] = binary_vector
-    return binary_query_embeddings
-
 def get_image_with_text(image_path):
     """Process a single image file and extract its text using OCR"""
     try:
@@ -301,16 +312,18 @@ def generate_queries(image, prompt_text, pydantic_model):
         }
     return queries
 
-def generate_embeddings(images, model, processor, batch_size=1) -> np.ndarray:
+def generate_embeddings(images, model, processor, batch_size=1, scheduler: EncoderScheduler = None) -> np.ndarray:
     """
     Generate embeddings for a list of images.
-    Move to CPU only once per batch.
+    Move to CPU only once per batch. Every batch runs in the page lane of the scheduler, so interactive
+    queries get the model in between batches.
 
     Args:
         images (List[PIL.Image]): List of PIL images.
         model (nn.Module): The model to generate embeddings.
         processor: The processor to preprocess images.
-        batch_size (int, optional): Batch size for processing. Defaults to 64.
+        batch_size (int, optional): Batch size for processing. Defaults to 1.
+        scheduler (EncoderScheduler, optional): Arbitrates the model with query encoding.
 
     Returns:
         np.ndarray: Embeddings for the images, shape
@@ -329,66 +342,14 @@ def generate_embeddings(images, model, processor, batch_size=1) -> np.ndarray:
 
     embeddings_list = []
     for batch in tqdm(dataloader):
-        with torch.no_grad():
+        with (scheduler.slot(EncoderScheduler.PAGE) if scheduler else nullcontext()), torch.no_grad():
             batch = {k: v.to(model.device) for k, v in batch.items()}
             embeddings_batch = model(**batch)
             # Convert tensor to numpy array and append to list
             embeddings_list.extend(
-                [t.cpu().numpy() for t in torch.unbind(embeddings_batch)]
+                [t.cpu().float().numpy() for t in torch.unbind(embeddings_batch)]
             )
 
     # Stack all embeddings into a single numpy array
     all_embeddings = np.stack(embeddings_list, axis=0)
     return all_embeddings
-
-def remove_document_from_vespa(settings: UserSettings, document_id: str):
-    logger = logging.getLogger("vespa_app")
-    logger.info(f"Removing document {document_id} from Vespa")
-
-    VESPA_TENANT_NAME = settings.tenant_name
-    VESPA_APPLICATION_NAME = settings.app_name
-    VESPA_INSTANCE_NAME = settings.instance_name
-    VESPA_SCHEMA_NAME = "pdf_page"
-
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    parent_dir = os.path.dirname(os.path.dirname(base_dir))
-    app_dir = os.path.join(parent_dir, "application")
-
-    current_dir = os.getcwd()
-
-    try:
-        logger.debug("Removing document from Vespa")
-        os.chdir(app_dir)
-
-        vespa_doc_id = f"id:{VESPA_APPLICATION_NAME}:{VESPA_SCHEMA_NAME}::{document_id}"
-
-        process = subprocess.Popen(
-            ["vespa", "document", "remove", vespa_doc_id, "-a", f"{VESPA_TENANT_NAME}.{VESPA_APPLICATION_NAME}.{VESPA_INSTANCE_NAME}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-
-        stdout, stderr = process.communicate()
-
-        if process.returncode != 0:
-            if "no endpoints found" in stderr.lower():
-                logger.error("No Vespa endpoints found")
-                return {"status": "error", "message": "No Vespa endpoints found. Please make sure the application is deployed and accessible."}
-            logger.error(f"Command failed with return code {process.returncode}: {stderr}")
-            return {"status": "error", "message": f"Command failed: {stderr}"}
-
-        success_message = f"Success: remove {vespa_doc_id}"
-        if success_message.lower() in stdout.lower():
-            logger.info(f"Successfully removed document {document_id} from Vespa")
-            return {"status": "success"}
-        else:
-            logger.error(f"Document removal may have failed. Output: {stdout}")
-            return {"status": "error", "message": "Document removal could not be confirmed"}
-
-    except Exception as e:
-        logger.error(f"Error removing document from Vespa: {str(e)}")
-        return {"status": "error", "message": f"Error removing document from Vespa: {str(e)}"}
-
-    finally:
-        os.chdir(current_dir)
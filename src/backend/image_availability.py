@@ -0,0 +1,64 @@
+import asyncio
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+class ImageAvailability:
+    """
+    Tracks page images that are being downloaded, so every image is downloaded once and anyone who needs it
+    is woken up as soon as it is on disk instead of polling for it.
+
+    Downloads run on the main event loop and on the event loops of the sim map workers, so waiters are
+    futures of their own loop, resolved thread-safely.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._waiters: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]] = {}
+
+    def claim(
+        self, keys: Iterable[str], is_ready: Callable[[str], bool]
+    ) -> Tuple[List[str], List[asyncio.Future]]:
+        """
+        Claim the images that are neither on disk nor being downloaded. Must be called from a running event loop.
+
+        Args:
+            keys (Iterable[str]): The images needed.
+            is_ready (Callable[[str], bool]): Whether an image is on disk.
+
+        Returns:
+            Tuple[List[str], List[asyncio.Future]]: The images the caller has to download and `release`, and
+                futures that resolve when the images claimed by someone else are released.
+        """
+        loop = asyncio.get_running_loop()
+        claimed, waiting = [], []
+        with self._lock:
+            for key in keys:
+                if is_ready(key):
+                    continue
+                if key in self._in_flight:
+                    future = loop.create_future()
+                    self._waiters.setdefault(key, []).append((loop, future))
+                    waiting.append(future)
+                else:
+                    self._in_flight.add(key)
+                    claimed.append(key)
+        return claimed, waiting
+
+    def release(self, key: str):
+        """Mark a claimed image as downloaded (or failed), waking up everyone waiting for it."""
+        with self._lock:
+            self._in_flight.discard(key)
+            waiters = self._waiters.pop(key, [])
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self._resolve, future)
+            except RuntimeError:
+                # The waiter's event loop is closed, nobody is waiting anymore
+                pass
+
+    @staticmethod
+    def _resolve(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
@@ -0,0 +1,75 @@
+from io import BytesIO
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from .disk_cache import DiskCache
+
+# Widths (in pixels) of the page image derivatives, smallest first
+DERIVATIVE_WIDTHS = (320, 640, 1024, 1600)
+
+# Format name in the URL -> (PIL format, media type, encoder options)
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+
+def derivative_name(doc_id: str, width: int, fmt: str) -> str:
+    return f"{doc_id}_{width}.{fmt}"
+
+
+def parse_derivative_filename(filename: str) -> Optional[Tuple[int, str]]:
+    """
+    Parse a derivative file name such as `640.webp` into its width and format.
+
+    Returns:
+        Optional[Tuple[int, str]]: The width and format, or None if it is not a supported derivative.
+    """
+    width, _, fmt = filename.partition(".")
+    if not width.isdigit() or int(width) not in DERIVATIVE_WIDTHS:
+        return None
+    if fmt not in DERIVATIVE_FORMATS:
+        return None
+    return int(width), fmt
+
+
+def render_derivative(source: Path, width: int, fmt: str) -> bytes:
+    """
+    Downscale a page image to the given width (never upscaling) and encode it.
+
+    Args:
+        source (Path): The full resolution page image.
+        width (int): The target width.
+        fmt (str): One of DERIVATIVE_FORMATS.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    pil_format, _, options = DERIVATIVE_FORMATS[fmt]
+    with Image.open(source) as img:
+        img = img.convert("RGB")
+        if img.width > width:
+            height = round(img.height * width / img.width)
+            img = img.resize((width, height), resample=Image.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+def get_or_create_derivative(
+    cache: DiskCache, source: Path, doc_id: str, width: int, fmt: str
+) -> Path:
+    """Return the cached derivative, rendering it from the full image on first access."""
+    name = derivative_name(doc_id, width, fmt)
+    path = cache.get(name)
+    if path is None:
+        path = cache.write(name, render_derivative(source, width, fmt))
+    return path
+
+
+def srcset(doc_id: str, fmt: str) -> str:
+    return ", ".join(
+        f"/page_image/{doc_id}/{width}.{fmt} {width}w" for width in DERIVATIVE_WIDTHS
+    )
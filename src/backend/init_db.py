@@ -6,19 +6,30 @@ from sqlalchemy.exc import SQLAlchemyError
 from asyncpg.exceptions import ConnectionDoesNotExistError, CannotConnectNowError, PostgresConnectionError
 import sys
 
-async def clear_image_queries(logger: logging.Logger):
+async def migrate_image_queries(logger: logging.Logger):
+    """
+    Drop the image_queries table if it still stores embeddings as a float array, so it is recreated with the
+    bytea layout by init_default_users. Image queries are short-lived, so nothing worth keeping is lost.
+    """
     try:
         async with async_session() as session:
             try:
-                # Use raw SQL for a simple truncate operation
-                await session.execute(text("TRUNCATE TABLE image_queries"))
-                await session.commit()
-                logger.info("Successfully cleared image_queries table")
+                result = await session.execute(
+                    text(
+                        "SELECT data_type FROM information_schema.columns "
+                        "WHERE table_name = 'image_queries' AND column_name = 'embeddings'"
+                    )
+                )
+                data_type = result.scalar_one_or_none()
+                if data_type == "ARRAY":
+                    await session.execute(text("DROP TABLE image_queries"))
+                    await session.commit()
+                    logger.info("Dropped legacy image_queries table")
             except Exception as e:
-                logger.error(f"Error clearing image_queries table: {e}")
+                logger.error(f"Error migrating image_queries table: {e}")
                 raise
     except Exception as e:
-        logger.error(f"Failed to clear image_queries table: {e}")
+        logger.error(f"Failed to migrate image_queries table: {e}")
         raise
 
 async def init_default_users(logger: logging.Logger, db: Database):
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+
+class ModelLoader:
+    """
+    Runs a slow loading function (the ColPali model, spaCy, ...) in a background thread, so the web
+    server can start serving login and static pages while the model is still loading.
+    """
+
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, logger: logging.Logger, load_fn: Callable[[], Any]):
+        """
+        Args:
+            logger (logging.Logger): Logger to use.
+            load_fn (Callable[[], Any]): Called once in the background thread, its return value is the loaded model.
+        """
+        self.logger = logger
+        self.load_fn = load_fn
+        self.state = self.LOADING
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self._value = None
+        self._done = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+        self._thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == self.READY
+
+    async def wait(self, timeout: float) -> Any:
+        """
+        Wait for the model to be loaded.
+
+        Raises:
+            TimeoutError: If the model is still loading after `timeout` seconds.
+            RuntimeError: If loading the model failed.
+        """
+        if not self._done.is_set():
+            await asyncio.to_thread(self._done.wait, timeout)
+        if self.state == self.LOADING:
+            raise TimeoutError("The model is still loading, please try again shortly")
+        if self.state == self.FAILED:
+            raise RuntimeError(f"The model failed to load: {self.error}")
+        return self._value
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "load_seconds": self.load_seconds,
+        }
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self._value = self.load_fn()
+            self.state = self.READY
+        except Exception as e:
+            self.logger.error(f"Error loading model: {str(e)}", exc_info=True)
+            self.error = str(e)
+            self.state = self.FAILED
+        finally:
+            self.load_seconds = time.perf_counter() - start
+            self._done.set()
+        if self.state == self.READY:
+            self.logger.info(f"Model loaded in {self.load_seconds:.1f} s")
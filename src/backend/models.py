@@ -1,10 +1,11 @@
-from sqlalchemy import String, DateTime, ARRAY, Enum, UUID, Column, ForeignKey, Text, Float, Boolean
+from sqlalchemy import String, DateTime, ARRAY, Enum, UUID, Column, ForeignKey, Text, Boolean, Integer, LargeBinary
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 from .base import Base
 import uuid
 from datetime import datetime
 import enum
+import numpy as np
 
 class RankerType(enum.Enum):
     colpali = "colpali"
@@ -52,7 +53,17 @@ class ImageQuery(Base):
     __tablename__ = "image_queries"
 
     query_id = Column(String, primary_key=True)
-    embeddings = Column(ARRAY(Float))
+    # Raw embedding bytes, see `embedding_array`
+    embeddings = Column(LargeBinary, nullable=False)
+    embedding_rows = Column(Integer, nullable=False)
+    embedding_dim = Column(Integer, nullable=False)
+    embedding_dtype = Column(String, nullable=False, default="float16")
     text = Column(Text)
     is_visual_only = Column(Boolean, default=False)
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+    def embedding_array(self) -> np.ndarray:
+        """The stored embeddings as a read-only [rows, dim] array, without copying the bytes"""
+        return np.frombuffer(self.embeddings, dtype=self.embedding_dtype).reshape(
+            self.embedding_rows, self.embedding_dim
+        )
@@ -0,0 +1,16 @@
+"""
+Every page is its own Vespa document, with the id `{document_id}_{page_number}`. The document_id is the id of
+the UserDocument (an uploaded PDF or image) the page belongs to.
+"""
+
+
+def page_id(document_id: str, page_number: int) -> str:
+    return f"{document_id}_{page_number}"
+
+
+def parent_document_id(page_id: str) -> str:
+    """The UserDocument id of a page id. Pages fed before page ids existed used the document id itself."""
+    document_id, _, page_number = page_id.rpartition("_")
+    if document_id and page_number.isdigit():
+        return document_id
+    return page_id
@@ -0,0 +1,168 @@
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .binarize import ArrayLike, to_numpy
+
+# ColPali resizes pages to 448x448 and splits them into a 32x32 grid of patches
+DEFAULT_GRID = 32
+IMAGE_QUERY_POOLING_METHODS = ("kmeans", "none")
+
+
+def content_mask(image: Image.Image, grid: int = DEFAULT_GRID, min_std: float = 4.0) -> np.ndarray:
+    """
+    Find the patches that show something, as opposed to blank background or padding.
+
+    Args:
+        image (Image.Image): The image the patches were computed from.
+        grid (int, optional): Number of patches per side. Defaults to 32.
+        min_std (float, optional): Minimum standard deviation of the grayscale pixels (0-255) in a patch.
+
+    Returns:
+        np.ndarray: Boolean mask of shape [grid * grid], in the row-major order of the patch embeddings.
+    """
+    cell = 8
+    pixels = np.asarray(
+        image.convert("L").resize((grid * cell, grid * cell), Image.BILINEAR), dtype=np.float32
+    )
+    blocks = pixels.reshape(grid, cell, grid, cell)
+    return (blocks.std(axis=(1, 3)) >= min_std).reshape(-1)
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def kmeans_pool(
+    embeddings: ArrayLike, k: int, iterations: int = 10, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pool embeddings into `k` vectors with spherical k-means (cosine similarity, k-means++ initialization).
+
+    Every pooled vector is the normalized mean of its cluster, so it stays on the same scale as the inputs.
+
+    Args:
+        embeddings (ArrayLike): Embeddings of shape [N, D].
+        k (int): Number of pooled vectors. If N <= k the normalized inputs are returned as they are.
+        iterations (int, optional): Number of assignment/update rounds. Defaults to 10.
+        seed (int, optional): Seed of the initialization, so the same image always pools the same way.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Pooled embeddings of shape [min(N, k), D] and the cluster of every input.
+    """
+    vectors = normalize(to_numpy(embeddings))
+    n = len(vectors)
+    if n <= k:
+        return vectors, np.arange(n)
+
+    rng = np.random.default_rng(seed)
+    centroids = np.empty((k, vectors.shape[1]), dtype=np.float32)
+    centroids[0] = vectors[rng.integers(n)]
+    distances = 1.0 - vectors @ centroids[0]
+    for i in range(1, k):
+        weights = np.maximum(distances, 0.0)
+        total = weights.sum()
+        index = rng.choice(n, p=weights / total) if total > 0 else rng.integers(n)
+        centroids[i] = vectors[index]
+        distances = np.minimum(distances, 1.0 - vectors @ centroids[i])
+
+    labels = np.zeros(n, dtype=np.int64)
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        # Clusters that lost all their members keep their centroid
+        filled = np.bincount(labels, minlength=k) > 0
+        centroids[filled] = normalize(sums[filled])
+
+    used, labels = np.unique(labels, return_inverse=True)
+    return centroids[used], labels
+
+
+def hierarchical_pool(
+    embeddings: ArrayLike, num_patches: int, pool_factor: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge similar image patches of a page with Ward hierarchical clustering, to roughly
+    `num_patches / pool_factor` vectors. Patches of blank margins are near identical and are merged first.
+
+    Only the image patches are pooled; the tokens after them are appended unchanged.
+
+    Args:
+        embeddings (ArrayLike): Page embeddings of shape [num_tokens, 128], image patches first.
+        num_patches (int): Number of image patch tokens at the start of the embeddings.
+        pool_factor (float): Target ratio of image patches to pooled vectors. 1 disables pooling.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The pooled embeddings, and for every image patch the index of the pooled
+            vector it was merged into.
+    """
+    embeddings = to_numpy(embeddings)
+    patches, rest = embeddings[:num_patches], embeddings[num_patches:]
+    if pool_factor <= 1:
+        return embeddings, np.arange(len(patches))
+    num_clusters = int(np.ceil(len(patches) / pool_factor))
+    if num_clusters >= len(patches):
+        return embeddings, np.arange(len(patches))
+
+    from scipy.cluster.hierarchy import fcluster, linkage
+
+    tree = linkage(patches, method="ward")
+    # fcluster labels start at 1
+    labels = fcluster(tree, t=num_clusters, criterion="maxclust") - 1
+    count = labels.max() + 1
+    sums = np.zeros((count, patches.shape[1]), dtype=np.float32)
+    np.add.at(sums, labels, patches)
+    pooled = sums / np.bincount(labels, minlength=count)[:, None]
+    return np.concatenate([pooled, rest]), labels
+
+
+def reduce_image_query(
+    embeddings: ArrayLike,
+    image: Optional[Image.Image],
+    num_patches: int,
+    budget: int,
+    method: str = "kmeans",
+    min_std: float = 4.0,
+) -> Tuple[np.ndarray, dict]:
+    """
+    Reduce the embeddings of an image used as a query to at most `budget` vectors.
+
+    The text prompt tokens that follow the image patches are the same for every image, and patches of blank
+    background match any page, so both are dropped before the remaining patches are pooled with k-means.
+    With method "none" the embeddings are returned unchanged, and the query is truncated later as before.
+
+    Args:
+        embeddings (ArrayLike): Image query embeddings of shape [num_tokens, 128], image patches first.
+        image (Image.Image, optional): The query image, used to detect background patches.
+        num_patches (int): Number of image patch tokens at the start of the embeddings.
+        budget (int): Maximum number of vectors to return.
+        method (str, optional): One of IMAGE_QUERY_POOLING_METHODS. Defaults to "kmeans".
+        min_std (float, optional): See `content_mask`.
+
+    Returns:
+        Tuple[np.ndarray, dict]: The reduced embeddings, and how many tokens were kept at each stage.
+    """
+    if method not in IMAGE_QUERY_POOLING_METHODS:
+        raise ValueError(f"Unknown pooling method: {method}, expected one of {IMAGE_QUERY_POOLING_METHODS}")
+    embeddings = to_numpy(embeddings)
+    stats = {"method": method, "tokens": len(embeddings)}
+    if method == "none":
+        stats["pooled"] = len(embeddings)
+        return embeddings, stats
+
+    patches = embeddings[:num_patches]
+    stats["patches"] = len(patches)
+    grid = int(round(np.sqrt(len(patches))))
+    if image is not None and grid * grid == len(patches):
+        mask = content_mask(image, grid=grid, min_std=min_std)
+        # A blank image has no content patches, keep everything rather than nothing
+        if mask.any():
+            patches = patches[mask]
+    stats["content_patches"] = len(patches)
+
+    pooled, _ = kmeans_pool(patches, budget)
+    stats["pooled"] = len(pooled)
+    return pooled, stats
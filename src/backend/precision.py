@@ -0,0 +1,99 @@
+import logging
+from typing import List
+
+import numpy as np
+import torch
+
+from .binarize import binarize
+
+# fp32: the reference, float32 weights and activations
+# bf16: bfloat16 weights and activations, half the memory
+# int8: dynamic int8 quantization of the linear layers (CPU only), float32 everywhere else
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# Minimum agreement with fp32 for a precision to be considered safe, see `compare_to_reference`
+MIN_BIT_AGREEMENT = 0.97
+MIN_TOP1_AGREEMENT = 0.9
+
+
+def load_colpali(model_name: str, device: str, precision: str, logger: logging.Logger):
+    """
+    Load the ColPali model and processor in the given precision.
+
+    int8 dynamic quantization only runs on the CPU, on other devices it falls back to fp32.
+    """
+    from colpali_engine.models import ColPali, ColPaliProcessor
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}, expected one of {PRECISIONS}")
+    if precision == "int8" and str(device) != "cpu":
+        logger.warning(f"int8 quantization is only supported on the CPU, using fp32 on {device}")
+        precision = "fp32"
+
+    model = ColPali.from_pretrained(
+        model_name,
+        # fp32 is the default, since it seems to produce the most similar results to the fed (float32 ->
+        # binarized) embeddings both locally (mps) and HF (Cuda)
+        torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32,
+        device_map=device,
+    ).eval()
+    if precision == "int8":
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    processor = ColPaliProcessor.from_pretrained(model_name)
+    logger.info(f"Loaded {model_name} in {precision} on {device}")
+    return model, processor, precision
+
+
+def bit_agreement(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Fraction of equal bits after binarization, over embeddings of the same shape."""
+    xor = np.bitwise_xor(binarize(reference).view(np.uint8), binarize(candidate).view(np.uint8))
+    return 1.0 - np.unpackbits(xor).mean()
+
+
+def maxsim_scores(q_embs: np.ndarray, pages: List[np.ndarray]) -> np.ndarray:
+    """MaxSim (late interaction) score of one query against each page."""
+    return np.array([(q_embs @ page.T).max(axis=1).sum() for page in pages])
+
+
+def compare_to_reference(
+    reference_queries: List[np.ndarray],
+    reference_pages: List[np.ndarray],
+    candidate_queries: List[np.ndarray],
+    candidate_pages: List[np.ndarray],
+    k: int = 3,
+) -> dict:
+    """
+    Compare embeddings produced in another precision against the fp32 reference, on the same queries and pages.
+
+    Returns:
+        dict: Bit agreement of the binarized query and page embeddings, how often the MaxSim top-1 page is the
+            same, the mean overlap of the top-k pages, and whether the agreement is within the thresholds.
+    """
+    page_bits = np.mean(
+        [bit_agreement(ref, cand) for ref, cand in zip(reference_pages, candidate_pages)]
+    )
+    query_bits = np.mean(
+        [bit_agreement(ref, cand) for ref, cand in zip(reference_queries, candidate_queries)]
+    )
+
+    top1, overlap = [], []
+    for ref_q, cand_q in zip(reference_queries, candidate_queries):
+        ref_order = np.argsort(-maxsim_scores(ref_q, reference_pages))
+        cand_order = np.argsort(-maxsim_scores(cand_q, candidate_pages))
+        top1.append(ref_order[0] == cand_order[0])
+        overlap.append(len(set(ref_order[:k]) & set(cand_order[:k])) / min(k, len(ref_order)))
+
+    report = {
+        "page_bit_agreement": float(page_bits),
+        "query_bit_agreement": float(query_bits),
+        "top1_agreement": float(np.mean(top1)),
+        f"top{k}_overlap": float(np.mean(overlap)),
+    }
+    report["passed"] = (
+        min(page_bits, query_bits) >= MIN_BIT_AGREEMENT
+        and report["top1_agreement"] >= MIN_TOP1_AGREEMENT
+    )
+    return report
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+# Ranking parameter tiers, from most to least expensive. "full" matches the parameters text queries used
+# before budgets existed, "fast" the ones used for visual-only (image) queries.
+DEFAULT_TIERS = [
+    {
+        "name": "full",
+        "target_hits": 100,
+        "explore_additional_hits": 300,
+        "rerank_count": 100,
+        "match_phase_max_hits": 100,
+    },
+    {
+        "name": "balanced",
+        "target_hits": 50,
+        "explore_additional_hits": 150,
+        "rerank_count": 50,
+        "match_phase_max_hits": 100,
+    },
+    {
+        "name": "fast",
+        "target_hits": 20,
+        "explore_additional_hits": 100,
+        "rerank_count": 25,
+        "match_phase_max_hits": 100,
+    },
+    {
+        "name": "minimal",
+        "target_hits": 10,
+        "explore_additional_hits": 30,
+        "rerank_count": 10,
+        "match_phase_max_hits": 50,
+    },
+]
+VISUAL_ONLY_TIER = "fast"
+DEFAULT_TIMEOUT_MS = 10_000
+MIN_TIMEOUT_MS = 500
+
+
+@dataclass
+class QueryParams:
+    """The ranking parameters chosen for one query, and why."""
+
+    tier: str
+    target_hits: int
+    explore_additional_hits: int
+    rerank_count: int
+    match_phase_max_hits: int
+    timeout_ms: int
+    budget_ms: Optional[float] = None
+    reasons: List[str] = field(default_factory=list)
+    elapsed_ms: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class QueryBudget:
+    """
+    Picks the ranking parameters for each ColPali query from a table of tiers.
+
+    Without a latency budget the most expensive tier is always used. With a budget, the most expensive tier
+    whose calibrated p95 latency fits the budget is used (see benchmarks/calibrate_query_budget.py), and it is
+    downgraded one tier further for every `load_threshold` concurrent queries and when the observed p95 of
+    that tier over the last `window_seconds` exceeds the budget. Once the slow samples age out, the more
+    expensive tier is tried again.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        budget_ms: Optional[float] = None,
+        tiers: Optional[List[dict]] = None,
+        load_threshold: int = 4,
+        window: int = 100,
+        window_seconds: float = 60.0,
+    ):
+        """
+        Args:
+            logger (logging.Logger): Logger to use.
+            budget_ms (float, optional): Target p95 query latency in milliseconds. Defaults to no budget.
+            tiers (List[dict], optional): Parameter tiers, most expensive first. Defaults to DEFAULT_TIERS.
+            load_threshold (int, optional): Concurrent queries per additional downgrade. Defaults to 4.
+            window (int, optional): Maximum number of recent latencies per tier to compute the observed p95 from.
+            window_seconds (float, optional): Maximum age of those latencies. Defaults to 60 seconds.
+        """
+        self.logger = logger
+        self.budget_ms = budget_ms
+        self.tiers = tiers or DEFAULT_TIERS
+        self.load_threshold = load_threshold
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._latencies = {tier["name"]: deque(maxlen=window) for tier in self.tiers}
+        self._recent = deque(maxlen=window)
+        self._counts = {tier["name"]: 0 for tier in self.tiers}
+
+    @classmethod
+    def from_env(cls, logger: logging.Logger) -> "QueryBudget":
+        budget_ms = float(os.getenv("QUERY_LATENCY_BUDGET_MS", "0")) or None
+        calibration_path = os.getenv(
+            "QUERY_BUDGET_CALIBRATION", "storage/query_budget.json"
+        )
+        tiers = None
+        if os.path.exists(calibration_path):
+            with open(calibration_path) as f:
+                tiers = json.load(f)["tiers"]
+            logger.info(f"Loaded {len(tiers)} calibrated query tiers from {calibration_path}")
+        return cls(
+            logger,
+            budget_ms=budget_ms,
+            tiers=tiers,
+            load_threshold=int(os.getenv("QUERY_BUDGET_LOAD_THRESHOLD", "4")),
+        )
+
+    def tier_index(self, name: str) -> int:
+        for i, tier in enumerate(self.tiers):
+            if tier["name"] == name:
+                return i
+        raise ValueError(f"Unknown query tier: {name}")
+
+    def acquire(self, visual_only: bool = False, tier: Optional[str] = None) -> QueryParams:
+        """
+        Choose the parameters for a query about to be sent. Must be followed by `release`.
+
+        Args:
+            visual_only (bool, optional): Visual-only queries never use a tier more expensive than VISUAL_ONLY_TIER.
+            tier (str, optional): Force a tier, e.g. for calibration.
+        """
+        with self._lock:
+            self._in_flight += 1
+            reasons = []
+            if tier is not None:
+                index = self.tier_index(tier)
+                reasons.append("forced")
+            else:
+                index = self._budget_index_locked(reasons)
+                visual_index = min(
+                    (i for i, t in enumerate(self.tiers) if t["name"] == VISUAL_ONLY_TIER),
+                    default=0,
+                )
+                if visual_only and index < visual_index:
+                    index = visual_index
+                    reasons.append("visual_only")
+                if self.budget_ms:
+                    index = self._downgrade_locked(index, reasons)
+            chosen = self.tiers[index]
+            self._counts[chosen["name"]] += 1
+
+        return QueryParams(
+            tier=chosen["name"],
+            target_hits=chosen["target_hits"],
+            explore_additional_hits=chosen["explore_additional_hits"],
+            rerank_count=chosen["rerank_count"],
+            match_phase_max_hits=chosen["match_phase_max_hits"],
+            timeout_ms=self._timeout_ms(),
+            budget_ms=self.budget_ms,
+            reasons=reasons,
+        )
+
+    def release(self, params: QueryParams, elapsed_ms: Optional[float]):
+        """Record the latency of a finished query, or None if it failed."""
+        with self._lock:
+            self._in_flight -= 1
+            params.elapsed_ms = elapsed_ms
+            if elapsed_ms is not None:
+                self._latencies[params.tier].append((time.monotonic(), elapsed_ms))
+            self._recent.append(params.to_dict())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_ms": self.budget_ms,
+                "in_flight": self._in_flight,
+                "tiers": [
+                    {
+                        **tier,
+                        "queries": self._counts[tier["name"]],
+                        "observed_p95_ms": self._p95(self._latencies[tier["name"]]),
+                    }
+                    for tier in self.tiers
+                ],
+                "recent": list(self._recent)[-20:],
+            }
+
+    def _budget_index_locked(self, reasons: list) -> int:
+        if not self.budget_ms:
+            return 0
+        for i, tier in enumerate(self.tiers):
+            p95 = tier.get("p95_ms")
+            if p95 is None or p95 <= self.budget_ms:
+                return i
+        reasons.append("no_tier_fits_budget")
+        return len(self.tiers) - 1
+
+    def _downgrade_locked(self, index: int, reasons: list) -> int:
+        load_steps = (self._in_flight - 1) // self.load_threshold
+        if load_steps > 0:
+            index += load_steps
+            reasons.append(f"load:{self._in_flight}")
+        index = min(index, len(self.tiers) - 1)
+        observed = self._p95(self._latencies[self.tiers[index]["name"]])
+        if observed is not None and observed > self.budget_ms and index < len(self.tiers) - 1:
+            index += 1
+            reasons.append(f"observed_p95:{observed:.0f}ms")
+        return index
+
+    def _timeout_ms(self) -> int:
+        if not self.budget_ms:
+            return DEFAULT_TIMEOUT_MS
+        return int(min(max(2 * self.budget_ms, MIN_TIMEOUT_MS), DEFAULT_TIMEOUT_MS))
+
+    def _p95(self, latencies) -> Optional[float]:
+        oldest = time.monotonic() - self.window_seconds
+        recent = [elapsed_ms for timestamp, elapsed_ms in latencies if timestamp >= oldest]
+        # Require a handful of samples before reacting
+        if len(recent) < 10:
+            return None
+        ordered = sorted(recent)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
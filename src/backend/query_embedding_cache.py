@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .cache import LRUCache
+
+
+class QueryEmbeddingCache:
+    """
+    Persistent cache of query embeddings and token maps, keyed by model, precision and normalized query.
+
+    Entries live in a local SQLite database (WAL mode), so every worker process on the host shares them and
+    they survive restarts, with a small in-process LRU in front. Embeddings are stored as raw float16 bytes
+    plus their shape, token maps as a JSON list. The least recently used entries are pruned once the
+    database holds more than `max_entries`.
+    """
+
+    PRUNE_EVERY = 100
+
+    def __init__(
+        self,
+        path: Path,
+        logger: logging.Logger,
+        max_entries: int = 10_000,
+        memory_size: int = 256,
+    ):
+        """
+        Args:
+            path (Path): The SQLite database file.
+            logger (logging.Logger): Logger to use.
+            max_entries (int, optional): Maximum number of entries in the database. Defaults to 10 000.
+            memory_size (int, optional): Size of the in-process LRU cache. Defaults to 256.
+        """
+        self.path = Path(path)
+        self.logger = logger
+        self.max_entries = max_entries
+        self._memory = LRUCache(max_size=memory_size)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=5.0
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS query_embeddings (
+                key TEXT PRIMARY KEY,
+                rows INTEGER NOT NULL,
+                dim INTEGER NOT NULL,
+                embedding BLOB NOT NULL,
+                tokens TEXT NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS query_embeddings_accessed_at ON query_embeddings (accessed_at)"
+        )
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        # Only whitespace is normalized, since casing and punctuation change the embedding
+        return " ".join(query.split())
+
+    @classmethod
+    def make_key(cls, model_name: str, precision: str, query: str) -> str:
+        raw = f"{model_name}\x00{precision}\x00{cls.normalize(query)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, dict]]:
+        """
+        Returns:
+            Optional[Tuple[np.ndarray, dict]]: The float16 embeddings and the index to token map, or None.
+        """
+        cached = self._memory.get(key)
+        if cached is not None:
+            # Lookups run in worker threads, so the counters are only updated under the lock
+            with self._lock:
+                self._stats["memory_hits"] += 1
+            return cached
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rows, dim, embedding, tokens FROM query_embeddings WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._conn.execute(
+                "UPDATE query_embeddings SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._stats["disk_hits"] += 1
+
+        rows, dim, blob, tokens = row
+        embedding = np.frombuffer(blob, dtype=np.float16).reshape(rows, dim)
+        entry = (embedding, dict(enumerate(json.loads(tokens))))
+        self._memory.set(key, entry)
+        return entry
+
+    def set(self, key: str, embedding: np.ndarray, idx_to_token: dict):
+        embedding = np.ascontiguousarray(embedding, dtype=np.float16)
+        tokens = [idx_to_token[idx] for idx in range(len(idx_to_token))]
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    embedding.shape[0],
+                    embedding.shape[1],
+                    embedding.tobytes(),
+                    json.dumps(tokens),
+                    time.time(),
+                ),
+            )
+            self._stats["writes"] += 1
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune_locked()
+        self._memory.set(key, (embedding, dict(idx_to_token)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            return {"path": str(self.path), "entries": entries, **self._stats}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _prune_locked(self):
+        deleted = self._conn.execute(
+            """
+            DELETE FROM query_embeddings WHERE key IN (
+                SELECT key FROM query_embeddings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        ).rowcount
+        if deleted:
+            self.logger.debug(f"Pruned {deleted} query embeddings from {self.path}")
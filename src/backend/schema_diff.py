@@ -0,0 +1,131 @@
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+# What existing documents need after a schema change, from least to most expensive
+NO_ACTION = "none"
+REINDEX = "reindex"
+REFEED = "refeed"
+ACTIONS = (NO_ACTION, REINDEX, REFEED)
+
+# Tensor types contain empty braces for mapped dimensions, e.g. tensor<int8>(patch{}, v[16])
+FIELD_PATTERN = re.compile(r"\bfield\s+(\w+)\s+type\s+((?:\{\}|[^{])+?)\s*\{(?!\})")
+INDEXING_PATTERN = re.compile(r"indexing\s*:\s*([^\n]+)")
+
+
+@dataclass
+class SchemaField:
+    name: str
+    type: str
+    in_document: bool
+    indexing: frozenset
+    settings: str
+
+
+@dataclass
+class SchemaChange:
+    """What a new schema requires of the documents fed with the deployed one, and why."""
+
+    action: str = NO_ACTION
+    reasons: List[str] = field(default_factory=list)
+
+    def require(self, action: str, reason: str):
+        self.reasons.append(f"{action}: {reason}")
+        if ACTIONS.index(action) > ACTIONS.index(self.action):
+            self.action = action
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _block_end(text: str, start: int) -> int:
+    """Index just past the brace that closes the block opened at `start`"""
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(text)
+
+
+def parse_fields(schema: str) -> Dict[str, SchemaField]:
+    """
+    Extract the fields of a schema, with what determines how they are stored.
+
+    Args:
+        schema (str): Schema definition, as in a .sd file.
+
+    Returns:
+        Dict[str, SchemaField]: Fields by name. `in_document` is False for synthetic fields declared outside the
+            document block, which are computed from other fields when indexing.
+    """
+    schema = re.sub(r"#[^\n]*", "", schema)
+    document = re.search(r"\bdocument\s+\w+\s*\{", schema)
+    document_span = (document.start(), _block_end(schema, document.end() - 1)) if document else (0, 0)
+
+    fields = {}
+    for match in FIELD_PATTERN.finditer(schema):
+        body = schema[match.end() : _block_end(schema, match.end() - 1) - 1]
+        indexing = INDEXING_PATTERN.search(body)
+        statements = indexing.group(1) if indexing else ""
+        settings = INDEXING_PATTERN.sub("", body)
+        # Summary settings only affect what is returned, not how documents are stored
+        settings = re.sub(r"summary\s*:[^\n]*", "", settings)
+        fields[match.group(1)] = SchemaField(
+            name=match.group(1),
+            type=" ".join(match.group(2).split()),
+            in_document=document_span[0] <= match.start() < document_span[1],
+            indexing=frozenset(re.findall(r"[\w-]+", statements)),
+            settings=" ".join(settings.split()),
+        )
+    return fields
+
+
+def classify_schema_change(deployed: Optional[str], new: str) -> SchemaChange:
+    """
+    Classify what deploying `new` over `deployed` requires of the documents that are already fed.
+
+    - Rank profiles, fieldsets, summaries, new document fields and removed synthetic fields need no action,
+      documents fed before simply have no value for a new field until they are fed again.
+    - New fields derived from existing fields (an indexing expression with `input`), new indexing targets and
+      changed match, attribute and index settings of existing fields make Vespa reindex the documents it
+      stores, which it does on its own after the deploy.
+    - Changed field types and removed or changed document fields need the pages to be fed again, as stored
+      documents have no (valid) value for them.
+
+    Args:
+        deployed (str, optional): The deployed schema, or None if unknown.
+        new (str): The schema to deploy.
+
+    Returns:
+        SchemaChange: The most expensive action needed, and the reason for every required action.
+    """
+    change = SchemaChange()
+    if deployed is None:
+        change.require(REFEED, "no record of the deployed schema")
+        return change
+
+    old_fields, new_fields = parse_fields(deployed), parse_fields(new)
+    for name, new_field in new_fields.items():
+        old_field = old_fields.get(name)
+        if old_field is None:
+            if "input" in new_field.indexing:
+                change.require(REINDEX, f"new field '{name}' derived from existing fields")
+            else:
+                change.require(NO_ACTION, f"new field '{name}'")
+        elif old_field.in_document != new_field.in_document:
+            where = "into" if new_field.in_document else "out of"
+            change.require(REFEED, f"field '{name}' moved {where} the document")
+        elif old_field.type != new_field.type:
+            change.require(REFEED, f"field '{name}' changed type from {old_field.type} to {new_field.type}")
+        elif old_field.indexing - {"summary"} != new_field.indexing - {"summary"}:
+            change.require(REINDEX, f"field '{name}' changed indexing")
+        elif old_field.settings != new_field.settings:
+            change.require(REINDEX, f"field '{name}' changed match, attribute or index settings")
+    for name, old_field in old_fields.items():
+        if name not in new_fields and old_field.in_document:
+            change.require(REFEED, f"document field '{name}' removed")
+    return change
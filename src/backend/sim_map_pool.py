@@ -0,0 +1,303 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+
+class SimMapJob:
+    """
+    A single sim map generation request, identified by its query_id.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    DROPPED = "dropped"
+
+    def __init__(
+        self,
+        query_id: str,
+        job_fn: Callable[..., Coroutine[Any, Any, bool]],
+        owner: Optional[str] = None,
+    ):
+        self.query_id = query_id
+        self.job_fn = job_fn
+        self.owner = owner
+        self.state = self.QUEUED
+        self.priority = SimMapWorkerPool.PRIORITY_NORMAL
+        self.submitted_at = time.perf_counter()
+        self.cancel_event = threading.Event()
+        # Incremented every time the job is (re-)pushed to the heap, so stale heap entries can be skipped
+        self.version = 0
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED, self.DROPPED)
+
+
+class SimMapWorkerPool:
+    """
+    Fixed-size pool of worker threads generating similarity maps.
+
+    Each worker owns a long-lived asyncio event loop, so jobs can await the Vespa client without
+    creating a new thread and event loop per search. Pending jobs are kept in a priority queue where
+    visible queries (promoted by the polling sim map buttons) come first and, within the same priority,
+    the newest query wins. A query_id is only ever queued or running once.
+    """
+
+    PRIORITY_VISIBLE = 0
+    PRIORITY_NORMAL = 1
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        num_workers: int = 2,
+        max_queue_size: int = 32,
+        max_finished_jobs: int = 256,
+    ):
+        """
+        Args:
+            logger (logging.Logger): Logger to use.
+            num_workers (int): Number of worker threads.
+            max_queue_size (int): Maximum number of pending jobs. When full, the oldest, least urgent job is dropped.
+            max_finished_jobs (int): Number of finished jobs to remember for status lookups.
+        """
+        self.logger = logger
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.max_finished_jobs = max_finished_jobs
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._heap = []
+        self._seq = itertools.count()
+        self._jobs: Dict[str, SimMapJob] = {}
+        self._finished_order = []
+        self._owner_jobs: Dict[str, str] = {}
+        self._threads = []
+        self._running = False
+
+        self._metrics = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "started": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "dropped": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "total_run_seconds": 0.0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.num_workers):
+            thread = threading.Thread(
+                target=self._worker, name=f"sim-map-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        self.logger.info(f"Started sim map worker pool with {self.num_workers} workers")
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            self._running = False
+            for job in self._jobs.values():
+                if not job.finished:
+                    job.cancel_event.set()
+            self._not_empty.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def submit(
+        self,
+        query_id: str,
+        job_fn: Callable[..., Coroutine[Any, Any, bool]],
+        owner: Optional[str] = None,
+    ) -> bool:
+        """
+        Queue a sim map job. `job_fn` is called as `job_fn(is_cancelled)` and must return a coroutine.
+
+        If the same owner (typically the user id) has another job pending or running, that job is
+        cancelled, since the user has navigated to a new search.
+
+        Returns:
+            bool: True if the job was queued, False if an identical job is already queued or running.
+        """
+        with self._lock:
+            existing = self._jobs.get(query_id)
+            if existing is not None and existing.state in (SimMapJob.QUEUED, SimMapJob.RUNNING):
+                self._metrics["deduplicated"] += 1
+                return False
+
+            if owner is not None:
+                previous_query_id = self._owner_jobs.get(owner)
+                if previous_query_id and previous_query_id != query_id:
+                    self._cancel_locked(previous_query_id)
+                self._owner_jobs[owner] = query_id
+
+            job = SimMapJob(query_id, job_fn, owner)
+            self._jobs[query_id] = job
+            self._push_locked(job)
+            self._metrics["submitted"] += 1
+
+            while self._pending_count_locked() > self.max_queue_size:
+                self._drop_one_locked()
+
+            self._not_empty.notify()
+        return True
+
+    def promote(self, query_id: str):
+        """Move a pending job to the front of the queue, e.g. because its results are being viewed."""
+        with self._lock:
+            job = self._jobs.get(query_id)
+            if job is None or job.state != SimMapJob.QUEUED:
+                return
+            if job.priority == self.PRIORITY_VISIBLE:
+                return
+            job.priority = self.PRIORITY_VISIBLE
+            self._push_locked(job)
+
+    def cancel(self, query_id: str) -> bool:
+        with self._lock:
+            return self._cancel_locked(query_id)
+
+    def status(self, query_id: str) -> Optional[str]:
+        with self._lock:
+            job = self._jobs.get(query_id)
+            return job.state if job else None
+
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        with self._lock:
+            return self._pending_count_locked()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            running = self._running_count_locked()
+            finished_runs = metrics["started"] - running
+            metrics["queue_depth"] = self._pending_count_locked()
+            metrics["in_flight"] = running
+            metrics["num_workers"] = self.num_workers
+            metrics["max_queue_size"] = self.max_queue_size
+            metrics["avg_wait_seconds"] = (
+                metrics["total_wait_seconds"] / metrics["started"]
+                if metrics["started"]
+                else 0.0
+            )
+            metrics["avg_run_seconds"] = (
+                metrics["total_run_seconds"] / finished_runs if finished_runs else 0.0
+            )
+        return metrics
+
+    def _push_locked(self, job: SimMapJob):
+        job.version += 1
+        # Newest first within the same priority
+        heapq.heappush(
+            self._heap, (job.priority, -next(self._seq), job.version, job.query_id)
+        )
+
+    def _pending_count_locked(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.state == SimMapJob.QUEUED)
+
+    def _running_count_locked(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.state == SimMapJob.RUNNING)
+
+    def _cancel_locked(self, query_id: str) -> bool:
+        job = self._jobs.get(query_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_event.set()
+        if job.state == SimMapJob.QUEUED:
+            self._finish_locked(job, SimMapJob.CANCELLED)
+        self.logger.debug(f"Cancelled sim map job for query_id: {query_id}")
+        return True
+
+    def _drop_one_locked(self):
+        pending = [job for job in self._jobs.values() if job.state == SimMapJob.QUEUED]
+        if not pending:
+            return
+        victim = max(pending, key=lambda job: (job.priority, -job.submitted_at))
+        victim.cancel_event.set()
+        self._finish_locked(victim, SimMapJob.DROPPED)
+        self.logger.warning(
+            f"Sim map queue full, dropped job for query_id: {victim.query_id}"
+        )
+
+    def _finish_locked(self, job: SimMapJob, state: str):
+        job.state = state
+        metric = {
+            SimMapJob.DONE: "completed",
+            SimMapJob.FAILED: "failed",
+            SimMapJob.CANCELLED: "cancelled",
+            SimMapJob.DROPPED: "dropped",
+        }[state]
+        self._metrics[metric] += 1
+        if job.owner is not None and self._owner_jobs.get(job.owner) == job.query_id:
+            del self._owner_jobs[job.owner]
+        self._finished_order.append(job.query_id)
+        while len(self._finished_order) > self.max_finished_jobs:
+            old_query_id = self._finished_order.pop(0)
+            old_job = self._jobs.get(old_query_id)
+            if old_job is not None and old_job.finished:
+                del self._jobs[old_query_id]
+
+    def _next_job(self) -> Optional[SimMapJob]:
+        with self._lock:
+            while True:
+                while self._heap:
+                    _, _, version, query_id = heapq.heappop(self._heap)
+                    job = self._jobs.get(query_id)
+                    if job is None or job.state != SimMapJob.QUEUED or job.version != version:
+                        continue  # Stale entry
+                    job.state = SimMapJob.RUNNING
+                    self._metrics["started"] += 1
+                    wait = time.perf_counter() - job.submitted_at
+                    self._metrics["total_wait_seconds"] += wait
+                    self._metrics["max_wait_seconds"] = max(
+                        self._metrics["max_wait_seconds"], wait
+                    )
+                    return job
+                if not self._running:
+                    return None
+                self._not_empty.wait()
+
+    def _worker(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    success = loop.run_until_complete(job.job_fn(job.is_cancelled))
+                    state = SimMapJob.DONE if success else SimMapJob.FAILED
+                except Exception as e:
+                    self.logger.error(
+                        f"Sim map job failed for query_id: {job.query_id}: {str(e)}",
+                        exc_info=True,
+                    )
+                    state = SimMapJob.FAILED
+                if job.is_cancelled():
+                    state = SimMapJob.CANCELLED
+                with self._lock:
+                    self._metrics["total_run_seconds"] += time.perf_counter() - start
+                    self._finish_locked(job, state)
+        finally:
+            loop.close()
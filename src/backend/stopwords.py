@@ -1,18 +1,155 @@
-import spacy
 import os
+import re
+import threading
+from functools import lru_cache
+from typing import List
 
-# Download the model if it is not already present
-if not spacy.util.is_package("en_core_web_sm"):
-    spacy.cli.download("en_core_web_sm")
-nlp = spacy.load("en_core_web_sm")
+# "fast" uses the precomputed stop word list and tokenizer below, "spacy" runs the full en_core_web_sm pipeline
+STOPWORDS_BACKEND = os.getenv("STOPWORDS_BACKEND", "fast").lower()
 
+# spaCy's English stop word list (spacy/lang/en/stop_words.py), so both backends agree on what a stop word is
+_STOP_WORDS = """
+a about above across after afterwards again against all almost alone along
+already also although always am among amongst amount an and another any anyhow
+anyone anything anyway anywhere are around as at
+back be became because become becomes becoming been before beforehand behind
+being below beside besides between beyond both bottom but by
+call can cannot ca could
+did do does doing done down due during
+each eight either eleven else elsewhere empty enough even ever every
+everyone everything everywhere except
+few fifteen fifty first five for former formerly forty four from front full
+further
+get give go
+had has have he hence her here hereafter hereby herein hereupon hers herself
+him himself his how however hundred
+i if in indeed into is it its itself
+keep
+last latter latterly least less
+just
+made make many may me meanwhile might mine more moreover most mostly move much
+must my myself
+name namely neither never nevertheless next nine no nobody none noone nor not
+nothing now nowhere
+of off often on once one only onto or other others otherwise our ours ourselves
+out over own
+part per perhaps please put
+quite
+rather re really regarding
+same say see seem seemed seeming seems serious several she should show side
+since six sixty so some somehow someone something sometime sometimes somewhere
+still such
+take ten than that the their them themselves then thence there thereafter
+thereby therefore therein thereupon these they third this those though three
+through throughout thru thus to together too top toward towards twelve twenty
+two
+under until up unless upon us used using
+various very via was we well were what whatever when whence whenever where
+whereafter whereas whereby wherein whereupon wherever whether which while
+whither who whoever whole whom whose why will with within without would
+yet you your yours yourself yourselves
+""".split()
+_CONTRACTIONS = ["n't", "'d", "'ll", "'m", "'re", "'s", "'ve"]
 
-# It would be possible to remove bolding for stopwords without removing them from the query,
-# but that would require a java plugin which we didn't want to complicate this sample app with.
-def filter(text):
-    doc = nlp(text)
-    tokens = [token.text for token in doc if not token.is_stop]
+STOP_WORDS = frozenset(
+    _STOP_WORDS
+    + _CONTRACTIONS
+    + [c.replace("'", apostrophe) for c in _CONTRACTIONS for apostrophe in "‘’"]
+)
+
+# Tokenizer rules approximating spaCy's English tokenizer for the kind of text typed into a search box:
+# split on whitespace, then peel off leading/trailing punctuation and contractions, then split hyphenated words.
+_PREFIX_CHARS = frozenset("\"'“”‘’`([{<*#$£€¥§&~")
+_SUFFIX_CHARS = frozenset("\"'“”‘’`)]}>.,;:!?%*…")
+_CONTRACTION = re.compile(r"^(.+?)(n['’]t|['’](?:s|d|ll|m|re|ve))$", re.IGNORECASE)
+_ABBREVIATION = re.compile(r"^(?:[A-Za-z]\.)+$")
+_INFIX = re.compile(r"(?<=[A-Za-z])(-)(?=[A-Za-z])|(?<=[A-Za-z0-9])([:<>=/])(?=[A-Za-z])")
+
+
+def is_stop(token: str) -> bool:
+    return token.lower() in STOP_WORDS
+
+
+def _split_chunk(chunk: str) -> List[str]:
+    prefixes, suffixes = [], []
+    while len(chunk) > 1:
+        if chunk[0] in _PREFIX_CHARS:
+            prefixes.append(chunk[0])
+            chunk = chunk[1:]
+            continue
+        match = _CONTRACTION.match(chunk)
+        # spaCy always splits off 's and n't, the other contractions only after pronouns and auxiliaries
+        if match and (
+            match.group(2).lower()[-2:] in ("'s", "’s", "'t", "’t")
+            or is_stop(match.group(1))
+        ):
+            suffixes.insert(0, match.group(2))
+            chunk = match.group(1)
+            continue
+        if chunk[-1] in _SUFFIX_CHARS and not _ABBREVIATION.match(chunk):
+            suffixes.insert(0, chunk[-1])
+            chunk = chunk[:-1]
+            continue
+        break
+    infixes = [part for part in _INFIX.split(chunk) if part]
+    return prefixes + infixes + suffixes
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for chunk in text.split():
+        tokens.extend(_split_chunk(chunk))
+    return tokens
+
+
+def _filter_fast(text: str) -> str:
+    tokens = [token for token in tokenize(text) if not is_stop(token)]
     if len(tokens) == 0:
         # if we remove all the words we don't have a query at all, so use the original
         return text
     return " ".join(tokens)
+
+
+# spaCy and its English pipeline take seconds to load, so they are only loaded when the spaCy backend is
+# used, on first use (or explicitly via `load()` from the background startup task).
+_nlp = None
+_lock = threading.Lock()
+
+
+def load_spacy():
+    """Load the spaCy pipeline, downloading it if it is not already present"""
+    global _nlp
+    if _nlp is not None:
+        return _nlp
+    with _lock:
+        if _nlp is None:
+            import spacy
+
+            # Download the model if it is not already present
+            if not spacy.util.is_package("en_core_web_sm"):
+                spacy.cli.download("en_core_web_sm")
+            _nlp = spacy.load("en_core_web_sm")
+    return _nlp
+
+
+def load():
+    """Prepare the configured backend"""
+    if STOPWORDS_BACKEND == "spacy":
+        load_spacy()
+
+
+def _filter_spacy(text: str) -> str:
+    doc = load_spacy()(text)
+    tokens = [token.text for token in doc if not token.is_stop]
+    if len(tokens) == 0:
+        return text
+    return " ".join(tokens)
+
+
+# It would be possible to remove bolding for stopwords without removing them from the query,
+# but that would require a java plugin which we didn't want to complicate this sample app with.
+@lru_cache(maxsize=4096)
+def filter(text):
+    if STOPWORDS_BACKEND == "spacy":
+        return _filter_spacy(text)
+    return _filter_fast(text)
@@ -0,0 +1,175 @@
+import bisect
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+from .cache import LRUCache
+
+# Artifact from our data generation
+IGNORED_QUESTIONS = {"string"}
+
+
+class SuggestionIndex:
+    """
+    In-process prefix index over the generated questions of all fed pages, used for autocomplete.
+
+    Every question is stored in a sorted array, and every word-start suffix of it in a second sorted
+    array, so both prefix and infix lookups are a binary search followed by a short scan. Questions are
+    reference counted per document and owner, so feeding and deleting documents updates the index
+    incrementally, and lookups can be scoped to the documents of one user. Questions of documents
+    without a known owner are visible to everyone.
+    """
+
+    def __init__(self, logger: logging.Logger, cache_size: int = 512):
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._documents: Dict[str, tuple] = {}  # doc_id -> (owner, questions)
+        self._owners: Dict[str, Counter] = {}  # normalized question -> owner counts
+        self._display: Dict[str, str] = {}  # normalized question -> question as fed
+        self._prefix_keys: List[str] = []
+        self._suffix_keys: List[tuple] = []  # (suffix, normalized question)
+        self._version = 0
+        self._cache = LRUCache(max_size=cache_size)
+        self.ready = False
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.lower().split())
+
+    def __len__(self) -> int:
+        return len(self._prefix_keys)
+
+    def build(self, documents: Iterable[tuple]):
+        """
+        Replace the index contents. This is a blocking call.
+
+        The new index is built aside and sorted once, then swapped in, so lookups are not held up by a rebuild.
+
+        Args:
+            documents (Iterable[tuple]): (doc_id, questions, owner) tuples.
+        """
+        index = SuggestionIndex(self.logger)
+        for doc_id, questions, owner in documents:
+            index._add_locked(doc_id, questions, owner, keep_sorted=False)
+        index._prefix_keys.sort()
+        index._suffix_keys.sort()
+        with self._lock:
+            self._documents = index._documents
+            self._owners = index._owners
+            self._display = index._display
+            self._prefix_keys = index._prefix_keys
+            self._suffix_keys = index._suffix_keys
+            self._version += 1
+            self.ready = True
+        self.logger.info(
+            f"Built suggestion index with {len(self._prefix_keys)} questions from {len(self._documents)} documents"
+        )
+
+    def add_document(self, doc_id: str, questions: Iterable[str], owner: Optional[str] = None):
+        with self._lock:
+            self._remove_locked(doc_id)
+            self._add_locked(doc_id, questions, owner)
+            self._version += 1
+
+    def remove_document(self, doc_id: str):
+        with self._lock:
+            if self._remove_locked(doc_id):
+                self._version += 1
+
+    def lookup(self, query: str, owner: Optional[str] = None, limit: int = 20) -> List[str]:
+        """
+        Find questions starting with the query, followed by questions containing it at a word boundary.
+
+        Args:
+            query (str): The text typed so far.
+            owner (str, optional): Only return questions from documents of this user, or without an owner.
+            limit (int, optional): Maximum number of suggestions. Defaults to 20.
+
+        Returns:
+            List[str]: The matching questions.
+        """
+        normalized = self.normalize(query)
+        if not normalized:
+            return []
+        cache_key = (self._version, owner, normalized, limit)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            matches = []
+            seen = set()
+            start = bisect.bisect_left(self._prefix_keys, normalized)
+            for question in self._prefix_keys[start:]:
+                if len(matches) >= limit or not question.startswith(normalized):
+                    break
+                if self._visible_locked(question, owner):
+                    seen.add(question)
+                    matches.append(self._display[question])
+
+            start = bisect.bisect_left(self._suffix_keys, (normalized,))
+            for suffix, question in self._suffix_keys[start:]:
+                if len(matches) >= limit or not suffix.startswith(normalized):
+                    break
+                if question not in seen and self._visible_locked(question, owner):
+                    seen.add(question)
+                    matches.append(self._display[question])
+
+        self._cache.set(cache_key, matches)
+        return matches
+
+    def _visible_locked(self, question: str, owner: Optional[str]) -> bool:
+        owners = self._owners[question]
+        return owner is None or owners[owner] > 0 or owners[None] > 0
+
+    def _add_locked(
+        self, doc_id: str, questions: Iterable[str], owner: Optional[str], keep_sorted: bool = True
+    ):
+        unique_questions = {
+            self.normalize(question): question.strip()
+            for question in questions
+            if question and question.strip() and question not in IGNORED_QUESTIONS
+        }
+        for question, display in unique_questions.items():
+            owners = self._owners.get(question)
+            if owners is None:
+                owners = self._owners[question] = Counter()
+                self._display[question] = display
+                if keep_sorted:
+                    bisect.insort(self._prefix_keys, question)
+                    for suffix in self._word_suffixes(question):
+                        bisect.insort(self._suffix_keys, (suffix, question))
+                else:
+                    # The caller sorts the keys once all documents are added
+                    self._prefix_keys.append(question)
+                    self._suffix_keys.extend((suffix, question) for suffix in self._word_suffixes(question))
+            owners[owner] += 1
+        self._documents[doc_id] = (owner, tuple(unique_questions))
+
+    def _remove_locked(self, doc_id: str) -> bool:
+        entry = self._documents.pop(doc_id, None)
+        if entry is None:
+            return False
+        owner, questions = entry
+        for question in questions:
+            owners = self._owners[question]
+            owners[owner] -= 1
+            if owners[owner] <= 0:
+                del owners[owner]
+            if owners:
+                continue
+            del self._owners[question]
+            del self._display[question]
+            self._prefix_keys.pop(bisect.bisect_left(self._prefix_keys, question))
+            for suffix in self._word_suffixes(question):
+                self._suffix_keys.pop(bisect.bisect_left(self._suffix_keys, (suffix, question)))
+        return True
+
+    @staticmethod
+    def _word_suffixes(question: str) -> List[str]:
+        suffixes = []
+        for i in range(1, len(question)):
+            if question[i - 1] == " ":
+                suffixes.append(question[i:])
+        return suffixes
@@ -0,0 +1,89 @@
+from typing import Callable, List, Optional
+
+import numpy as np
+
+# How to rank query tokens when choosing which ones get a nearestNeighbor operator:
+#   magnitude: sum of the absolute packed int8 values (the original heuristic)
+#   norm:      L2 norm of the float embedding
+#   distinct:  IDF-like, tokens that are dissimilar to the rest of the query rank first, so near-duplicates
+#              such as the query augmentation tokens don't use up the budget
+NN_TOKEN_STRATEGIES = ("magnitude", "norm", "distinct")
+
+
+def hamming_distances(binary_q_embs: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    """Hamming distance in bits between every row of `binary_q_embs` and `vector` (both packed int8)."""
+    xor = np.bitwise_xor(binary_q_embs.view(np.uint8), vector.view(np.uint8))
+    return np.unpackbits(xor, axis=-1).sum(axis=-1)
+
+
+def score_tokens(
+    float_q_embs: np.ndarray, binary_q_embs: np.ndarray, strategy: str
+) -> np.ndarray:
+    if strategy == "magnitude":
+        return np.abs(binary_q_embs.astype(np.int32)).sum(axis=1).astype(np.float32)
+    if strategy == "norm":
+        return np.linalg.norm(float_q_embs, axis=1)
+    if strategy == "distinct":
+        norms = np.linalg.norm(float_q_embs, axis=1, keepdims=True)
+        unit = float_q_embs / np.maximum(norms, 1e-12)
+        similarity = unit @ unit.T
+        np.fill_diagonal(similarity, 0.0)
+        return 1.0 - similarity.sum(axis=1) / max(len(unit) - 1, 1)
+    raise ValueError(
+        f"Unknown token selection strategy: {strategy}, expected one of {NN_TOKEN_STRATEGIES}"
+    )
+
+
+def select_nn_tokens(
+    float_q_embs: np.ndarray,
+    binary_q_embs: np.ndarray,
+    max_tokens: int,
+    strategy: str = "magnitude",
+    idx_to_token: Optional[dict] = None,
+    should_filter_token: Optional[Callable[[str], bool]] = None,
+    dedup_hamming: int = 0,
+) -> List[int]:
+    """
+    Choose which query tokens get a nearestNeighbor operator.
+
+    Tokens rejected by `should_filter_token` are skipped (unless that would leave none), the rest are ranked
+    by `strategy`, and a token is skipped when its binary vector is within `dedup_hamming` bits of an already
+    selected one, since it would retrieve the same neighbors.
+
+    Args:
+        float_q_embs (np.ndarray): Float query embeddings of shape [num_tokens, 128].
+        binary_q_embs (np.ndarray): Packed binary query embeddings of shape [num_tokens, 16].
+        max_tokens (int): Maximum number of tokens to select.
+        strategy (str, optional): One of NN_TOKEN_STRATEGIES. Defaults to "magnitude".
+        idx_to_token (dict, optional): Index to token mapping, not available for image queries.
+        should_filter_token (Callable[[str], bool], optional): Returns True for tokens to skip.
+        dedup_hamming (int, optional): Maximum Hamming distance of near-duplicates. Defaults to 0 (exact
+            duplicates only), a negative value disables deduplication.
+
+    Returns:
+        List[int]: Row indices of the selected tokens, best first.
+    """
+    num_tokens = len(binary_q_embs)
+    candidates = np.arange(num_tokens)
+    if idx_to_token and should_filter_token:
+        keep = [
+            idx
+            for idx in range(num_tokens)
+            if not should_filter_token(idx_to_token.get(idx, ""))
+        ]
+        if keep:
+            candidates = np.array(keep)
+
+    scores = score_tokens(float_q_embs[candidates], binary_q_embs[candidates], strategy)
+    ordered = candidates[np.argsort(-scores, kind="stable")]
+
+    selected = []
+    for idx in ordered:
+        if len(selected) >= max_tokens:
+            break
+        if selected:
+            distances = hamming_distances(binary_q_embs[selected], binary_q_embs[idx])
+            if distances.min() <= dedup_hamming:
+                continue
+        selected.append(int(idx))
+    return selected
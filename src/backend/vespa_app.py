@@ -1,13 +1,17 @@
 import os
+import re
 import time
-from typing import Any, Dict, Tuple
-import asyncio
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 import torch
 from dotenv import load_dotenv
 from vespa.application import Vespa
 from vespa.io import VespaQueryResponse
+from .binarize import binarize, float_cells, tensor_cells, to_numpy
 from .colpali import SimMapGenerator
+from .page_ids import parent_document_id
+from .query_budget import QueryBudget
+from .token_selection import NN_TOKEN_STRATEGIES, select_nn_tokens
 import backend.stopwords
 import logging
 from backend.models import UserSettings
@@ -17,7 +21,10 @@ import httpx
 class VespaQueryClient:
     MAX_QUERY_TERMS = 64
     VESPA_SCHEMA_NAME = "pdf_page"
+    # Documents per selection-based delete, which keeps the selection expression small
+    REMOVE_BATCH_SIZE = 100
     SELECT_FIELDS = "id,title,url,blur_image,page_number,snippet,text"
+    SIM_MAP_SUMMARY = "results_sim"
 
     def __init__(self, logger: logging.Logger, settings: UserSettings):
         """
@@ -26,6 +33,33 @@ class VespaQueryClient:
         load_dotenv()
         self.logger = logger
 
+        # Query token pruning for the nearestNeighbor operators, see backend/token_selection.py. The defaults
+        # keep the original selection (top MAX_QUERY_TERMS by magnitude), pruning is opt-in until evaluated
+        # with benchmarks/nn_token_selection.py
+        self.nn_token_strategy = os.getenv("NN_TOKEN_STRATEGY", "magnitude")
+        if self.nn_token_strategy not in NN_TOKEN_STRATEGIES:
+            raise ValueError(
+                f"NN_TOKEN_STRATEGY must be one of {NN_TOKEN_STRATEGIES}, got {self.nn_token_strategy}"
+            )
+        self.nn_max_tokens = int(os.getenv("NN_MAX_TOKENS", str(self.MAX_QUERY_TERMS)))
+        self.nn_dedup_hamming = int(os.getenv("NN_DEDUP_HAMMING", "-1"))
+        self.nn_filter_tokens = os.getenv("NN_FILTER_TOKENS", "false").lower() == "true"
+        self.query_budget = QueryBudget.from_env(logger)
+        # Only the best page of every document is shown, picked from COLLAPSE_FETCH_FACTOR times more hits
+        self.collapse_pages = os.getenv("COLLAPSE_PAGES", "true").lower() == "true"
+        self.collapse_fetch_factor = int(os.getenv("COLLAPSE_FETCH_FACTOR", "3"))
+        # Only schemas with patch pooling have the field, selecting a missing field fails the query
+        schema = settings.schema or ""
+        self.sim_map_fields = (
+            "patch_clusters,summaryfeatures"
+            if "field patch_clusters " in schema
+            else "summaryfeatures"
+        )
+        # Schemas deployed before sim maps were fetched with the results may lack the summary and the
+        # `*_sim` rank profiles, asking for a missing one fails the query
+        self.sim_map_summary = f"document-summary {self.SIM_MAP_SUMMARY} " in schema
+        self.sim_rank_profiles = set(re.findall(r"\brank-profile\s+(\w+_sim)\b", schema))
+
         if os.environ.get("USE_MTLS") == "true":
             self.logger.info("Connected using mTLS")
             mtls_key = os.environ.get("VESPA_CLOUD_MTLS_KEY")
@@ -77,6 +111,7 @@ class VespaQueryClient:
                 vespa_cloud_secret_token=self.vespa_cloud_secret_token,
             )
 
+        self.app_name = settings.app_name
         self.app.wait_for_application_up()
         self.logger.info(f"Connected to Vespa at {self.vespa_app_url}")
 
@@ -84,7 +119,13 @@ class VespaQueryClient:
         if not sim_map:
             return self.SELECT_FIELDS
         else:
-            return "summaryfeatures"
+            # Hit fields and sim map summary features are fetched in the same request
+            return f"{self.SELECT_FIELDS},{self.sim_map_fields}"
+
+    def get_summary_params(self, sim_map: bool = False) -> dict:
+        if not sim_map or not self.sim_map_summary:
+            return {}
+        return {"presentation.summary": self.SIM_MAP_SUMMARY}
 
     def format_query_results(
         self, query: str, response: VespaQueryResponse, hits: int = 5
@@ -105,8 +146,35 @@ class VespaQueryClient:
         count = response.json.get("root", {}).get("fields", {}).get("totalCount", 0)
         result_text = f"Query text: '{query}', query time {query_time}s, count={count}, top results:\n"
         self.logger.debug(result_text)
+        if self.collapse_pages:
+            self.collapse_to_best_page(response.json, hits)
         return response.json
 
+    def fetch_hits(self, hits: int) -> int:
+        """Number of hits to request, so `hits` remain after collapsing pages of the same document"""
+        return hits * self.collapse_fetch_factor if self.collapse_pages else hits
+
+    @staticmethod
+    def collapse_to_best_page(result: dict, hits: int) -> None:
+        """
+        Keep only the best page of every document in a result, and at most `hits` hits. Hits arrive ordered by
+        relevance, so the first page seen of a document is its best one.
+        """
+        root = result.get("root", {})
+        seen, kept = set(), []
+        for hit in root.get("children", []):
+            page = hit.get("fields", {}).get("id")
+            if page is not None:
+                document_id = parent_document_id(page)
+                if document_id in seen:
+                    continue
+                seen.add(document_id)
+            kept.append(hit)
+            if len(kept) >= hits:
+                break
+        if "children" in root:
+            root["children"] = kept
+
     async def query_vespa_bm25(
         self,
         query: str,
@@ -141,9 +209,10 @@ class VespaQueryClient:
                     "ranking": self.get_rank_profile("bm25", sim_map),
                     "query": query,
                     "timeout": timeout,
-                    "hits": hits,
+                    "hits": self.fetch_hits(hits),
                     "input.query(qt)": query_embedding,
                     "presentation.timing": True,
+                    **self.get_summary_params(sim_map),
                     **kwargs,
                 },
             )
@@ -153,62 +222,64 @@ class VespaQueryClient:
                 f"Query time + data transfer took: {stop - start} s, Vespa reported searchtime was "
                 f"{response.json.get('timing', {}).get('searchtime', -1)} s"
             )
-        return self.format_query_results(query, response)
+        return self.format_query_results(query, response, hits)
 
-    def float_to_binary_embedding(self, float_query_embedding: dict) -> dict:
+    def binarize_q_embs(self, q_embs: torch.Tensor) -> np.ndarray:
         """
-        Convert float query embeddings to binary embeddings.
+        Convert float query embeddings to packed binary embeddings, truncated to MAX_QUERY_TERMS.
 
         Args:
-            float_query_embedding (dict): Dictionary of float embeddings.
+            q_embs (torch.Tensor): Query embeddings tensor of shape [num_tokens, 128].
 
         Returns:
-            dict: Dictionary of binary embeddings.
-        """
-        binary_query_embeddings = {}
-        for key, vector in float_query_embedding.items():
-            binary_vector = (
-                np.packbits(np.where(np.array(vector) > 0, 1, 0))
-                .astype(np.int8)
-                .tolist()
+            np.ndarray: Binary embeddings of shape [num_tokens, 16] and dtype int8.
+        """
+        binary_q_embs = binarize(q_embs)
+        if len(binary_q_embs) > self.MAX_QUERY_TERMS:
+            self.logger.warning(
+                f"Warning: Query has more than {self.MAX_QUERY_TERMS} terms. Truncating."
             )
-            binary_query_embeddings[key] = binary_vector
-            if len(binary_query_embeddings) >= self.MAX_QUERY_TERMS:
-                self.logger.warning(
-                    f"Warning: Query has more than {self.MAX_QUERY_TERMS} terms. Truncating."
-                )
-                break
-        return binary_query_embeddings
+            binary_q_embs = binary_q_embs[: self.MAX_QUERY_TERMS]
+        return binary_q_embs
 
     def create_nn_query_strings(
-        self, binary_query_embeddings: dict, target_hits_per_query_tensor: int = 20
+        self,
+        q_embs: torch.Tensor,
+        binary_q_embs: np.ndarray,
+        target_hits_per_query_tensor: int = 20,
+        idx_to_token: Optional[dict] = None,
+        strategy: Optional[str] = None,
+        max_tokens: Optional[int] = None,
     ) -> Tuple[str, dict]:
         """
-        Create nearest neighbor query strings for Vespa.
+        Create nearest neighbor query strings for Vespa, for the query tokens picked by `select_nn_tokens`.
 
         Args:
-            binary_query_embeddings (dict): Binary query embeddings.
+            q_embs (torch.Tensor): Float query embeddings.
+            binary_q_embs (np.ndarray): Binary query embeddings of shape [num_tokens, 16].
             target_hits_per_query_tensor (int, optional): Target hits per query tensor. Defaults to 20.
+            idx_to_token (dict, optional): Index to token mapping, used to skip filtered tokens.
+            strategy (str, optional): Token ranking strategy. Defaults to NN_TOKEN_STRATEGY.
+            max_tokens (int, optional): Maximum number of nearestNeighbor operators. Defaults to NN_MAX_TOKENS.
 
         Returns:
             Tuple[str, dict]: Nearest neighbor query string and query tensor dictionary.
         """
-        nn_query_dict = {}
-        # Limit the number of terms to process
-        max_terms = min(len(binary_query_embeddings), self.MAX_QUERY_TERMS)
-
-        # Sort embeddings by magnitude and take top terms
-        embeddings_with_magnitude = []
-        for i, vector in binary_query_embeddings.items():
-            magnitude = sum(abs(x) for x in vector)
-            embeddings_with_magnitude.append((i, vector, magnitude))
-
-        # Sort by magnitude in descending order and take top terms
-        sorted_embeddings = sorted(embeddings_with_magnitude, key=lambda x: x[2], reverse=True)[:max_terms]
+        selected = select_nn_tokens(
+            to_numpy(q_embs)[: len(binary_q_embs)],
+            binary_q_embs,
+            max_tokens=min(max_tokens or self.nn_max_tokens, self.MAX_QUERY_TERMS),
+            strategy=strategy or self.nn_token_strategy,
+            idx_to_token=idx_to_token,
+            should_filter_token=SimMapGenerator.should_filter_token if self.nn_filter_tokens else None,
+            dedup_hamming=self.nn_dedup_hamming,
+        )
 
-        # Create query dictionary with only the most significant terms
-        for i, (orig_idx, vector, _) in enumerate(sorted_embeddings):
-            nn_query_dict[f"input.query(rq{i})"] = vector
+        # Create query dictionary with only the selected terms
+        nn_query_dict = {
+            f"input.query(rq{i})": vector
+            for i, vector in enumerate(binary_q_embs[selected].tolist())
+        }
 
         # Create OR clauses only for the selected terms
         nn = " OR ".join(
@@ -229,7 +300,7 @@ class VespaQueryClient:
         Returns:
             dict: Dictionary where each key is an index and value is the embedding list.
         """
-        return {idx: emb.tolist() for idx, emb in enumerate(q_embs)}
+        return float_cells(q_embs)
 
     async def get_result_from_query(
         self,
@@ -258,11 +329,19 @@ class VespaQueryClient:
         sim_map: bool = len(ranking.split("_")) > 1 and ranking.split("_")[1] == "sim"
         if rank_method == "colpali":  # ColPali
             result = await self.query_vespa_colpali(
-                query=query, ranking=rank_method, q_emb=q_embs, sim_map=sim_map
+                query=query,
+                ranking=rank_method,
+                q_emb=q_embs,
+                sim_map=sim_map,
+                idx_to_token=idx_to_token,
             )
         elif rank_method == "hybrid":  # Hybrid ColPali+BM25
             result = await self.query_vespa_colpali(
-                query=query, ranking=rank_method, q_emb=q_embs, sim_map=sim_map
+                query=query,
+                ranking=rank_method,
+                q_emb=q_embs,
+                sim_map=sim_map,
+                idx_to_token=idx_to_token,
             )
         elif rank_method == "bm25":
             result = await self.query_vespa_bm25(query, q_embs, sim_map=sim_map)
@@ -275,7 +354,7 @@ class VespaQueryClient:
             self.logger.debug(single_result["fields"].keys())
         return result
 
-    def get_sim_maps_from_query(
+    async def get_sim_maps_from_query(
         self, query: str, q_embs: torch.Tensor, ranking: str, idx_to_token: dict
     ):
         """
@@ -290,14 +369,27 @@ class VespaQueryClient:
         Returns:
             Dict[str, Any]: The query results.
         """
-        # Get the result by calling asyncio.run
-        result = asyncio.run(
-            self.get_result_from_query(query, q_embs, ranking, idx_to_token)
-        )
+        result = await self.get_result_from_query(query, q_embs, ranking, idx_to_token)
+        return self.extract_sim_maps(result)
+
+    def extract_sim_maps(self, result: dict) -> list:
+        """
+        Remove the sim map summary features from the hits of a result fetched with a `*_sim` rank profile.
+
+        Args:
+            result (dict): The query results.
+
+        Returns:
+            list: The Vespa similarity maps, in hit order.
+        """
         vespa_sim_maps = []
-        for single_result in result["root"]["children"]:
-            vespa_sim_map = single_result["fields"].get("summaryfeatures", None)
+        for single_result in result.get("root", {}).get("children", []):
+            vespa_sim_map = single_result["fields"].pop("summaryfeatures", None)
             if vespa_sim_map is not None:
+                # Set for pages fed with patch pooling, see backend.patch_pooling.hierarchical_pool
+                patch_clusters = single_result["fields"].pop("patch_clusters", None)
+                if patch_clusters:
+                    vespa_sim_map["patch_clusters"] = patch_clusters
                 vespa_sim_maps.append(vespa_sim_map)
             else:
                 raise ValueError("No sim_map found in Vespa response")
@@ -313,12 +405,32 @@ class VespaQueryClient:
         Returns:
             str: The full image data.
         """
+        images = await self.get_full_images_from_vespa([doc_id])
+        if doc_id not in images:
+            raise ValueError(f"No full image found in Vespa for doc_id: {doc_id}")
+        return images[doc_id]
+
+    async def get_full_images_from_vespa(self, doc_ids: list) -> Dict[str, str]:
+        """
+        Retrieve the full images for several document IDs with a single query.
+
+        Args:
+            doc_ids (list): The document IDs.
+
+        Returns:
+            Dict[str, str]: The base64 encoded full image data, keyed by document ID. IDs without a match are left out.
+        """
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return {}
+        id_list = ", ".join(self.yql_string(doc_id) for doc_id in doc_ids)
         async with self.app.asyncio(connections=1) as session:
             start = time.perf_counter()
             response: VespaQueryResponse = await session.query(
                 body={
-                    "yql": f'select full_image from {self.VESPA_SCHEMA_NAME} where id contains "{doc_id}"',
+                    "yql": f"select id, full_image from {self.VESPA_SCHEMA_NAME} where id in ({id_list})",
                     "ranking": "unranked",
+                    "hits": len(doc_ids),
                     "presentation.timing": True,
                     "ranking.matching.numThreadsPerSearch": 1,
                 },
@@ -326,13 +438,23 @@ class VespaQueryClient:
             assert response.is_successful(), response.json
             stop = time.perf_counter()
             self.logger.debug(
-                f"Getting image from Vespa took: {stop - start} s, Vespa reported searchtime was "
+                f"Getting {len(doc_ids)} images from Vespa took: {stop - start} s, Vespa reported searchtime was "
                 f"{response.json.get('timing', {}).get('searchtime', -1)} s"
             )
-        return response.json["root"]["children"][0]["fields"]["full_image"]
+        return {
+            child["fields"]["id"]: child["fields"]["full_image"]
+            for child in self.get_results_children(response.json)
+            if "full_image" in child.get("fields", {})
+        }
+
+    @staticmethod
+    def yql_string(value: str) -> str:
+        """Quote a value as a string literal of YQL and of document selections, which escape the same way."""
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        return f'"{escaped}"'
 
     def get_results_children(self, result: VespaQueryResponse) -> list:
-        return result["root"]["children"]
+        return result.get("root", {}).get("children", [])
 
     def results_to_search_results(
         self, result: VespaQueryResponse, idx_to_token: dict
@@ -351,7 +473,8 @@ class VespaQueryClient:
     async def get_suggestions(self, query: str) -> list:
         async with self.app.asyncio(connections=1) as session:
             start = time.perf_counter()
-            yql = f'select questions from {self.VESPA_SCHEMA_NAME} where questions matches (".*{query}.*")'
+            pattern = self.yql_string(f".*{re.escape(query)}.*")
+            yql = f"select questions from {self.VESPA_SCHEMA_NAME} where questions matches {pattern}"
             response: VespaQueryResponse = await session.query(
                 body={
                     "yql": yql,
@@ -387,8 +510,97 @@ class VespaQueryClient:
 
             return list(unique_questions)
 
+    def visit_questions(self) -> Dict[str, list]:
+        """
+        Visit all pages and collect their generated questions, used to build the suggestion index.
+        This is a blocking call.
+
+        Returns:
+            Dict[str, list]: Questions by UserDocument id.
+        """
+        start = time.perf_counter()
+        questions = {}
+        for slice in self.app.visit(
+            content_cluster_name=f"{self.app_name}_content",
+            schema=self.VESPA_SCHEMA_NAME,
+            namespace=self.app_name,
+            selection="true",
+            wanted_document_count=500,
+            fieldSet=f"{self.VESPA_SCHEMA_NAME}:id,questions",
+        ):
+            for response in slice:
+                assert response.is_successful(), response.json
+                for document in response.documents:
+                    fields = document.get("fields", {})
+                    doc_id = fields.get("id")
+                    if doc_id:
+                        # Suggestions are per uploaded document, not per page
+                        questions.setdefault(parent_document_id(doc_id), []).extend(
+                            fields.get("questions", [])
+                        )
+        self.logger.debug(
+            f"Visited {len(questions)} documents for suggestions in {time.perf_counter() - start:.3f} s"
+        )
+        return questions
+
+    async def delete_by_selection(self, selection: str) -> int:
+        """
+        Remove all pages matching a document selection, with selection-based deletes of the document/v1 API.
+        Vespa visits and removes the matching documents server side, in as many requests as it takes.
+
+        Args:
+            selection (str): Document selection, e.g. `pdf_page.id=="..."`.
+
+        Returns:
+            int: The number of removed documents, as reported by Vespa.
+        """
+        start = time.perf_counter()
+        end_point = f"{self.app.end_point}/document/v1/{self.app_name}/{self.VESPA_SCHEMA_NAME}/docid"
+        params = {"cluster": f"{self.app_name}_content", "selection": selection}
+        removed = 0
+        async with self.app.asyncio(connections=1) as session:
+            session.httpx_client._timeout = httpx.Timeout(timeout=60.0)
+            while True:
+                response = await session.httpx_client.delete(end_point, params=params)
+                result = response.json()
+                if response.status_code != 200:
+                    raise RuntimeError(f"Selection delete failed: {result}")
+                removed += result.get("documentCount", 0)
+                if "continuation" not in result:
+                    break
+                params["continuation"] = result["continuation"]
+        self.logger.info(
+            f"Removed {removed} documents matching {selection} in {time.perf_counter() - start:.3f} s"
+        )
+        return removed
+
+    async def remove_pages(self, document_ids: List[str]) -> dict:
+        """
+        Remove all pages of the given documents (UserDocument ids) with selection-based deletes of up to
+        REMOVE_BATCH_SIZE documents each, so multi-page PDFs and multi-file uploads are removed in a few calls.
+
+        Returns:
+            dict: `status`, and the number of `removed` pages or an error `message`.
+        """
+        if not document_ids:
+            return {"status": "success", "removed": 0}
+        # Pages are `{document_id}_{page_number}`, pages fed before page ids existed are `{document_id}`
+        removed = 0
+        try:
+            for i in range(0, len(document_ids), self.REMOVE_BATCH_SIZE):
+                selection = " or ".join(
+                    f"{self.VESPA_SCHEMA_NAME}.id=={self.yql_string(document_id)} or "
+                    f"{self.VESPA_SCHEMA_NAME}.id={self.yql_string(document_id + '_*')}"
+                    for document_id in document_ids[i : i + self.REMOVE_BATCH_SIZE]
+                )
+                removed += await self.delete_by_selection(selection)
+        except Exception as e:
+            self.logger.error(f"Error removing pages of {document_ids} from Vespa: {str(e)}")
+            return {"status": "error", "message": f"Error removing document from Vespa: {str(e)}"}
+        return {"status": "success", "removed": removed}
+
     def get_rank_profile(self, ranking: str, sim_map: bool) -> str:
-        if sim_map:
+        if sim_map and f"{ranking}_sim" in self.sim_rank_profiles:
             return f"{ranking}_sim"
         else:
             return ranking
@@ -398,87 +610,119 @@ class VespaQueryClient:
         query: str,
         ranking: str,
         q_emb: torch.Tensor,
-        target_hits_per_query_tensor: int = 100,
-        hnsw_explore_additional_hits: int = 300,
+        target_hits_per_query_tensor: Optional[int] = None,
+        hnsw_explore_additional_hits: Optional[int] = None,
         hits: int = 3,
-        timeout: str = "10s",
+        timeout: Optional[str] = None,
         sim_map: bool = False,
         visual_only: bool = False,
+        idx_to_token: Optional[dict] = None,
+        nn_strategy: Optional[str] = None,
+        nn_max_tokens: Optional[int] = None,
+        tier: Optional[str] = None,
         **kwargs,
     ) -> dict:
         """
         Query Vespa using nearest neighbor search with mixed tensors for MaxSim calculations.
         This corresponds to the "ColPali" radio button in the UI.
 
+        Ranking parameters not given explicitly are chosen by the query budget, see backend/query_budget.py.
+        The chosen parameters are returned in the `query_params` key of the result.
+
         Args:
             query (str): The query text.
             q_emb (torch.Tensor): Query embeddings.
-            target_hits_per_query_tensor (int, optional): Target hits per query tensor. Defaults to 20.
+            target_hits_per_query_tensor (int, optional): Target hits per query tensor.
+            hnsw_explore_additional_hits (int, optional): Additional HNSW exploration per query tensor.
             hits (int, optional): Number of hits to retrieve. Defaults to 3.
-            timeout (str, optional): Query timeout. Defaults to "10s".
+            timeout (str, optional): Query timeout, e.g. "2s".
+            idx_to_token (dict, optional): Index to token mapping of a text query.
+            nn_strategy (str, optional): Overrides NN_TOKEN_STRATEGY.
+            nn_max_tokens (int, optional): Overrides NN_MAX_TOKENS.
+            tier (str, optional): Force a query budget tier.
 
         Returns:
             dict: The formatted query results.
         """
+        params = self.query_budget.acquire(visual_only=visual_only, tier=tier)
+        if target_hits_per_query_tensor is not None:
+            params.target_hits = target_hits_per_query_tensor
+        if hnsw_explore_additional_hits is not None:
+            params.explore_additional_hits = hnsw_explore_additional_hits
+        if timeout is None:
+            timeout = f"{params.timeout_ms}ms"
         if visual_only:
-            # Further optimize parameters for visual search
-            timeout = "300s"  # Match the HTTP client timeout
-            hnsw_explore_additional_hits = 100  # Keep reduced exploration
-            target_hits_per_query_tensor = 20  # Keep reduced target hits
             ranking = f"{ranking}_visual"
 
-        async with self.app.asyncio(connections=1) as session:
-            # Configure longer timeout for the session
-            session.httpx_client._timeout = httpx.Timeout(timeout=300.0)  # 5 minutes
+        elapsed_ms = None
+        try:
+            async with self.app.asyncio(connections=1) as session:
+                # Leave Vespa time to return (soft timeout) results before giving up on the connection
+                session.httpx_client._timeout = httpx.Timeout(
+                    timeout=params.timeout_ms / 1000 + 5.0
+                )
 
-            float_query_embedding = self.format_q_embs(q_emb)
-            binary_query_embeddings = self.float_to_binary_embedding(
-                float_query_embedding
-            )
+                float_query_embedding = self.format_q_embs(q_emb)
+                binary_q_embs = self.binarize_q_embs(q_emb)
+
+                # Mixed tensors for MaxSim calculations
+                query_tensors = {
+                    "input.query(qtb)": tensor_cells(binary_q_embs),
+                    "input.query(qt)": float_query_embedding,
+                }
+                nn_string, nn_query_dict = self.create_nn_query_strings(
+                    q_emb,
+                    binary_q_embs,
+                    params.target_hits,
+                    idx_to_token=idx_to_token,
+                    strategy=nn_strategy,
+                    max_tokens=nn_max_tokens,
+                )
+                query_tensors.update(nn_query_dict)
 
-            # Mixed tensors for MaxSim calculations
-            query_tensors = {
-                "input.query(qtb)": binary_query_embeddings,
-                "input.query(qt)": float_query_embedding,
-            }
-            nn_string, nn_query_dict = self.create_nn_query_strings(
-                binary_query_embeddings, target_hits_per_query_tensor
-            )
-            query_tensors.update(nn_query_dict)
-
-            # Prepare query body with optimized parameters
-            query_body = {
-                **query_tensors,
-                "presentation.timing": True,
-                "yql": (
-                    f"select {self.get_fields(sim_map=sim_map)} from {self.VESPA_SCHEMA_NAME} where {nn_string}"
-                    + (" or userQuery()" if not visual_only else "")
-                ),
-                "ranking.profile": self.get_rank_profile(
-                    ranking=ranking, sim_map=sim_map
-                ),
-                "timeout": timeout,
-                "hits": hits,
-                "hnsw.exploreAdditionalHits": hnsw_explore_additional_hits,
-                "ranking.rerankCount": 25 if visual_only else 100,  # Further reduce rerank count
-                "ranking.matchPhase.maxHits": 100,  # Limit match phase hits
-                "ranking.softtimeout.enable": True,  # Enable soft timeout
-                **kwargs,
-            }
-
-            # Only add query parameter if not visual_only
-            if not visual_only:
-                query_body["query"] = query
-
-            try:
-                response: VespaQueryResponse = await session.query(body=query_body)
-                assert response.is_successful(), response.json
-            except Exception as e:
-                self.logger.error(f"Query failed: {str(e)}")
-                if hasattr(e, 'response') and hasattr(e.response, 'json'):
-                    self.logger.error(f"Response JSON: {e.response.json()}")
-                raise
-        return self.format_query_results(query, response)
+                query_body = {
+                    **query_tensors,
+                    "presentation.timing": True,
+                    "yql": (
+                        f"select {self.get_fields(sim_map=sim_map)} from {self.VESPA_SCHEMA_NAME} where {nn_string}"
+                        + (" or userQuery()" if not visual_only else "")
+                    ),
+                    "ranking.profile": self.get_rank_profile(
+                        ranking=ranking, sim_map=sim_map
+                    ),
+                    "timeout": timeout,
+                    "hits": self.fetch_hits(hits),
+                    "hnsw.exploreAdditionalHits": params.explore_additional_hits,
+                    "ranking.rerankCount": params.rerank_count,
+                    "ranking.matchPhase.maxHits": params.match_phase_max_hits,
+                    "ranking.softtimeout.enable": True,  # Enable soft timeout
+                    **self.get_summary_params(sim_map),
+                    **kwargs,
+                }
+
+                # Only add query parameter if not visual_only
+                if not visual_only:
+                    query_body["query"] = query
+
+                start = time.perf_counter()
+                try:
+                    response: VespaQueryResponse = await session.query(body=query_body)
+                    assert response.is_successful(), response.json
+                except Exception as e:
+                    self.logger.error(f"Query failed: {str(e)}")
+                    if hasattr(e, 'response') and hasattr(e.response, 'json'):
+                        self.logger.error(f"Response JSON: {e.response.json()}")
+                    raise
+                elapsed_ms = (time.perf_counter() - start) * 1000
+        finally:
+            self.query_budget.release(params, elapsed_ms)
+        self.logger.info(
+            f"ColPali query used tier {params.tier} ({', '.join(params.reasons) or 'default'}), "
+            f"took {elapsed_ms:.0f} ms"
+        )
+        result = self.format_query_results(query, response, hits)
+        result["query_params"] = params.to_dict()
+        return result
 
     async def keepalive(self) -> bool:
         """
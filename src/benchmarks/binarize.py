@@ -0,0 +1,86 @@
+"""
+Benchmark the vectorized binarization in backend.binarize against the previous per-row loops.
+
+Checks that both produce identical Vespa tensors for a page ([1030, 128] patch embeddings) and a query
+([25, 128] token embeddings), and reports the time per call.
+
+Run from the src directory:
+
+    python -m benchmarks.binarize
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from backend.binarize import binary_cells, float_cells
+
+
+def legacy_float_to_binary_embedding(float_query_embedding: dict) -> dict:
+    binary_query_embeddings = {}
+    for k, v in float_query_embedding.items():
+        binary_vector = (
+            np.packbits(np.where(np.array(v) > 0, 1, 0)).astype(np.int8).tolist()
+        )
+        binary_query_embeddings[k] = binary_vector
+    return binary_query_embeddings
+
+
+def legacy_page(embedding: np.ndarray) -> dict:
+    return legacy_float_to_binary_embedding({k: v for k, v in enumerate(embedding)})
+
+
+def legacy_query(embedding: np.ndarray) -> tuple:
+    float_query_embedding = {idx: emb.tolist() for idx, emb in enumerate(embedding)}
+    binary = legacy_float_to_binary_embedding(float_query_embedding)
+    magnitudes = [(i, sum(abs(x) for x in vector)) for i, vector in binary.items()]
+    order = [i for i, _ in sorted(magnitudes, key=lambda x: x[1], reverse=True)]
+    return float_query_embedding, binary, order
+
+
+def vectorized_page(embedding: np.ndarray) -> dict:
+    return binary_cells(embedding)
+
+
+def vectorized_query(embedding: np.ndarray) -> tuple:
+    float_query_embedding = float_cells(embedding)
+    binary = binary_cells(embedding)
+    packed = np.array(list(binary.values()), dtype=np.int32)
+    order = np.argsort(-np.abs(packed).sum(axis=1), kind="stable").tolist()
+    return float_query_embedding, binary, order
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--patches", type=int, default=1030)
+    parser.add_argument("--tokens", type=int, default=25)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    page = rng.standard_normal((args.patches, 128)).astype(np.float32)
+    query = rng.standard_normal((args.tokens, 128)).astype(np.float32)
+
+    assert legacy_page(page) == vectorized_page(page), "page tensors differ"
+    legacy_q, vectorized_q = legacy_query(query), vectorized_query(query)
+    assert legacy_q[1] == vectorized_q[1], "query tensors differ"
+    assert legacy_q[2] == vectorized_q[2], "nearest neighbor term order differs"
+    print("Outputs are identical")
+
+    for name, legacy, vectorized, embedding in [
+        ("page", legacy_page, vectorized_page, page),
+        ("query", legacy_query, vectorized_query, query),
+    ]:
+        legacy_time = min(timeit.repeat(lambda: legacy(embedding), number=args.number, repeat=3))
+        vectorized_time = min(timeit.repeat(lambda: vectorized(embedding), number=args.number, repeat=3))
+        legacy_ms = legacy_time / args.number * 1000
+        vectorized_ms = vectorized_time / args.number * 1000
+        print(
+            f"{name:<6} legacy {legacy_ms:8.3f} ms   vectorized {vectorized_ms:8.3f} ms   "
+            f"speedup {legacy_ms / vectorized_ms:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
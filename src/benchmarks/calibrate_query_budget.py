@@ -0,0 +1,102 @@
+"""
+Calibrate the query budget tiers against a deployed application.
+
+Every tier in backend/query_budget.py is run for a set of queries, and the measured p50/p95 latencies are
+written together with the tier parameters to the calibration file read by the app
+(QUERY_BUDGET_CALIBRATION, storage/query_budget.json by default). With QUERY_LATENCY_BUDGET_MS set, the
+app then picks the most expensive tier whose p95 fits the budget.
+
+Needs the ColPali model and the same Vespa environment variables as the app.
+
+Run from the src directory:
+
+    python -m benchmarks.calibrate_query_budget --app-name myapp --queries queries.txt
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from backend.colpali import SimMapGenerator
+from backend.query_budget import DEFAULT_TIERS
+from backend.vespa_app import VespaQueryClient
+from benchmarks.nn_token_selection import QUERIES
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(args):
+    logger = logging.getLogger("vespa_app")
+    settings = SimpleNamespace(
+        app_name=args.app_name, vespa_cloud_endpoint=None, vespa_cloud_secret_token=None
+    )
+    client = VespaQueryClient(logger=logger, settings=settings)
+    client.query_budget.tiers = DEFAULT_TIERS
+    model = SimMapGenerator(logger=logger)
+
+    queries = list(QUERIES)
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    embedded = [(q, *model.get_query_embeddings_and_token_map(q)) for q in queries]
+
+    calibrated = []
+    for tier in DEFAULT_TIERS:
+        latencies = []
+        for _ in range(args.rounds):
+            for q, q_embs, idx_to_token in embedded:
+                start = time.perf_counter()
+                await client.query_vespa_colpali(
+                    query=q,
+                    ranking="hybrid",
+                    q_emb=q_embs,
+                    idx_to_token=idx_to_token,
+                    sim_map=True,
+                    tier=tier["name"],
+                )
+                latencies.append((time.perf_counter() - start) * 1000)
+        p50, p95 = percentile(latencies, 0.5), percentile(latencies, 0.95)
+        print(
+            f"{tier['name']:<10} p50 {p50:8.1f} ms   p95 {p95:8.1f} ms   "
+            f"mean {statistics.mean(latencies):8.1f} ms"
+        )
+        calibrated.append({**tier, "p50_ms": round(p50, 1), "p95_ms": round(p95, 1)})
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "calibrated_at": datetime.now(timezone.utc).isoformat(),
+                "queries": len(queries) * args.rounds,
+                "tiers": calibrated,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Wrote {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--app-name", required=True, help="Vespa application name")
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--output",
+        default=os.getenv("QUERY_BUDGET_CALIBRATION", "storage/query_budget.json"),
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
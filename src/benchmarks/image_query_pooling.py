@@ -0,0 +1,118 @@
+"""
+Compare the reductions of image query embeddings (IMAGE_QUERY_POOLING) for recall and latency.
+
+Every page is encoded as a document, and a degraded copy of it (cropped, slightly rotated, JPEG
+compressed, like a photo or screenshot of the page) is used as the query that should find it. Each query is
+reduced with the original truncation to the first MAX_QUERY_TERMS tokens, with background pruning and
+k-means pooling at several budgets, and without any reduction as an upper bound. The pages are ranked
+offline with the same MaxSim expression as the colpali rank profile (float query against unpacked binary
+page embeddings), and recall@k of the source page, the reduction time and the MaxSim time are reported.
+
+Run from the src directory, with a directory of page images and/or PDFs:
+
+    python -m benchmarks.image_query_pooling --pages path/to/pages
+"""
+
+import argparse
+import io
+import logging
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+
+from backend.binarize import binarize
+from backend.colpali import SimMapGenerator
+from backend.patch_pooling import reduce_image_query
+from backend.precision import maxsim_scores
+from backend.vespa_app import VespaQueryClient
+from benchmarks.precision import load_pages
+
+
+def degrade(page: Image.Image, rng: np.random.Generator) -> Image.Image:
+    """Crop, rotate and JPEG compress a page, so the query is similar but not identical to it"""
+    width, height = page.size
+    scale = rng.uniform(0.7, 0.95)
+    left = rng.uniform(0, (1 - scale) * width)
+    top = rng.uniform(0, (1 - scale) * height)
+    image = page.crop((left, top, left + scale * width, top + scale * height))
+    image = image.rotate(rng.uniform(-3, 3), expand=True, fillcolor="white")
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=60)
+    return Image.open(io.BytesIO(buffer.getvalue())).convert("RGB")
+
+
+def unpacked(page_embedding: np.ndarray) -> np.ndarray:
+    """Binary page embeddings as the rank profile sees them, after unpack_bits"""
+    return np.unpackbits(binarize(page_embedding).view(np.uint8), axis=-1).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", required=True, help="Directory with page images and/or PDFs")
+    parser.add_argument("--max-pages", type=int, default=50)
+    parser.add_argument("--budgets", nargs="*", type=int, default=[16, 32, 64, 128])
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--min-std", type=float, default=4.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logger = logging.getLogger("vespa_app")
+    generator = SimMapGenerator(logger=logger)
+    rng = np.random.default_rng(args.seed)
+
+    pages = load_pages(args.pages, args.max_pages)
+    documents = [unpacked(generator.encode_image_query(page).numpy()) for page in pages]
+    print(f"Encoded {len(documents)} pages")
+
+    max_terms = VespaQueryClient.MAX_QUERY_TERMS
+    variants = {"full": None, f"truncate {max_terms}": None}
+    variants.update({f"kmeans {budget}": budget for budget in args.budgets})
+    results = {name: {"ranks": [], "reduce_ms": [], "maxsim_ms": [], "tokens": []} for name in variants}
+
+    for target, page in enumerate(pages):
+        query_image = degrade(page, rng)
+        embeddings = generator.encode_image_query(query_image).numpy()
+        for name, budget in variants.items():
+            start = time.perf_counter()
+            if name == "full":
+                reduced = embeddings
+            elif budget is None:
+                reduced = embeddings[:max_terms]
+            else:
+                reduced, _ = reduce_image_query(
+                    embeddings,
+                    query_image,
+                    num_patches=generator.num_image_patches,
+                    budget=budget,
+                    min_std=args.min_std,
+                )
+            reduce_ms = 1000 * (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            scores = maxsim_scores(reduced, documents)
+            maxsim_ms = 1000 * (time.perf_counter() - start)
+
+            result = results[name]
+            result["ranks"].append(int((scores > scores[target]).sum()))
+            result["reduce_ms"].append(reduce_ms)
+            result["maxsim_ms"].append(maxsim_ms)
+            result["tokens"].append(len(reduced))
+
+    print(f"{len(pages)} degraded page queries against {len(documents)} pages")
+    print(
+        f"{'reduction':<14} {'tokens':>6} {'recall@1':>8} {f'recall@{args.k}':>8} {'MRR':>6} "
+        f"{'reduce (ms)':>11} {'maxsim (ms)':>11}"
+    )
+    for name, result in results.items():
+        ranks = np.array(result["ranks"])
+        print(
+            f"{name:<14} {statistics.mean(result['tokens']):>6.0f} {np.mean(ranks < 1):>8.3f} "
+            f"{np.mean(ranks < args.k):>8.3f} {np.mean(1 / (ranks + 1)):>6.3f} "
+            f"{statistics.median(result['reduce_ms']):>11.2f} {statistics.median(result['maxsim_ms']):>11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
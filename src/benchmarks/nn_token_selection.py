@@ -0,0 +1,125 @@
+"""
+Offline evaluation of query token selection for the nearestNeighbor fan-out.
+
+For every query, the reference result list is retrieved with the original behavior (all tokens up to
+MAX_QUERY_TERMS, ranked by magnitude, no filtering or deduplication). Each strategy is then run with an
+increasing number of nearestNeighbor operators, and recall@k against the reference and the Vespa search
+time are reported, so NN_TOKEN_STRATEGY and NN_MAX_TOKENS can be chosen with data.
+
+Needs the ColPali model and a deployed application, configured through the same environment variables
+as the app (VESPA_APP_TOKEN_URL and VESPA_CLOUD_SECRET_TOKEN, or USE_MTLS=true with the mTLS variables).
+
+Run from the src directory:
+
+    python -m benchmarks.nn_token_selection --app-name myapp --queries queries.txt
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+from types import SimpleNamespace
+
+from backend.colpali import SimMapGenerator
+from backend.token_selection import NN_TOKEN_STRATEGIES
+from backend.vespa_app import VespaQueryClient
+
+QUERIES = [
+    "Percentage of non-fresh water as source?",
+    "Policies related to nature risk?",
+    "How much of produced water is recycled?",
+    "What is the total revenue in 2023?",
+    "Number of employees by region",
+]
+
+
+def hit_ids(result: dict) -> list:
+    return [hit["fields"]["id"] for hit in result.get("root", {}).get("children", [])]
+
+
+def recall(reference: list, candidate: list, k: int) -> float:
+    reference = set(reference[:k])
+    if not reference:
+        return 1.0
+    return len(reference & set(candidate[:k])) / len(reference)
+
+
+async def run(args):
+    logger = logging.getLogger("vespa_app")
+    settings = SimpleNamespace(
+        app_name=args.app_name, vespa_cloud_endpoint=None, vespa_cloud_secret_token=None
+    )
+    client = VespaQueryClient(logger=logger, settings=settings)
+    model = SimMapGenerator(logger=logger)
+
+    queries = list(QUERIES)
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    async def query(q, q_embs, idx_to_token, strategy, max_tokens):
+        result = await client.query_vespa_colpali(
+            query=q,
+            ranking="colpali",
+            q_emb=q_embs,
+            hits=args.k,
+            idx_to_token=idx_to_token,
+            nn_strategy=strategy,
+            nn_max_tokens=max_tokens,
+        )
+        return hit_ids(result), result.get("timing", {}).get("searchtime", 0.0)
+
+    recalls = {}
+    searchtimes = {}
+    for q in queries:
+        q_embs, idx_to_token = model.get_query_embeddings_and_token_map(q)
+
+        client.nn_dedup_hamming, client.nn_filter_tokens = -1, False
+        reference, reference_time = await query(
+            q, q_embs, None, "magnitude", client.MAX_QUERY_TERMS
+        )
+        searchtimes.setdefault(("reference", client.MAX_QUERY_TERMS), []).append(reference_time)
+        client.nn_dedup_hamming, client.nn_filter_tokens = args.dedup_hamming, args.filter_tokens
+
+        for strategy in args.strategies:
+            for max_tokens in args.max_tokens:
+                ids, searchtime = await query(q, q_embs, idx_to_token, strategy, max_tokens)
+                recalls.setdefault((strategy, max_tokens), []).append(
+                    recall(reference, ids, args.k)
+                )
+                searchtimes.setdefault((strategy, max_tokens), []).append(searchtime)
+
+    print(f"{len(queries)} queries, recall@{args.k} against the original token selection")
+    print(f"{'strategy':<10} {'max NN':>6} {'recall':>8} {'searchtime (s)':>15}")
+    reference_key = ("reference", client.MAX_QUERY_TERMS)
+    print(
+        f"{'reference':<10} {client.MAX_QUERY_TERMS:>6} {1.0:>8.3f} "
+        f"{statistics.mean(searchtimes[reference_key]):>15.3f}"
+    )
+    for (strategy, max_tokens), values in recalls.items():
+        print(
+            f"{strategy:<10} {max_tokens:>6} {statistics.mean(values):>8.3f} "
+            f"{statistics.mean(searchtimes[(strategy, max_tokens)]):>15.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--app-name", required=True, help="Vespa application name")
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--strategies", nargs="*", default=list(NN_TOKEN_STRATEGIES))
+    parser.add_argument("--max-tokens", nargs="*", type=int, default=[4, 8, 16, 32, 64])
+    parser.add_argument("--dedup-hamming", type=int, default=8, help="NN_DEDUP_HAMMING of the candidates")
+    parser.add_argument(
+        "--no-filter-tokens",
+        dest="filter_tokens",
+        action="store_false",
+        help="Don't skip filtered tokens in the candidates (NN_FILTER_TOKENS)",
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Evaluate document-side patch pooling (FEED_PATCH_POOL_FACTOR) for index size, feed speed and quality.
+
+Every page is encoded once, then pooled at each factor. For each factor the report shows:
+
+- the vectors per page and an estimate of their attribute and HNSW memory
+- the pooling time per page next to the encoding time
+- two retrieval quality measures, both ranked offline with the MaxSim expression of the colpali rank
+  profile (float query against unpacked binary page embeddings):
+  - recall@k of the source page for degraded copies of the pages used as image queries (reduced as
+    /api/image-search does)
+  - top-k overlap with the unpooled ranking for text queries
+
+Run from the src directory, with a directory of page images and/or PDFs:
+
+    python -m benchmarks.patch_pooling --pages path/to/pages
+"""
+
+import argparse
+import logging
+import statistics
+import time
+
+import numpy as np
+
+from backend.colpali import SimMapGenerator
+from backend.patch_pooling import hierarchical_pool, reduce_image_query
+from backend.precision import maxsim_scores
+from backend.vespa_app import VespaQueryClient
+from benchmarks.image_query_pooling import degrade, unpacked
+from benchmarks.precision import load_pages, read_queries
+
+# Bytes per vector: the packed int8 embedding, and about one 4 byte link per neighbor in both directions
+# of the HNSW graph (max-links-per-node in the schema)
+EMBEDDING_BYTES = 16
+HNSW_LINK_BYTES = 2 * 32 * 4
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", required=True, help="Directory with page images and/or PDFs")
+    parser.add_argument("--queries", help="File with one text query per line")
+    parser.add_argument("--max-pages", type=int, default=50)
+    parser.add_argument("--factors", nargs="*", type=float, default=[1, 2, 3, 4, 6, 8])
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logger = logging.getLogger("vespa_app")
+    generator = SimMapGenerator(logger=logger)
+    rng = np.random.default_rng(args.seed)
+    num_patches = generator.num_image_patches
+
+    pages = load_pages(args.pages, args.max_pages)
+    page_embeddings, encode_ms = [], []
+    for page in pages:
+        start = time.perf_counter()
+        page_embeddings.append(generator.encode_image_query(page).numpy())
+        encode_ms.append(1000 * (time.perf_counter() - start))
+    print(f"Encoded {len(pages)} pages, {statistics.median(encode_ms):.0f} ms per page")
+
+    image_queries = []
+    for page in pages:
+        query_image = degrade(page, rng)
+        reduced, _ = reduce_image_query(
+            generator.encode_image_query(query_image),
+            query_image,
+            num_patches=num_patches,
+            budget=VespaQueryClient.MAX_QUERY_TERMS,
+        )
+        image_queries.append(reduced)
+    text_queries = [generator.encode_query(query)[0].numpy() for query in read_queries(args.queries)]
+
+    unpooled = [unpacked(embedding) for embedding in page_embeddings]
+    reference_rankings = [
+        np.argsort(-maxsim_scores(query, unpooled))[: args.k] for query in text_queries
+    ]
+    print(
+        f"{'factor':>6} {'vectors':>7} {'index/page':>10} {'pool (ms)':>9} "
+        f"{'image recall@' + str(args.k):>15} {'text overlap@' + str(args.k):>15}"
+    )
+    for factor in args.factors:
+        documents, pool_ms = [], []
+        for embedding in page_embeddings:
+            start = time.perf_counter()
+            pooled, _ = hierarchical_pool(embedding, num_patches, factor)
+            pool_ms.append(1000 * (time.perf_counter() - start))
+            documents.append(pooled)
+        binary_documents = [unpacked(document) for document in documents]
+
+        ranks = []
+        for target, query in enumerate(image_queries):
+            scores = maxsim_scores(query, binary_documents)
+            ranks.append(int((scores > scores[target]).sum()))
+
+        rankings = [
+            np.argsort(-maxsim_scores(query, binary_documents))[: args.k] for query in text_queries
+        ]
+        overlap = statistics.mean(
+            len(set(reference) & set(ranking)) / len(reference)
+            for reference, ranking in zip(reference_rankings, rankings)
+        )
+
+        vectors = statistics.mean(len(document) for document in documents)
+        index_kb = vectors * (EMBEDDING_BYTES + HNSW_LINK_BYTES) / 1024
+        print(
+            f"{factor:>6.1f} {vectors:>7.0f} {index_kb:>8.0f}KB {statistics.median(pool_ms):>9.1f} "
+            f"{np.mean(np.array(ranks) < args.k):>15.3f} {overlap:>15.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Benchmark the ColPali inference precisions (COLPALI_PRECISION) for latency, memory and accuracy.
+
+Every precision runs in its own process, so the resident memory numbers are not mixed up. Each process
+encodes a fixed set of queries and pages, and the embeddings are compared against fp32 with the accuracy
+guard in backend/precision.py. The exit code is 1 if any precision fails the guard.
+
+Run from the src directory, with a directory of page images and/or PDFs:
+
+    python -m benchmarks.precision --pages path/to/pages
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from backend.precision import PRECISIONS, compare_to_reference
+from benchmarks.nn_token_selection import QUERIES
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def load_pages(directory: str, max_pages: int) -> list:
+    from pdf2image import convert_from_path
+    from PIL import Image
+
+    pages = []
+    for path in sorted(Path(directory).rglob("*")):
+        if path.suffix.lower() == ".pdf":
+            pages.extend(convert_from_path(path))
+        elif path.suffix.lower() in (".png", ".jpg", ".jpeg"):
+            pages.append(Image.open(path).convert("RGB"))
+        if len(pages) >= max_pages:
+            break
+    return pages[:max_pages]
+
+
+def worker(args):
+    """Encode the queries and pages in one precision and save the embeddings and timings"""
+    import logging
+
+    from backend.colpali import SimMapGenerator
+
+    logger = logging.getLogger("vespa_app")
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    generator = SimMapGenerator(logger=logger, precision=args.worker)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = rss_mb()
+
+    queries = read_queries(args.queries)
+    query_embs, query_times = [], []
+    for query in queries:
+        start = time.perf_counter()
+        q_emb, _ = generator.encode_query(query)
+        query_times.append(time.perf_counter() - start)
+        query_embs.append(q_emb.numpy())
+
+    page_embs, page_times = [], []
+    for page in load_pages(args.pages, args.max_pages):
+        start = time.perf_counter()
+        inputs = generator.processor.process_images([page]).to(generator.model.device)
+        with torch.no_grad():
+            embedding = generator.model(**inputs).to("cpu", dtype=torch.float32)[0]
+        page_times.append(time.perf_counter() - start)
+        page_embs.append(embedding.numpy())
+
+    np.savez(
+        args.out,
+        **{f"q{i}": emb for i, emb in enumerate(query_embs)},
+        **{f"p{i}": emb for i, emb in enumerate(page_embs)},
+    )
+    with open(args.out + ".json", "w") as f:
+        json.dump(
+            {
+                "precision": generator.precision,
+                "load_seconds": load_seconds,
+                "model_rss_mb": rss_loaded - rss_before,
+                "peak_rss_mb": rss_mb(),
+                "query_ms": 1000 * float(np.median(query_times[1:] or query_times)),
+                "page_ms": 1000 * float(np.median(page_times[1:] or page_times)),
+            },
+            f,
+        )
+
+
+def read_queries(path: str) -> list:
+    if not path:
+        return list(QUERIES)
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_embeddings(path: str) -> tuple:
+    data = np.load(path)
+    queries = [data[f"q{i}"] for i in range(sum(k.startswith("q") for k in data.files))]
+    pages = [data[f"p{i}"] for i in range(sum(k.startswith("p") for k in data.files))]
+    return queries, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", required=True, help="Directory with page images and/or PDFs")
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument("--max-pages", type=int, default=16)
+    parser.add_argument("--precisions", nargs="*", default=list(PRECISIONS))
+    parser.add_argument("--worker", choices=PRECISIONS, help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    precisions = ["fp32"] + [p for p in args.precisions if p != "fp32"]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for precision in precisions:
+            out = os.path.join(tmp, f"{precision}.npz")
+            command = [sys.executable, "-m", "benchmarks.precision", "--worker", precision, "--out", out]
+            command += ["--pages", args.pages, "--max-pages", str(args.max_pages)]
+            if args.queries:
+                command += ["--queries", args.queries]
+            subprocess.run(command, check=True)
+            with open(out + ".json") as f:
+                results[precision] = json.load(f)
+            results[precision]["embeddings"] = load_embeddings(out)
+
+    reference_queries, reference_pages = results["fp32"]["embeddings"]
+    print(
+        f"{'precision':<10} {'load (s)':>8} {'model RSS':>10} {'query (ms)':>10} {'page (ms)':>10} "
+        f"{'page bits':>9} {'query bits':>10} {'top1':>6} {'top3':>6} {'guard':>6}"
+    )
+    failed = False
+    for precision, result in results.items():
+        queries, pages = result["embeddings"]
+        report = compare_to_reference(reference_queries, reference_pages, queries, pages)
+        failed |= not report["passed"]
+        print(
+            f"{result['precision']:<10} {result['load_seconds']:>8.1f} {result['model_rss_mb']:>8.0f}MB "
+            f"{result['query_ms']:>10.1f} {result['page_ms']:>10.1f} "
+            f"{report['page_bit_agreement']:>9.4f} {report['query_bit_agreement']:>10.4f} "
+            f"{report['top1_agreement']:>6.2f} {report['top3_overlap']:>6.2f} "
+            f"{'pass' if report['passed'] else 'FAIL':>6}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
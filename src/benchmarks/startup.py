@@ -0,0 +1,112 @@
+"""
+Measure import and startup time of the web app.
+
+Each module is imported in a fresh interpreter so earlier imports don't skew the numbers. With `--serve`,
+the app is started as `python main.py` and the time until /healthz and /readyz respond is reported.
+
+Run from the src directory:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --serve
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+MODULES = [
+    "torch",
+    "backend.stopwords",
+    "backend.colpali",
+    "backend.vespa_app",
+    "backend.feed",
+    "google.generativeai",
+    "main",
+]
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def time_import(module: str, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def wait_for(url: str, deadline: float) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                raise
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"{url} did not become ready")
+
+
+def time_serve(port: int, timeout: float) -> dict:
+    env = dict(os.environ, HOT_RELOAD="false")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = start + timeout
+        live = wait_for(f"http://localhost:{port}/healthz", deadline)
+        ready = wait_for(f"http://localhost:{port}/readyz", deadline)
+        return {"healthz": live - start, "readyz": ready - start}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modules", nargs="*", default=MODULES)
+    parser.add_argument("--serve", action="store_true", help="Also time a full app start")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    print(f"{'module':<24} {'min (s)':>8} {'max (s)':>8}")
+    for module in args.modules:
+        try:
+            timings = time_import(module, args.repeat)
+        except RuntimeError as e:
+            print(f"{module:<24} failed: {e}")
+            continue
+        print(f"{module:<24} {min(timings):>8.2f} {max(timings):>8.2f}")
+
+    if args.serve:
+        timings = time_serve(args.port, args.timeout)
+        print(f"time to /healthz: {timings['healthz']:.2f} s")
+        print(f"time to /readyz:  {timings['readyz']:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compare the fast stop word filter against the spaCy pipeline, for agreement and latency.
+
+The corpus is a built-in set of search-box style queries, optionally extended with a file holding one
+query per line (for example the generated questions exported from Vespa). Requires spaCy and
+en_core_web_sm to be installed.
+
+Run from the src directory:
+
+    python -m benchmarks.stopwords [--corpus queries.txt]
+"""
+
+import argparse
+import statistics
+import time
+
+from backend import stopwords
+
+QUERIES = [
+    "What is the revenue of Apple's Q3?",
+    "Why don't they publish state-of-the-art results?",
+    "How many employees were there in the U.S. in 2023?",
+    "Percentage of women in management positions",
+    "What's the total energy consumption (in GWh) per year?",
+    "Can't find the table with the dividend per share",
+    "Show me the organisational chart",
+    "Which countries have the highest CO2 emissions?",
+    "the",
+    "How does the company handle cybersecurity risks?",
+    "What are the key figures for 2022/2023?",
+    "Is there a breakdown by region: Europe, Asia and Americas?",
+    "I'd like to see the net profit margin",
+    "They're reporting EBITDA of 1.2bn, aren't they?",
+    "What was the impact of COVID-19 on operations?",
+]
+
+
+def time_per_query(fn, queries: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            fn(query)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--corpus", help="File with one query per line")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--show", type=int, default=10, help="Number of mismatches to print")
+    args = parser.parse_args()
+
+    queries = list(QUERIES)
+    if args.corpus:
+        with open(args.corpus) as f:
+            queries.extend(line.strip() for line in f if line.strip())
+
+    start = time.perf_counter()
+    stopwords.load_spacy()
+    print(f"spaCy load time: {time.perf_counter() - start:.2f} s")
+
+    mismatches = [
+        (query, fast, spacy)
+        for query in queries
+        if (fast := stopwords._filter_fast(query)) != (spacy := stopwords._filter_spacy(query))
+    ]
+    agreement = 1 - len(mismatches) / len(queries)
+    print(f"Agreement: {agreement:.1%} of {len(queries)} queries")
+    for query, fast, spacy in mismatches[: args.show]:
+        print(f"  {query!r}\n    fast:  {fast!r}\n    spacy: {spacy!r}")
+
+    fast_times = [time_per_query(stopwords._filter_fast, queries, args.repeat) for _ in range(3)]
+    spacy_times = [time_per_query(stopwords._filter_spacy, queries, args.repeat) for _ in range(3)]
+    print(f"fast:  {statistics.median(fast_times) * 1e6:8.1f} us/query")
+    print(f"spacy: {statistics.median(spacy_times) * 1e6:8.1f} us/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -492,6 +492,17 @@ def SimMapButtonPoll(query_id, idx, token, token_idx):
     )
 
 
+def SimMapButtonUnavailable(query_id, idx, token, token_idx):
+    return Button(
+        token.replace("\u2581", ""),
+        size="sm",
+        disabled=True,
+        title="Similarity map not available",
+        id=f"sim-map-button-{query_id}-{idx}-{token_idx}-{token}",
+        cls="pointer-events-auto font-mono text-xs h-5 rounded-full px-2 p-2 ml-1 mb-1 opacity-50",
+    )
+
+
 def SearchInfo(search_time, total_count):
     return Div(
         Span(
@@ -573,13 +584,13 @@ def ChatResult(query_id: str, query: str, doc_ids: Optional[list] = None):
     messages = Div(LoadingSkeleton())
 
     if doc_ids:
+        # The answer arrives in parts, which static/js/chat.js joins
         messages = Div(
-            LoadingSkeleton(),
+            Div(LoadingSkeleton(), sse_swap="status", hx_swap="innerHTML"),
+            Div(sse_swap="delta", hx_swap="beforeend"),
             hx_ext="sse",
             sse_connect=f"/get-message?query_id={query_id}&doc_ids={','.join(doc_ids)}&query={quote_plus(query)}",
-            sse_swap="message",
             sse_close="close",
-            hx_swap="innerHTML",
         )
 
     return Div(
@@ -1,4 +1,4 @@
-from fasthtml.components import Div, H2, P, Button
+from fasthtml.components import Div, H2, P, Button, Ul, Li
 from lucide_fasthtml import Lucide
 
 def DeploymentModal():
@@ -113,3 +113,45 @@ def DeploymentErrorModal():
         ),
         cls="fixed inset-0 bg-black bg-opacity-50 backdrop-blur-sm z-40"
     )
+
+def DeploymentConfirmModal(action: str, reasons: list):
+    consequence = (
+        "Vespa will reindex the fed pages after the deploy."
+        if action == "reindex"
+        else "The fed pages have to be uploaded again after the deploy."
+    )
+    return Div(
+        Div(
+            Div(
+                Div(
+                    Lucide(icon="circle-alert", cls="size-12 text-yellow-500"),
+                    cls="flex justify-center mb-4"
+                ),
+                H2(
+                    "Schema change needs a " + ("reindex" if action == "reindex" else "re-feed"),
+                    cls="text-xl font-semibold mb-2 text-gray-900 dark:text-white"
+                ),
+                P(
+                    consequence,
+                    cls="text-gray-500 dark:text-gray-400 mb-4"
+                ),
+                Ul(
+                    *[Li(reason) for reason in reasons],
+                    cls="text-left text-sm text-gray-500 dark:text-gray-400 mb-6 list-disc pl-5"
+                ),
+                Button(
+                    "Deploy",
+                    cls="w-full p-4 bg-black text-white rounded-[10px] hover:bg-gray-800 transition-colors",
+                    onclick="confirmDeployment()"
+                ),
+                Button(
+                    "Cancel",
+                    cls="w-full p-4 bg-white text-black border rounded-[10px] hover:bg-gray-100 transition-colors mt-4",
+                    onclick="closeDeploymentModal()"
+                ),
+                cls="bg-white dark:bg-gray-900 p-8 rounded-[10px] shadow-md max-w-md w-full text-center"
+            ),
+            cls="fixed inset-0 flex items-center justify-center z-50 p-4"
+        ),
+        cls="fixed inset-0 bg-black bg-opacity-50 backdrop-blur-sm z-40"
+    )
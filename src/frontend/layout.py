@@ -3,7 +3,6 @@ from fasthtml.xtend import A, Script
 from lucide_fasthtml import Lucide
 from shad4fast import Button, Separator
 from sqlalchemy import select
-from uuid import UUID
 
 overlay_scrollbars_manager = Script(
     """
@@ -115,9 +114,8 @@ async def Links(request=None):
     username = None
     if request and "user_id" in request.session:
         try:
-            user_id = UUID(request.session["user_id"])
-            user = await request.app.db.get_user_by_id(user_id)
-            username = user.username if user else None
+            # Cached per user, so rendering the layout doesn't hit the database
+            username = await request.app.db.get_username(request.session["user_id"])
         except Exception as e:
             request.app.logger.error(f"Error getting username: {e}")
 
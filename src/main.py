@@ -4,15 +4,14 @@ import os
 import time
 import logging
 import sys
-import torch
 import pytesseract
 from io import BytesIO
+from datetime import timedelta
+from email.utils import formatdate
 from concurrent.futures import ThreadPoolExecutor
 from fasthtml.common import StaticFiles
 from pathlib import Path
 
-import google.generativeai as genai
-from fastcore.parallel import threaded
 from fasthtml.common import (
     Aside,
     Div,
@@ -24,6 +23,7 @@ from fasthtml.common import (
     Main,
     P,
     Redirect,
+    Response,
     Script,
     StreamingResponse,
     fast_app,
@@ -33,10 +33,28 @@ from PIL import Image
 from shad4fast import ShadHead
 from sqlalchemy import select
 from backend.auth import verify_password
+from backend.cache import LRUCache
+from backend.disk_cache import DiskCache
+from backend.encoder_scheduler import EncoderScheduler
+from backend.image_derivatives import (
+    DERIVATIVE_FORMATS,
+    DERIVATIVE_WIDTHS,
+    derivative_name,
+    get_or_create_derivative,
+    parse_derivative_filename,
+    srcset as derivative_srcset,
+)
+from backend.image_availability import ImageAvailability
 from backend.database import Database
 from backend.models import User
 
 from backend.colpali import SimMapGenerator
+from backend.model_loader import ModelLoader
+from backend.patch_pooling import reduce_image_query
+from backend.query_embedding_cache import QueryEmbeddingCache
+import backend.stopwords
+from backend.sim_map_pool import SimMapWorkerPool
+from backend.suggestions import SuggestionIndex
 from backend.vespa_app import VespaQueryClient
 from backend.models import UserSettings
 from frontend.app import (
@@ -47,11 +65,12 @@ from frontend.app import (
     SearchResult,
     SimMapButtonPoll,
     SimMapButtonReady,
+    SimMapButtonUnavailable,
 )
 from frontend.layout import Layout
 from frontend.components.login import Login
 from backend.middleware import login_required
-from backend.init_db import init_default_users, clear_image_queries
+from backend.init_db import init_default_users, migrate_image_queries
 from frontend.components.my_documents import (
     MyDocuments,
     DocumentProcessingModal,
@@ -61,8 +80,7 @@ from frontend.components.my_documents import (
 )
 from frontend.components.settings import Settings, TabContent
 from backend.deploy import deploy_application_step_1, deploy_application_step_2
-from backend.feed import feed_documents_to_vespa, remove_document_from_vespa
-from frontend.components.deployment import DeploymentModal, DeploymentLoginModal,DeploymentSuccessModal, DeploymentErrorModal
+from frontend.components.deployment import DeploymentModal, DeploymentLoginModal,DeploymentSuccessModal, DeploymentErrorModal, DeploymentConfirmModal
 from frontend.components.image_search import ImageSearchModal
 
 highlight_js_theme_link = Link(id="highlight-theme", rel="stylesheet", href="")
@@ -93,6 +111,7 @@ sselink = Script(src="https://unpkg.com/htmx-ext-sse@2.2.1/sse.js")
 deployment_js = Script(src="/static/js/deployment.js")
 upload_documents_js = Script(src="/static/js/upload-documents.js")
 image_search_js = Script(src="/static/js/image-search.js")
+chat_js = Script(src="/static/js/chat.js")
 
 # Get log level from environment variable, default to INFO
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -129,11 +148,18 @@ app, rt = fast_app(
         deployment_js,
         upload_documents_js,
         image_search_js,
+        chat_js,
     ),
 )
 thread_pool = ThreadPoolExecutor()
 app.deployed = False
 app.results_cache = {}  # Initialize the results cache
+# Sim map summary features per query_id, fetched together with the search results
+app.sim_map_features_cache = LRUCache(
+    max_size=int(os.getenv("SIM_MAP_FEATURES_CACHE_SIZE", "128"))
+)
+# Gemini answers per query and pages, so repeating a search does not generate the answer again
+app.answer_cache = LRUCache(max_size=int(os.getenv("ANSWER_CACHE_SIZE", "256")))
 
 def configure_static_routes(app):
     os.makedirs("storage", exist_ok=True)
@@ -143,6 +169,8 @@ configure_static_routes(app)
 
 # Gemini config
 def configure_gemini(api_key: str):
+    import google.generativeai as genai
+
     genai.configure(api_key=api_key)
     GEMINI_SYSTEM_PROMPT = """If the user query is a question, try your best to answer it based on the provided images.
     If the user query can not be interpreted as a question, or if the answer to the query can not be inferred from the images,
@@ -159,31 +187,172 @@ def configure_gemini(api_key: str):
 STATIC_DIR = Path("static")
 IMG_DIR = STATIC_DIR / "full_images"
 SIM_MAP_DIR = STATIC_DIR / "sim_maps"
-os.makedirs(IMG_DIR, exist_ok=True)
-os.makedirs(SIM_MAP_DIR, exist_ok=True)
+# Full page images downloaded from Vespa and generated sim maps, bounded in size with LRU and TTL eviction
+img_cache = DiskCache(
+    IMG_DIR,
+    max_bytes=int(os.getenv("FULL_IMAGE_CACHE_MAX_BYTES", str(2 * 1024**3))),
+    ttl_seconds=float(os.getenv("FULL_IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    logger=logger,
+)
+sim_map_cache = DiskCache(
+    SIM_MAP_DIR,
+    max_bytes=int(os.getenv("SIM_MAP_CACHE_MAX_BYTES", str(1024**3))),
+    ttl_seconds=float(os.getenv("SIM_MAP_CACHE_TTL_SECONDS", str(24 * 3600))),
+    logger=logger,
+)
+# Downscaled WebP/JPEG renditions of the full images, served with long browser cache lifetimes
+page_image_cache = DiskCache(
+    STATIC_DIR / "page_images",
+    max_bytes=int(os.getenv("PAGE_IMAGE_CACHE_MAX_BYTES", str(1024**3))),
+    ttl_seconds=float(os.getenv("PAGE_IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    logger=logger,
+)
+PAGE_IMAGE_MAX_AGE = 365 * 24 * 3600
+DISK_CACHE_SWEEP_INTERVAL = int(os.getenv("DISK_CACHE_SWEEP_INTERVAL_SECONDS", "600"))
+# Image queries are only needed while their results are being browsed
+IMAGE_QUERY_TTL = timedelta(hours=float(os.getenv("IMAGE_QUERY_TTL_HOURS", "24")))
+IMAGE_QUERY_PURGE_INTERVAL = int(os.getenv("IMAGE_QUERY_PURGE_INTERVAL_SECONDS", "3600"))
+# Full images being downloaded, shared by the chat, the page image route and the sim map workers
+image_availability = ImageAvailability()
+FULL_IMAGE_WAIT_SECONDS = float(os.getenv("FULL_IMAGE_WAIT_SECONDS", "10"))
+# Pages are sent to Gemini as JPEG derivatives of this width, one of DERIVATIVE_WIDTHS
+GEMINI_IMAGE_WIDTH = int(os.getenv("GEMINI_IMAGE_WIDTH", "1024"))
+GEMINI_MAX_IMAGES = 3
 
 app.db = Database()
+app.sim_map_pool = SimMapWorkerPool(
+    logger=logger,
+    num_workers=int(os.getenv("SIM_MAP_WORKERS", "2")),
+    max_queue_size=int(os.getenv("SIM_MAP_QUEUE_SIZE", "32")),
+)
+# Sim maps rendered per query, most useful first, 0 renders all of them. While other queries wait for a
+# worker, a query stops after SIM_MAP_RENDER_BUDGET_UNDER_LOAD maps.
+SIM_MAP_RENDER_BUDGET = int(os.getenv("SIM_MAP_RENDER_BUDGET", "0"))
+SIM_MAP_RENDER_BUDGET_UNDER_LOAD = int(os.getenv("SIM_MAP_RENDER_BUDGET_UNDER_LOAD", "5"))
+# Autocomplete index over the generated questions, built from Vespa after deployment
+app.suggestion_index = SuggestionIndex(
+    logger=logger, cache_size=int(os.getenv("SUGGESTION_CACHE_SIZE", "512"))
+)
+MAX_SUGGESTIONS = int(os.getenv("MAX_SUGGESTIONS", "20"))
+# Image queries are reduced to this many pooled patch vectors, see backend.patch_pooling
+IMAGE_QUERY_POOLING = os.getenv("IMAGE_QUERY_POOLING", "kmeans")
+IMAGE_QUERY_MAX_PATCHES = int(
+    os.getenv("IMAGE_QUERY_MAX_PATCHES", str(VespaQueryClient.MAX_QUERY_TERMS))
+)
+IMAGE_QUERY_MIN_PATCH_STD = float(os.getenv("IMAGE_QUERY_MIN_PATCH_STD", "4.0"))
+# Pages are fed with about 1/FEED_PATCH_POOL_FACTOR of their patch vectors, 1 feeds all of them
+FEED_PATCH_POOL_FACTOR = float(os.getenv("FEED_PATCH_POOL_FACTOR", "1"))
+
+@app.on_event("startup")
+async def settings_cache_listener():
+    # Other workers announce settings changes through Postgres, so their cached copies are dropped
+    if os.getenv("SETTINGS_CACHE_NOTIFY", "false").lower() == "true":
+        await app.db.start_settings_listener()
+
 
 @app.on_event("shutdown")
-def shutdown_db():
-    app.db.close()
+async def shutdown_db():
+    await app.db.close()
+
+# Query embeddings shared by all workers on this host and kept across restarts
+query_embedding_cache = QueryEmbeddingCache(
+    Path(os.getenv("QUERY_EMBEDDING_CACHE_PATH", "storage/query_embeddings.sqlite3")),
+    logger=logger,
+    max_entries=int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", "10000")),
+)
+
+
+# Searches get the model ahead of document uploads, which are encoded one page batch at a time
+encoder_scheduler = EncoderScheduler(
+    logger=logger,
+    query_concurrency=int(os.getenv("QUERY_ENCODER_CONCURRENCY", "1")),
+    max_page_jobs=int(os.getenv("PAGE_ENCODER_MAX_JOBS", "1")),
+)
+
+
+def load_models() -> SimMapGenerator:
+    backend.stopwords.load()
+    sim_map_generator = SimMapGenerator(
+        logger=logger,
+        query_cache=query_embedding_cache,
+        precision=os.getenv("COLPALI_PRECISION", "fp32"),
+        scheduler=encoder_scheduler,
+    )
+    SimMapGenerator.colormap(0.0)  # Warm up matplotlib
+    return sim_map_generator
+
+
+# The model is loaded in the background so login and static pages are served right away, see /readyz
+app.model_loader = ModelLoader(logger=logger, load_fn=load_models)
+MODEL_WAIT_TIMEOUT = float(os.getenv("MODEL_WAIT_TIMEOUT_SECONDS", "60"))
+
+
+async def get_sim_map_generator() -> SimMapGenerator:
+    """Wait for the background model load to finish, raising TimeoutError or RuntimeError if it doesn't"""
+    return await app.model_loader.wait(MODEL_WAIT_TIMEOUT)
+
 
 @app.on_event("startup")
 def load_model_on_startup():
-    app.sim_map_generator = SimMapGenerator(logger=logger)
+    app.model_loader.start()
+    return
+
+async def warm_query_embedding_cache(questions: list = None):
+    """Encode the demo questions (of all users by default) that are not in the query embedding cache yet"""
+    try:
+        sim_map_generator = await app.model_loader.wait(timeout=None)
+        if questions is None:
+            questions = await app.db.get_all_demo_questions()
+        encoded = await asyncio.to_thread(sim_map_generator.warm_query_cache, questions)
+        logger.info(f"Warmed query embedding cache, encoded {encoded} of {len(questions)} demo questions")
+    except Exception as e:
+        logger.error(f"Error warming query embedding cache: {str(e)}")
+
+
+@app.on_event("startup")
+async def warm_query_embeddings_on_startup():
+    asyncio.create_task(warm_query_embedding_cache())
     return
 
+
+@app.on_event("startup")
+def start_sim_map_pool():
+    app.sim_map_pool.start()
+
+
+@app.on_event("shutdown")
+def stop_sim_map_pool():
+    app.sim_map_pool.stop()
+
+
+@app.on_event("shutdown")
+def close_query_embedding_cache():
+    query_embedding_cache.close()
+
+
 @app.on_event("startup")
 async def keepalive():
     asyncio.create_task(poll_vespa_keepalive())
     return
 
 
+@app.on_event("startup")
+async def disk_cache_sweeper():
+    asyncio.create_task(sweep_disk_caches())
+    return
+
+
+@app.on_event("startup")
+async def image_query_purger():
+    asyncio.create_task(purge_image_queries())
+    return
+
+
 @app.on_event("startup")
 async def startup_event():
     try:
         os.environ["USE_MTLS"] = "true"
-        await clear_image_queries(logger)
+        await migrate_image_queries(logger)
         await init_default_users(logger, app.db)
     except SystemExit:
         logger.error("Application Startup Failed")
@@ -278,7 +447,7 @@ async def get(request, query: str = "", ranking: str = "colpali", image_query: s
                 )
 
             logger.info(f"Found image query data: visual_only={image_query_data.is_visual_only}")
-            embeddings = torch.tensor(image_query_data.embeddings)
+            embeddings = image_query_data.embedding_array()
 
             # Use the appropriate query method based on visual_only flag
             app = request.app.vespa_app
@@ -303,6 +472,9 @@ async def get(request, query: str = "", ranking: str = "colpali", image_query: s
             # Process the Vespa response
             if not response or 'root' not in response:
                 raise ValueError("Invalid response from Vespa")
+            request.app.sim_map_features_cache.set(
+                query_id, request.app.vespa_app.extract_sim_maps(response)
+            )
 
             root = response['root']
             if 'children' not in root:
@@ -368,20 +540,30 @@ async def get(session, request, query: str, ranking: str):
     query_id = generate_query_id(query, ranking)
     logger.info(f"Query id in /fetch_results: {query_id}")
 
+    try:
+        sim_map_generator = await get_sim_map_generator()
+    except (TimeoutError, RuntimeError) as e:
+        logger.warning(f"Cannot serve query_id {query_id}: {str(e)}")
+        return Div(P(str(e)), cls="p-4")
+
     # Run the embedding and query against Vespa app
     start_inference = time.perf_counter()
-    q_embs, idx_to_token = app.sim_map_generator.get_query_embeddings_and_token_map(query)
+    # In a thread, so waiting for the encoder behind a page batch doesn't block the event loop
+    q_embs, idx_to_token = await asyncio.to_thread(
+        sim_map_generator.get_query_embeddings_and_token_map, query
+    )
     end_inference = time.perf_counter()
     logger.info(f"Inference time for query_id: {query_id} \t {end_inference - start_inference:.2f} seconds")
 
     start = time.perf_counter()
-    # Fetch real search results from Vespa
+    # Fetch real search results from Vespa, together with the summary features used for the sim maps
     result = await app.vespa_app.get_result_from_query(
         query=query,
         q_embs=q_embs,
-        ranking=ranking,
+        ranking=f"{ranking}_sim",
         idx_to_token=idx_to_token,
     )
+    app.sim_map_features_cache.set(query_id, app.vespa_app.extract_sim_maps(result))
     end = time.perf_counter()
     logger.info(f"Search results fetched in {end - start:.2f} seconds. Vespa search time: {result['timing']['searchtime']}")
     search_time = result["timing"]["searchtime"]
@@ -400,6 +582,7 @@ async def get(session, request, query: str, ranking: str):
         ranking=ranking,
         idx_to_token=idx_to_token,
         doc_ids=[result["fields"]["id"] for result in search_results],
+        owner=session.get("user_id"),
     )
     return SearchResult(search_results, query, query_id, search_time, total_count)
 
@@ -413,6 +596,24 @@ def get_results_children(result):
     return search_results
 
 
+async def sweep_disk_caches():
+    while True:
+        await asyncio.sleep(DISK_CACHE_SWEEP_INTERVAL)
+        for cache in (img_cache, sim_map_cache, page_image_cache):
+            await asyncio.to_thread(cache.sweep)
+
+
+async def purge_image_queries():
+    while True:
+        await asyncio.sleep(IMAGE_QUERY_PURGE_INTERVAL)
+        try:
+            deleted = await app.db.purge_image_queries(IMAGE_QUERY_TTL)
+            if deleted:
+                logger.info(f"Purged {deleted} expired image queries")
+        except Exception as e:
+            logger.error(f"Error purging image queries: {str(e)}")
+
+
 async def poll_vespa_keepalive():
     while True:
         await asyncio.sleep(5)
@@ -421,45 +622,106 @@ async def poll_vespa_keepalive():
             logger.debug(f"Vespa keepalive: {time.time()}")
 
 
-@threaded
+def full_image_name(doc_id: str) -> str:
+    return f"{doc_id}.jpg"
+
+
+def sim_map_file_name(query_id: str, idx: int, token_idx: int) -> str:
+    return f"{query_id}_{idx}_{token_idx}.png"
+
+
+async def fetch_missing_full_images(doc_ids: list) -> list:
+    """
+    Download the full images that are not yet cached on disk, using a single Vespa query.
+    Images that are already being downloaded elsewhere are waited for, up to FULL_IMAGE_WAIT_SECONDS.
+
+    Returns:
+        list: The doc_ids that are still missing afterwards.
+    """
+    def is_cached(doc_id):
+        return img_cache.contains(full_image_name(doc_id))
+
+    claimed, waiting = image_availability.claim(doc_ids, is_cached)
+    try:
+        if claimed:
+            logger.info(f"Downloading {len(claimed)} missing images...")
+            images = await app.vespa_app.get_full_images_from_vespa(claimed)
+            for doc_id, image_data in images.items():
+                img_cache.write(full_image_name(doc_id), base64.b64decode(image_data))
+                logger.debug(f"Downloaded image for doc_id: {doc_id}")
+    finally:
+        for doc_id in claimed:
+            image_availability.release(doc_id)
+    if waiting:
+        await asyncio.wait(waiting, timeout=FULL_IMAGE_WAIT_SECONDS)
+    return [doc_id for doc_id in doc_ids if not is_cached(doc_id)]
+
+
+def gemini_image(doc_id: str) -> Image.Image:
+    """The downscaled page image sent to Gemini, rendered from the full image once and cached"""
+    path = get_or_create_derivative(
+        page_image_cache, img_cache.path(full_image_name(doc_id)), doc_id, GEMINI_IMAGE_WIDTH, "jpeg"
+    )
+    with Image.open(path) as image:
+        image.load()
+        return image
+
+
 def get_and_store_sim_maps(
-    query_id, query: str, q_embs, ranking, idx_to_token, doc_ids
+    query_id, query: str, q_embs, ranking, idx_to_token, doc_ids, owner=None
 ):
-    try:
-        logger.info(f"Starting sim map generation for query_id: {query_id}")
-        ranking_sim = ranking + "_sim"
-        vespa_sim_maps = app.vespa_app.get_sim_maps_from_query(
+    """
+    Queue sim map generation for a query on the sim map worker pool.
+    Only one job per query_id is queued or running at a time.
+    """
+    async def job(is_cancelled):
+        return await generate_and_store_sim_maps(
+            query_id=query_id,
             query=query,
             q_embs=q_embs,
-            ranking=ranking_sim,
+            ranking=ranking,
             idx_to_token=idx_to_token,
+            doc_ids=doc_ids,
+            is_cancelled=is_cancelled,
         )
-        logger.info(f"Retrieved {len(vespa_sim_maps)} sim maps from Vespa")
 
-        img_paths = [IMG_DIR / f"{doc_id}.jpg" for doc_id in doc_ids]
-        logger.info(f"Checking for images at paths: {img_paths}")
+    if not app.sim_map_pool.submit(query_id, job, owner=owner):
+        logger.debug(f"Sim map generation already in progress for query_id: {query_id}")
+
+
+async def generate_and_store_sim_maps(
+    query_id, query: str, q_embs, ranking, idx_to_token, doc_ids, is_cancelled
+):
+    try:
+        logger.info(f"Starting sim map generation for query_id: {query_id}")
+        vespa_sim_maps = app.sim_map_features_cache.get(query_id)
+        if vespa_sim_maps is None:
+            # Evicted from the cache, so the summary features have to be fetched again
+            ranking_sim = ranking + "_sim"
+            vespa_sim_maps = await app.vespa_app.get_sim_maps_from_query(
+                query=query,
+                q_embs=q_embs,
+                ranking=ranking_sim,
+                idx_to_token=idx_to_token,
+            )
+            logger.info(f"Retrieved {len(vespa_sim_maps)} sim maps from Vespa")
+        if is_cancelled():
+            logger.info(f"Sim map generation cancelled for query_id: {query_id}")
+            return False
 
         # Download any missing images first
-        missing_images = [(doc_id, path) for doc_id, path in zip(doc_ids, img_paths) if not os.path.exists(path)]
+        try:
+            missing_images = await fetch_missing_full_images(doc_ids)
+        except Exception as e:
+            logger.error(f"Failed to download images for query_id {query_id}: {str(e)}")
+            return False
         if missing_images:
-            logger.info(f"Downloading {len(missing_images)} missing images...")
-            for doc_id, path in missing_images:
-                try:
-                    image_data = asyncio.run(app.vespa_app.get_full_image_from_vespa(doc_id))
-                    with open(path, "wb") as f:
-                        f.write(base64.b64decode(image_data))
-                    logger.debug(f"Downloaded image for doc_id: {doc_id}")
-                except Exception as e:
-                    logger.error(f"Failed to download image for doc_id {doc_id}: {str(e)}")
-                    return False
-
-        # Verify all images are now available
-        if not all([os.path.exists(img_path) for img_path in img_paths]):
-            logger.error("Some images still missing after download attempt")
+            logger.error(f"Images still missing after download attempt: {missing_images}")
             return False
+        img_paths = [img_cache.path(full_image_name(doc_id)) for doc_id in doc_ids]
 
         logger.debug("All images found, generating similarity maps")
-        sim_map_generator = app.sim_map_generator.gen_similarity_maps(
+        sim_map_generator = (await get_sim_map_generator()).gen_similarity_maps(
             query=query,
             query_embs=q_embs,
             token_idx_map=idx_to_token,
@@ -467,16 +729,27 @@ def get_and_store_sim_maps(
             vespa_sim_maps=vespa_sim_maps,
         )
 
+        rendered = 0
         for idx, token, token_idx, blended_img_base64 in sim_map_generator:
-            sim_map_path = SIM_MAP_DIR / f"{query_id}_{idx}_{token_idx}.png"
+            if is_cancelled():
+                logger.info(f"Sim map generation cancelled for query_id: {query_id}")
+                return False
+            sim_map_name = sim_map_file_name(query_id, idx, token_idx)
             try:
-                with open(sim_map_path, "wb") as f:
-                    f.write(base64.b64decode(blended_img_base64))
+                sim_map_cache.write(sim_map_name, base64.b64decode(blended_img_base64))
                 logger.info(
                     f"Sim map saved to disk for query_id: {query_id}, idx: {idx}, token: {token}"
                 )
             except Exception as e:
-                logger.error(f"Error saving sim map to {sim_map_path}: {str(e)}")
+                logger.error(f"Error saving sim map {sim_map_name}: {str(e)}")
+            rendered += 1
+            # The remaining maps are the least useful ones, their buttons show as unavailable
+            if SIM_MAP_RENDER_BUDGET and rendered >= SIM_MAP_RENDER_BUDGET:
+                logger.info(f"Sim map budget of {rendered} maps reached for query_id: {query_id}")
+                break
+            if rendered >= SIM_MAP_RENDER_BUDGET_UNDER_LOAD and app.sim_map_pool.queue_depth() > 0:
+                logger.info(f"Stopping sim maps after {rendered} maps for query_id: {query_id}, other queries are waiting")
+                break
 
         logger.info(f"Completed sim map generation for query_id: {query_id}")
         return True
@@ -494,8 +767,16 @@ async def get_sim_map(request, query_id: str, idx: int, token: str, token_idx: i
     when it is ready. If it is not ready, returns a SimMapButtonPoll, that
     continues to poll every 1 second.
     """
-    sim_map_path = SIM_MAP_DIR / f"{query_id}_{idx}_{token_idx}.png"
-    if not os.path.exists(sim_map_path):
+    sim_map_path = sim_map_cache.get(sim_map_file_name(query_id, idx, token_idx))
+    if sim_map_path is None:
+        job_status = app.sim_map_pool.status(query_id)
+        if job_status is not None and job_status not in ("queued", "running"):
+            # The job has finished, was cancelled or dropped, so this sim map will not appear
+            return SimMapButtonUnavailable(
+                query_id=query_id, idx=idx, token=token, token_idx=token_idx
+            )
+        # The user is looking at this query, so render its sim maps before others
+        app.sim_map_pool.promote(query_id)
         logger.debug(
             f"Sim map not ready for query_id: {query_id}, idx: {idx}, token: {token}"
         )
@@ -512,94 +793,203 @@ async def get_sim_map(request, query_id: str, idx: int, token: str, token_idx: i
         )
 
 
+@rt("/sim_map_stats")
+@login_required
+async def sim_map_stats(request):
+    """Backpressure metrics for the sim map worker pool"""
+    return JSONResponse(app.sim_map_pool.metrics())
+
+
+@rt("/encoder_stats")
+@login_required
+async def encoder_stats(request):
+    """Wait and run times of query and page forward passes on the shared model"""
+    return JSONResponse(encoder_scheduler.metrics())
+
+
+@rt("/db_pool_stats")
+@login_required
+async def db_pool_stats(request):
+    """Database connection pool usage and wait times of this worker"""
+    return JSONResponse(app.db.pool_stats())
+
+
+@rt("/query_budget_stats")
+@login_required
+async def query_budget_stats(request):
+    """Query tiers in use and the ranking parameters chosen for recent queries"""
+    if not hasattr(app, "vespa_app"):
+        return JSONResponse({"error": "Application not deployed"}, status_code=503)
+    return JSONResponse(app.vespa_app.query_budget.stats())
+
+
+@rt("/cache_stats")
+@login_required
+async def cache_stats(request):
+    """Size and hit statistics for the on-disk caches"""
+    return JSONResponse(
+        {
+            "full_images": img_cache.stats(),
+            "sim_maps": sim_map_cache.stats(),
+            "query_embeddings": query_embedding_cache.stats(),
+            "page_images": page_image_cache.stats(),
+        }
+    )
+
+
 @rt("/full_image")
 async def full_image(doc_id: str):
     """
     Endpoint to get the full quality image for a given result id.
+    The browser picks the smallest page image derivative that fits the result view.
     """
-    img_path = IMG_DIR / f"{doc_id}.jpg"
-    if not os.path.exists(img_path):
-        image_data = await app.vespa_app.get_full_image_from_vespa(doc_id)
-        # image data is base 64 encoded string. Save it to disk as jpg.
-        with open(img_path, "wb") as f:
-            f.write(base64.b64decode(image_data))
-        logger.debug(f"Full image saved to disk for doc_id: {doc_id}")
-    else:
-        with open(img_path, "rb") as f:
-            image_data = base64.b64encode(f.read()).decode("utf-8")
     return Img(
-        src=f"data:image/jpeg;base64,{image_data}",
+        src=f"/page_image/{doc_id}/{DERIVATIVE_WIDTHS[-1]}.jpeg",
+        srcset=derivative_srcset(doc_id, "webp"),
+        sizes="(min-width: 1280px) 640px, (min-width: 768px) 50vw, 100vw",
         alt="something",
         cls="result-image w-full h-full object-contain",
     )
 
 
+@rt("/page_image/{doc_id}/{filename}")
+async def page_image(request, doc_id: str, filename: str):
+    """
+    Serve a downscaled WebP or JPEG rendition of a page image, e.g. /page_image/<doc_id>/640.webp.
+    Derivatives are generated from the cached full image on first access.
+    """
+    parsed = parse_derivative_filename(filename)
+    if parsed is None:
+        return Response(status_code=404)
+    width, fmt = parsed
+
+    name = derivative_name(doc_id, width, fmt)
+    path = page_image_cache.get(name)
+    if path is None:
+        missing = await fetch_missing_full_images([doc_id])
+        if missing:
+            return Response(status_code=404)
+        path = await asyncio.to_thread(
+            get_or_create_derivative,
+            page_image_cache,
+            img_cache.path(full_image_name(doc_id)),
+            doc_id,
+            width,
+            fmt,
+        )
+
+    stat = os.stat(path)
+    etag = f'"{name}-{stat.st_size}-{int(stat.st_mtime)}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": f"public, max-age={PAGE_IMAGE_MAX_AGE}, immutable",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=DERIVATIVE_FORMATS[fmt][1], headers=headers)
+
+
+@rt("/healthz")
+async def healthz():
+    """Liveness probe, the web server is up"""
+    return JSONResponse({"status": "ok"})
+
+
+@rt("/readyz")
+async def readyz():
+    """Readiness probe, the model is loaded and searches can be served"""
+    status = app.model_loader.status()
+    return JSONResponse(status, status_code=200 if app.model_loader.ready else 503)
+
+
 @rt("/suggestions")
-async def get_suggestions(query: str = ""):
+async def get_suggestions(request, query: str = ""):
     """Endpoint to get suggestions as user types in the search box"""
     query = query.lower().strip()
 
     if query:
-        suggestions = await app.vespa_app.get_suggestions(query)
+        if app.suggestion_index.ready:
+            suggestions = app.suggestion_index.lookup(
+                query, owner=request.session.get("user_id"), limit=MAX_SUGGESTIONS
+            )
+        else:
+            # Index is still being built, fall back to a (slow) regex match in Vespa
+            suggestions = await app.vespa_app.get_suggestions(query)
         if len(suggestions) > 0:
             return JSONResponse({"suggestions": suggestions})
 
     return JSONResponse({"suggestions": []})
 
 
-async def message_generator(query_id: str, query: str, doc_ids: list):
-    """Generator function to yield SSE messages for chat response"""
-    images = []
-    num_images = min(3, len(doc_ids))  # Use min to avoid index out of range
-    max_wait = 10  # seconds
-    start_time = time.time()
-
-    # Check if full images are ready on disk
-    while (
-        len(images) < num_images
-        and time.time() - start_time < max_wait
-    ):
-        images = []
-        for idx in range(num_images):
-            image_filename = IMG_DIR / f"{doc_ids[idx]}.jpg"
-            if not os.path.exists(image_filename):
-                logger.debug(
-                    f"Message generator: Full image not ready for query_id: {query_id}, idx: {idx}"
-                )
-                continue
-            else:
-                logger.debug(
-                    f"Message generator: image ready for query_id: {query_id}, idx: {idx}"
-                )
-                images.append(Image.open(image_filename))
-        if len(images) < num_images:
-            await asyncio.sleep(0.2)
+async def build_suggestion_index():
+    try:
+        owners = await app.db.get_document_owners()
+        questions = await asyncio.to_thread(app.vespa_app.visit_questions)
+        await asyncio.to_thread(
+            app.suggestion_index.build,
+            [(doc_id, doc_questions, owners.get(doc_id)) for doc_id, doc_questions in questions.items()],
+        )
+    except Exception as e:
+        logger.error(f"Error building suggestion index: {str(e)}")
 
-    # yield message with number of images ready
-    yield f"event: message\ndata: Generating response based on {len(images)} images...\n\n"
-    if not images:
-        yield "event: message\ndata: Failed to send images to Gemini-8B!\n\n"
-        yield "event: close\ndata: \n\n"
-        return
 
-    # If newlines are present in the response, the connection will be closed.
-    def replace_newline_with_br(text):
-        return text.replace("\n", "<br>")
+def sse_event(event: str, data: str) -> str:
+    # A newline in the data would end the event, and the answer is HTML anyway
+    data = data.replace("\n", "<br>")
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def message_generator(query_id: str, query: str, doc_ids: list):
+    """
+    Generator function to yield SSE messages for chat response.
 
+    `status` events replace the status line, `delta` events are the next part of the answer.
+    """
+    page_ids = doc_ids[:GEMINI_MAX_IMAGES]
     # If query is empty (visual search), use a default prompt
     if not query.strip():
         query = "Describe what you see in these images and their key visual elements."
+    answer_key = f"{query.strip()}|{','.join(page_ids)}"
+    cached = app.answer_cache.get(answer_key)
+    if cached is not None:
+        logger.debug(f"Message generator: cached answer for query_id: {query_id}")
+        yield sse_event("status", "")
+        yield sse_event("delta", cached)
+        yield sse_event("close", "")
+        return
+
+    # Starts as soon as the images are on disk, downloading them unless the sim map job already is
+    try:
+        missing = set(await fetch_missing_full_images(page_ids))
+    except Exception as e:
+        logger.error(f"Message generator: failed to download images for query_id {query_id}: {str(e)}")
+        missing = set(page_ids)
+    if missing:
+        logger.debug(f"Message generator: images not ready for query_id: {query_id}: {sorted(missing)}")
+    images = await asyncio.to_thread(
+        lambda: [gemini_image(doc_id) for doc_id in page_ids if doc_id not in missing]
+    )
+
+    yield sse_event("status", f"Generating response based on {len(images)} images...")
+    if not images:
+        yield sse_event("status", "Failed to send images to Gemini-8B!")
+        yield sse_event("close", "")
+        return
 
     response_text = ""
     async for chunk in await app.gemini_model.generate_content_async(
         images + ["\n\n Query: ", query], stream=True
     ):
         if chunk.text:
+            if not response_text:
+                yield sse_event("status", "")
             response_text += chunk.text
-            response_text = replace_newline_with_br(response_text)
-            yield f"event: message\ndata: {response_text}\n\n"
-            await asyncio.sleep(0.1)
-    yield "event: close\ndata: \n\n"
+            yield sse_event("delta", chunk.text)
+    # Only complete answers are cached, an interrupted stream raises before this
+    if len(images) == len(page_ids):
+        app.answer_cache.set(answer_key, response_text)
+    yield sse_event("close", "")
 
 
 @rt("/get-message")
@@ -701,18 +1091,43 @@ async def upload_files(request):
                 )
                 doc_names[document_id] = file.filename
 
-        model = app.sim_map_generator.model
-        processor = app.sim_map_generator.processor
+        try:
+            sim_map_generator = await get_sim_map_generator()
+        except (TimeoutError, RuntimeError) as e:
+            logger.error(f"Cannot process documents: {str(e)}")
+            for doc_id in doc_names.keys():
+                await app.db.delete_document(doc_id)
+            return {"status": "error", "message": str(e)}
+        model = sim_map_generator.model
+        processor = sim_map_generator.processor
+
+        from backend.feed import feed_documents_to_vespa
+
+        def feed():
+            with encoder_scheduler.page_job():
+                return feed_documents_to_vespa(
+                    settings,
+                    user_id,
+                    model,
+                    processor,
+                    doc_names,
+                    scheduler=encoder_scheduler,
+                    pool_factor=FEED_PATCH_POOL_FACTOR,
+                )
 
         try:
-            result = feed_documents_to_vespa(settings, user_id, model, processor, doc_names)
+            result = await asyncio.to_thread(feed)
             if result["status"] == "error":
                 logger.error(f"Error during vespa feed: {result['message']}")
-                # Clean up documents on error
+                # Clean up documents on error, including pages that were fed before the error
+                if hasattr(app, "vespa_app"):
+                    await app.vespa_app.remove_pages(list(doc_names.keys()))
                 logger.info(f"Deleting {len(doc_names)} documents from database")
                 for doc_id in doc_names.keys():
                     await app.db.delete_document(doc_id)
                 return result
+            for doc_id, questions in result.get("questions", {}).items():
+                app.suggestion_index.add_document(doc_id, questions, owner=user_id)
             return {"status": "success"}
 
         except Exception as e:
@@ -727,6 +1142,13 @@ async def upload_files(request):
         logger.error(f"Error during file upload: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+async def get_vespa_client(settings: UserSettings) -> VespaQueryClient:
+    """The client of the deployed application, connecting with the user's settings if there is none yet"""
+    if not hasattr(app, "vespa_app"):
+        app.vespa_app = await asyncio.to_thread(VespaQueryClient, logger=logger, settings=settings)
+    return app.vespa_app
+
+
 @rt("/delete-document/{document_id}", methods=["DELETE"])
 @login_required
 async def delete_document(request, document_id: str):
@@ -739,12 +1161,14 @@ async def delete_document(request, document_id: str):
             logger.error("Settings not found")
             return {"status": "error", "message": "Settings not found"}
 
-        vespa_result = remove_document_from_vespa(settings, document_id)
+        vespa_app = await get_vespa_client(settings)
+        vespa_result = await vespa_app.remove_pages([document_id])
         if vespa_result["status"] == "error":
             logger.error(f"Error removing document from Vespa: {vespa_result['message']}")
             return vespa_result
 
         await app.db.delete_document(document_id)
+        app.suggestion_index.remove_document(document_id)
         return {"status": "success"}
 
     except Exception as e:
@@ -758,8 +1182,7 @@ async def get(request):
     tab = request.query_params.get("tab", "demo-questions")
 
     if "username" not in request.session:
-        user = await request.app.db.get_user_by_id(user_id)
-        request.session["username"] = user.username if user else None
+        request.session["username"] = await request.app.db.get_username(user_id)
 
     if request.session["username"] != "admin" and tab == "prompt":
         tab = "demo-questions"
@@ -788,8 +1211,7 @@ async def get_settings_content(request):
     tab = request.query_params.get("tab", "demo-questions")
 
     if "username" not in request.session:
-        user = await request.app.db.get_user_by_id(user_id)
-        request.session["username"] = user.username if user else None
+        request.session["username"] = await request.app.db.get_username(user_id)
 
     if request.session["username"] != "admin" and tab == "prompt":
         tab = "demo-questions"
@@ -815,7 +1237,14 @@ async def update_users(request):
     form = await request.form()
 
     try:
-        await request.app.db.update_users(dict(form))
+        deleted_documents = await request.app.db.update_users(dict(form))
+        for user_id, document_ids in deleted_documents.items():
+            for document_id in document_ids:
+                app.suggestion_index.remove_document(document_id)
+            if hasattr(app, "vespa_app"):
+                result = await app.vespa_app.remove_pages(document_ids)
+                if result["status"] != "success":
+                    logger.error(f"Error removing pages of user {user_id} from Vespa: {result['message']}")
         return Redirect("/settings?tab=users")
     except ValueError as e:
         logger.error(f"Validation error updating users: {e}")
@@ -840,6 +1269,7 @@ async def update_demo_questions(request):
     if questions:
         user_id = request.session["user_id"]
         await request.app.db.update_settings(user_id, {'demo_questions': questions})
+        asyncio.create_task(warm_query_embedding_cache(questions))
 
     return Redirect("/settings?tab=demo-questions")
 
@@ -961,7 +1391,15 @@ async def deploy_part_2(request):
             logger.error("Settings not found")
             return {"status": "error", "message": "Settings not found"}
 
-        result = await deploy_application_step_2(request, settings, user_id)
+        # A deploy of an unchanged package is skipped, force=true deploys it anyway
+        force = request.query_params.get("force", "").lower() == "true"
+        # Schema changes that need a reindex or re-feed are returned for confirmation first
+        confirmed = request.query_params.get("confirm", "").lower() == "true"
+        result = await deploy_application_step_2(
+            request, settings, user_id, force=force, confirmed=confirmed
+        )
+        if result["status"] == "confirm":
+            return result
 
         # Read the settings again to get the new URL
         settings: UserSettings = await request.app.db.get_user_settings(user_id)
@@ -970,6 +1408,7 @@ async def deploy_part_2(request):
             return {"status": "error", "message": "Settings not found"}
 
         app.vespa_app = VespaQueryClient(logger=logger, settings=settings)
+        asyncio.create_task(build_suggestion_index())
 
         # Configure Gemini with the API key
         configure_gemini(settings.gemini_token)
@@ -998,6 +1437,13 @@ async def get_deployment_login_modal(request):
 async def get_deployment_success_modal(request):
     return DeploymentSuccessModal()
 
+@rt("/deployment-modal/confirm")
+@login_required
+async def get_deployment_confirm_modal(request):
+    action = request.query_params.get("action", "")
+    reasons = request.query_params.getlist("reason")
+    return DeploymentConfirmModal(action=action, reasons=reasons)
+
 @rt("/deployment-modal/error")
 @login_required
 async def get_deployment_error_modal(request):
@@ -1066,20 +1512,24 @@ async def image_search(request):
         image = Image.open(BytesIO(image_content))
         logger.info(f"Opened image: {image.size}, mode: {image.mode}")
 
-        # Process the image using the processor
-        logger.info("Processing image with ColPali processor")
-        processed_image = app.sim_map_generator.processor.process_images([image])
-        logger.info(f"Processed image keys: {processed_image.keys()}")
-
-        processed_image = {k: v.to(app.sim_map_generator.model.device) for k, v in processed_image.items()}
-        logger.info(f"Moved tensors to device: {app.sim_map_generator.model.device}")
-
-        # Generate embeddings using the model
+        # Generate embeddings using the model, in the query lane of the encoder
         logger.info("Generating embeddings")
-        with torch.no_grad():
-            embeddings = app.sim_map_generator.model(**processed_image)
+        sim_map_generator = await get_sim_map_generator()
+        embeddings = await asyncio.to_thread(sim_map_generator.encode_image_query, image)
         logger.info(f"Generated embeddings shape: {embeddings.shape}")
 
+        # Drop background patches and pool the rest, instead of truncating to the first patches
+        embeddings, pooling_stats = await asyncio.to_thread(
+            reduce_image_query,
+            embeddings,
+            image,
+            num_patches=sim_map_generator.num_image_patches,
+            budget=IMAGE_QUERY_MAX_PATCHES,
+            method=IMAGE_QUERY_POOLING,
+            min_std=IMAGE_QUERY_MIN_PATCH_STD,
+        )
+        logger.info(f"Reduced image query embeddings: {pooling_stats}")
+
         try:
             logger.info("Extracting text with OCR")
             text = pytesseract.image_to_string(image)
@@ -1097,7 +1547,7 @@ async def image_search(request):
         logger.info(f"Is visual only: {is_visual_only}")
 
         logger.info("Storing image query in database")
-        await app.db.store_image_query(query_id, embeddings[0], text, is_visual_only)
+        await app.db.store_image_query(query_id, embeddings, text, is_visual_only)
         logger.info("Successfully stored image query")
 
         response_data = {
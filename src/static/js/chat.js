@@ -0,0 +1,9 @@
+// Gemini answers are streamed as deltas of HTML. A tag can be split across two deltas, so the parts are
+// joined and the whole answer is rendered again, instead of appending each part on its own.
+document.addEventListener('htmx:sseBeforeMessage', function (event) {
+    const target = event.target;
+    if (!target.getAttribute || target.getAttribute('sse-swap') !== 'delta') return;
+    event.preventDefault();
+    target.dataset.answer = (target.dataset.answer || '') + event.detail.data;
+    target.innerHTML = target.dataset.answer;
+});
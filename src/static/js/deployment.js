@@ -29,6 +29,19 @@ function handleVespaLogin(url) {
     }, 1000);
 }
 
+function confirmDeployment() {
+    isDeploying = true;
+    htmx.ajax('GET', '/deployment-modal', {
+        target: '#deployment-modal',
+        swap: 'innerHTML'
+    }).then(() => {
+        htmx.ajax('POST', '/api/deploy-part-2?confirm=true', {
+            target: '#deployment-modal',
+            swap: 'innerHTML'
+        });
+    });
+}
+
 function closeDeploymentModal() {
     document.getElementById('deployment-modal').remove();
 }
@@ -74,7 +87,7 @@ document.addEventListener('htmx:afterRequest', function(event) {
                 });
             }
         }
-    } else if (event.detail.requestConfig.path === '/api/deploy-part-2') {
+    } else if (event.detail.requestConfig.path.startsWith('/api/deploy-part-2')) {
         isDeploying = false;
         const modalContainer = document.getElementById('deployment-modal');
 
@@ -86,6 +99,14 @@ document.addEventListener('htmx:afterRequest', function(event) {
                     target: '#deployment-modal',
                     swap: 'innerHTML'
                 });
+            } else if (response.status === 'confirm') {
+                // The schema change needs a reindex or re-feed, ask before deploying it
+                const params = new URLSearchParams({ action: response.schema_change.action });
+                response.schema_change.reasons.forEach(reason => params.append('reason', reason));
+                htmx.ajax('GET', `/deployment-modal/confirm?${params}`, {
+                    target: '#deployment-modal',
+                    swap: 'innerHTML'
+                });
             } else {
                 htmx.ajax('GET', '/deployment-modal/error', {
                     target: '#deployment-modal',